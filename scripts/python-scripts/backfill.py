@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# backfill.py
+# rebuild the history of the yearly datasets from the source files under data/, without Socrata
+#
+# Every fiscal-year folder (data/approved_budget/FY17-18, data/proposed_budget/FY18-19, ...) is
+# found, and each year's Expenditures, Positions, General Fund Revenue, Performance Measures and
+# Budget Requests Detail files are normalized with the dataset specs (see dataset_specs.py) in a
+# process pool, one worker per year. The years are then merged into one long table per dataset
+# and stage, e.g. expenses_adopted.csv, with the columns of the yearly output in their order (see
+# budget_config.datasets): the expenses get their program priorities from the maintained index
+# ('Not Categorized' without one) and a blank expense_type, as in expenses.py.
+#
+# Only files named for the folder's stage are used (a *Proposed* file in an approved_budget folder
+# is skipped), a file found twice in the same year is read once, and of the revisions of a file
+# (..._Rev20180425.xlsx) only the latest is used. Of the expenditures and budget requests, only
+# section 2 (the regular departments and non-departmental) is read by default, as the yearly
+# pipelines do; --sections 2 4 adds section 4 (Library and Recreation and Parks).
+#
+# Usage (from scripts/python-scripts):
+#   python3 backfill.py
+#   python3 backfill.py --data-root ../../data/ --output-dir ../../data/backfill/ --workers 4
+#   python3 backfill.py --sections 2 4
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from budget_config import datasets
+from dataset_specs import read_dataset
+from priority_index import assign_priorities, default_index_path, load_index, not_categorized
+
+# stage of the budget in each folder under data/
+stage_folders = {'approved_budget': 'Adopted', 'proposed_budget': 'Proposed'}
+
+# file name patterns of each dataset's yearly files (case-insensitive, spaces or underscores); {section}
+# is the budget section of the files that come in one per section
+file_patterns = {
+    'expenses': r'^Expenditures[ _]Sec{section}(?!\d)',
+    'positions': r'^Positions[ _]',
+    'gfrev': r'^General[ _]Fund[ _]Revenue[ _]',
+    'pm': r'^Performance[ _]Measures[ _]',
+    'inc': r'^Budget[ _]Requests[ _]Detail[ _]Sec{section}(?!\d)',
+}
+
+# the sections read by the yearly pipelines (see budget_config.input_files)
+default_sections = ('2',)
+
+source_extensions = ('.csv', '.xls', '.xlsx')
+
+
+def folder_fiscal_year(folder):
+    """'FY17-18' -> 2018, the year the fiscal year ends in."""
+    match = re.fullmatch(r'FY\d{2}-(\d{2})', os.path.basename(os.path.normpath(folder)))
+    return 2000 + int(match.group(1)) if match else None
+
+
+def _revision(filename):
+    # the name without its revision suffix or download counter, and the revision
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    stem = re.sub(r'\s*\(\d+\)$', '', stem)
+    match = re.search(r'_Rev(\d+)$', stem)
+    return (stem[:match.start()] if match else stem) + ext.lower(), match.group(1) if match else ''
+
+
+def _file_pattern(dataset, sections):
+    # the pattern of the dataset's files, matching any of the sections
+    return file_patterns[dataset].replace('{section}', '(?:' + '|'.join(map(re.escape, sections)) + ')')
+
+
+def year_files(folder, stage, sections=default_sections):
+    """{dataset: [files]} of one fiscal-year folder, including its subfolders."""
+    latest = {}
+    for filename in sorted(glob.glob(os.path.join(folder, '**', '*'), recursive=True)):
+        name = os.path.basename(filename)
+        if not name.lower().endswith(source_extensions) or stage.lower() not in name.lower():
+            continue
+        key, revision = _revision(filename)
+        if key not in latest or revision > latest[key][0]:
+            latest[key] = (revision, filename)
+
+    patterns = {dataset: _file_pattern(dataset, sections) for dataset in file_patterns}
+    files = {}
+    for _, filename in sorted(latest.values(), key=lambda item: item[1]):
+        for dataset, pattern in patterns.items():
+            if re.search(pattern, os.path.basename(filename), re.IGNORECASE):
+                files.setdefault(dataset, []).append(filename)
+    return files
+
+
+def find_years(data_root='../../data/', sections=default_sections):
+    """One dict per fiscal-year folder under data_root: folder, fiscal_year, stage and files."""
+    years = []
+    for folder_name, stage in stage_folders.items():
+        for folder in sorted(glob.glob(os.path.join(data_root, folder_name, 'FY*'))):
+            fiscal_year = folder_fiscal_year(folder)
+            if fiscal_year is None or not os.path.isdir(folder):
+                continue
+            years.append({'folder': folder, 'fiscal_year': fiscal_year, 'stage': stage,
+                          'files': year_files(folder, stage, sections)})
+    return years
+
+
+def normalize_year(year):
+    """
+    Read every file of one fiscal-year folder with its spec; returns ({dataset: frame}, problems).
+    Runs in a worker process.
+    """
+    tables = {}
+    problems = []
+    for dataset, filenames in year['files'].items():
+        frames = []
+        for filename in filenames:
+            try:
+                frames.append(read_dataset(dataset, filename, year['fiscal_year'], year['stage']))
+            except (KeyError, ValueError) as e:
+                # a file of another year or layout; reported, not fatal
+                problems.append(f'{filename}: {e}')
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+            if 'fiscal_year' not in df.columns:
+                df['fiscal_year'] = year['fiscal_year']
+            tables[dataset] = df
+    return tables, problems
+
+
+def backfill(data_root='../../data/', output_dir='../../data/backfill/', workers=None, index_path=None,
+             sections=default_sections):
+    """
+    Rebuild every dataset from the fiscal-year folders under data_root and write one
+    <dataset>_<stage>.csv per dataset and stage to output_dir. Returns {(dataset, stage): frame}.
+    The priorities come from index_path (default: program_priority_index.csv in data_root); the
+    expenditures and budget requests are read from the given budget sections.
+    """
+    index_path = index_path or os.path.join(data_root, os.path.basename(default_index_path))
+    start = time.perf_counter()
+    years = [year for year in find_years(data_root, sections) if year['files']]
+    if not years:
+        print(f'no fiscal-year folders with source files under {data_root}')
+        return {}
+
+    merged = {}
+    with ProcessPoolExecutor(max_workers=workers or min(len(years), os.cpu_count() or 1)) as pool:
+        for year, (tables, problems) in zip(years, pool.map(normalize_year, years)):
+            counts = ', '.join(f'{dataset} {len(df):,}' for dataset, df in tables.items())
+            print(f"{year['folder']} ({year['stage']} {year['fiscal_year']}): {counts}")
+            for problem in problems:
+                print(f'  skipped {problem}')
+            for dataset, df in tables.items():
+                merged.setdefault((dataset, year['stage']), []).append(df)
+
+    # the priorities of the expenses come from the maintained index, if there is one
+    index = load_index(index_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    for (dataset, stage), frames in merged.items():
+        df = pd.concat(frames, ignore_index=True)
+        if dataset == 'expenses':
+            df['program_priority'] = assign_priorities(df, index, report=False) if len(index) else not_categorized
+            df['expense_type'] = None
+        df = df.sort_values('fiscal_year', ascending=False, kind='stable', ignore_index=True)
+        fiscal_years = sorted(df['fiscal_year'].unique().tolist())
+        # the fiscal_year column added to sort the years is dropped again where the output has none
+        df = df.reindex(columns=datasets[dataset]['columns'])
+        filename = os.path.join(output_dir, f'{dataset}_{stage.lower()}.csv')
+        df.to_csv(filename, index=False)
+        print(f'{filename}: {len(df):,} rows, fiscal years {fiscal_years}')
+        results[(dataset, stage)] = df
+
+    print(f'backfill done in {time.perf_counter() - start:.1f}s')
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild the dataset history from the source files under data/.')
+    parser.add_argument('--data-root', default='../../data/', help='folder holding approved_budget/ and proposed_budget/')
+    parser.add_argument('--output-dir', default='../../data/backfill/', help='where to write the long tables')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per year)')
+    parser.add_argument('--sections', nargs='+', default=list(default_sections),
+                        help='budget sections of the expenditures and budget requests to read (default: 2)')
+    args = parser.parse_args(argv)
+    backfill(args.data_root, args.output_dir, args.workers, sections=args.sections)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
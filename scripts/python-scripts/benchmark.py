@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# benchmark.py
+# time each pipeline stage on synthetic data of growing size
+#
+# The appropriations dataset gains a year of department x program x fund x account rows every
+# year, so this measures how each stage scales. The stages call the functions the pipelines run:
+# fetch (socrata_fetch, against a local fake Socrata client), reading the yearly expenses, positions
+# and budget requests files (dataset_specs.read_dataset), the priority lookup
+# (priority_index.assign_priorities), combining the old and new rows over the shared vocabulary
+# (dimensions) and sorting them by fiscal year, csv write and Exhibit B parsing (revenue_parser).
+# Results are written to a JSON file; pass a previous results file as --baseline to flag
+# stages that got slower.
+#
+# Usage (from scripts/python-scripts):
+#   python3 benchmark.py                                  # 10k, 100k and 1M rows
+#   python3 benchmark.py --rows 10000 10000000 --output benchmark_results.json
+#   python3 benchmark.py --baseline benchmark_baseline.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import synthetic_data
+from budget_config import socrata_dtypes
+from dataset_specs import read_dataset
+from dimensions import Vocabulary
+from priority_index import assign_priorities, update_index, load_index
+from revenue_parser import iter_records
+from socrata_fetch import fetch_dataset
+from socrata_sync import drop_system_fields
+
+default_rows = [10_000, 100_000, 1_000_000]
+
+
+class FakeSocrata:
+    """In-memory stand-in for sodapy.Socrata, serving a list of records."""
+
+    def __init__(self, records):
+        self.records = records
+
+    def get(self, identifier, select=None, limit=1000, offset=0, **query):
+        if select == 'count(*)':
+            return [{'count': str(len(self.records))}]
+        return self.records[offset:offset + limit]
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run(rows, workdir):
+    """Run every stage once on rows rows; returns a list of result dicts."""
+    results = []
+
+    def record(stage, seconds, n):
+        # size is the data size of the run, rows the rows the stage actually handled
+        results.append({'stage': stage, 'size': rows, 'rows': n, 'seconds': round(seconds, 6),
+                        'rows_per_sec': round(n / seconds) if seconds > 0 else None})
+        print(f'{stage:<16} {n:>10,} rows {seconds:>9.3f}s')
+
+    # fetch, with the typed pages of expenses.py
+    client = FakeSocrata(synthetic_data.socrata_appropriations(rows))
+    seconds, old = _timed(lambda: fetch_dataset(client, '5242-pnmt', dtypes=socrata_dtypes['5242-pnmt']))
+    record('fetch', seconds, len(old))
+    old = drop_system_fields(old)
+    del client
+
+    # the yearly files, read through their specs as the pipelines do
+    for name, generate, size in [('expenses', synthetic_data.expenditures, rows),
+                                 ('positions', synthetic_data.positions, rows // 10),
+                                 ('inc', synthetic_data.budget_requests, rows // 10)]:
+        filename = os.path.join(workdir, f'{name}_{rows}.csv')
+        generate(size).to_csv(filename, index=False)
+        seconds, df = _timed(read_dataset, name, filename, 2022, 'Adopted')
+        record(f'read_{name}', seconds, len(df))
+        if name == 'expenses':
+            new = df
+
+    # priority lookup
+    index = update_index(load_index(os.path.join(workdir, 'no_index.csv')), old, 'socrata', 1)
+    seconds, priorities = _timed(lambda: assign_priorities(new, index, report=False))
+    record('priority_merge', seconds, len(new))
+    new['program_priority'] = priorities
+    new['fiscal_year'] = 2022
+    new['expense_type'] = None
+    new = new[old.columns]
+
+    # combine the new and old rows, encoded over a (new) shared vocabulary, and sort them by fiscal year,
+    # as in expenses.py
+    def combine():
+        expenses = Vocabulary().concat([new, old], axis=0).astype({'fiscal_year': int})
+        return expenses.sort_values(by=['fiscal_year'], ascending=False)
+
+    seconds, expenses = _timed(combine)
+    record('concat', seconds, len(expenses))
+
+    # csv write
+    seconds, _ = _timed(lambda: expenses.to_csv(os.path.join(workdir, 'new_expenses.csv'), index=False))
+    record('csv_write', seconds, len(expenses))
+
+    # Exhibit B parsing: a real Exhibit B has ~100 lines, so this uses one line per 100 rows
+    pages = synthetic_data.exhibit_b_pages(max(rows // 100, 100))
+    seconds, records = _timed(lambda: list(iter_records(pages)))
+    record('pdf_parse', seconds, len(records))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the stages that are more than tolerance slower than in baseline; returns their number."""
+    # results written before size was recorded have the size of the run as rows
+    previous = {(r['stage'], r.get('size', r['rows'])): r['seconds'] for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        before = previous.get((r['stage'], r['size']))
+        if before and r['seconds'] > before * (1 + tolerance):
+            regressions += 1
+            print(f'REGRESSION {r["stage"]} at {r["size"]:,} rows: {before:.3f}s -> {r["seconds"]:.3f}s')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the budget pipeline stages on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=default_rows, help='data sizes to run')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='previous results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before flagging, e.g. 0.25 = 25%%')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in args.rows:
+            results += run(rows, workdir)
+
+    output = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# budget_config.py
+# the fiscal year, folders and file names the pipelines work on, and the datasets they publish
+#
+# The scripts used to hardcode '../../data/approved_budget/FY21-22/' and each file name of the
+# year. BudgetYear derives them all from the fiscal year, the budget stage and the data root,
+# following the names of the City Administrative Office exports, e.g. for the 2022 adopted budget:
+#
+#   folder      ../../data/approved_budget/FY21-22/
+#   expenses    ../../data/approved_budget/FY21-22/Expenditures_Sec2_for_2122_Adopted.csv
+#   exhibit_b   ../../data/approved_budget/FY21-22/05-Exhibit B 22A.pdf
+#
+# This module only uses the standard library, so the labudget command line can use it without
+# loading pandas.
+
+import os
+
+# relative to scripts/python-scripts
+default_data_root = '../../data/'
+
+# the fiscal year being added (the year it ends in), and its stage
+default_fiscal_year = 2022
+default_stage = 'Adopted'
+
+# folder of each stage under the data root
+stage_folders = {'Adopted': 'approved_budget', 'Proposed': 'proposed_budget'}
+
+# the yearly input files, named after the fields of BudgetYear.fields()
+input_files = {
+    'expenses': 'Expenditures_Sec2_for_{yy}_{stage}.csv',
+    'gfrev': 'General_Fund_Revenue_{yy}_{stage}.csv',
+    'positions': 'Positions_{yy}_{stage}.csv',
+    'inc': 'Budget_Requests_Detail_Sec2_{yy}_{stage}.csv',
+    'pm': 'Performance_Measures_{yy}_{stage}.csv',
+    'departments': 'QRY_Department_Name_Text_{yy}_{stage}.csv',
+    'programs': 'QRY_Program_Description_Text_{yy}_{stage}.csv',
+    'exhibit_b': '05-Exhibit B {end}{stage_letter}.pdf',
+}
+
+# the Socrata datasets: identifier, natural key (Socrata column names), the output file that
+# is published to it, the dtypes of the numeric columns, applied to every page as it is fetched
+# (everything else stays text, so codes keep their leading zeros), and for the yearly line-item
+# datasets the columns of the output, in the order of the portal
+datasets = {
+    'expenses': {
+        'identifier': '5242-pnmt',
+        'key': ['fiscal_year', 'dept_code', 'prog_code', 'source_fund_code', 'account_code'],
+        'output': 'new_expenses.csv',
+        'dtypes': {'appropriation': 'float64', 'fiscal_year': 'Int64'},
+        'columns': ['dept_code', 'department_name', 'subdept_code', 'subdepartment_name', 'prog_code', 'program_name',
+                    'program_priority', 'source_fund_code', 'source_fund_name', 'account_code', 'account_name',
+                    'appropriation', 'fiscal_year', 'expense_type'],
+    },
+    'revenues': {
+        'identifier': 'ih6g-qkwz',
+        'key': ['fiscal_year', 'revenue_source', 'fund_type'],
+        'output': 'final_revenues.csv',
+        'dtypes': {'amount': 'float64', 'fiscal_year_2': 'Int64'},
+        # the output uses the column names of the old R scripts
+        'socrata_columns': {
+            'Revenue.Source': 'revenue_source',
+            'Amount': 'amount',
+            'Fund.Type': 'fund_type',
+            'Fiscal.Year': 'fiscal_year',
+            'Fiscal.Year.Shorthand': 'fiscal_year_2',
+        },
+    },
+    'descriptions': {
+        'identifier': 'cd49-p4un',
+        'key': ['entity_type', 'entity_name'],
+        'output': 'new_descriptions.csv',
+    },
+    'gfrev': {
+        'identifier': 'qrkr-kfbh',
+        'key': ['fiscal_year', 'dept_code', 'program_code', 'fund_code', 'account_code'],
+        'output': 'new_gfrev.csv',
+        'dtypes': {'revenue': 'float64'},
+        'columns': ['dept_code', 'department_name', 'program_code', 'program_name', 'fund_code', 'fund_name',
+                    'account_code', 'account_name', 'fiscal_year', 'revenue'],
+    },
+    'positions': {
+        'identifier': '46qe-t7np',
+        'key': ['budget', 'department_code', 'program_code', 'source_fund_code', 'account_code'],
+        'output': 'new_positions.csv',
+        'dtypes': {'positions': 'float64'},
+        'columns': ['department_code', 'department_name', 'program_code', 'program_name', 'fund_code',
+                    'source_fund_code', 'source_fund_name', 'account_code', 'account_name', 'budget', 'positions'],
+    },
+    'inc': {
+        'identifier': 'k4k6-bwwv',
+        'key': ['budget', 'department_code', 'program_code', 'source_fund_code', 'account_code',
+                'budget_request_description'],
+        'output': 'new_incremental_changes.csv',
+        'dtypes': {'incremental_change': 'float64'},
+        'columns': ['department_code', 'department_name', 'program_code', 'program_name', 'fund_code', 'fund_name',
+                    'source_fund_code', 'source_fund_name', 'budget_request_description', 'budget_request_category',
+                    'account_code', 'account_name', 'one_time_ongoing', 'budget', 'incremental_change'],
+    },
+    'pm': {
+        'identifier': 'bywz-284j',
+        'key': ['budget', 'department_code', 'program_code', 'performance_measure_code'],
+        'output': 'new_performance_measures.csv',
+        'dtypes': {'performance_measure_amount': 'float64'},
+        'columns': ['department_code', 'department_name', 'subdept_code', 'subdept_name', 'program_code',
+                    'program_name', 'performance_measure_code', 'performance_measure_name', 'unit', 'budget',
+                    'performance_measure_amount'],
+    },
+}
+
+# natural keys by dataset identifier
+natural_keys = {spec['identifier']: spec['key'] for spec in datasets.values()}
+
+# dtypes of the fetched pages by dataset identifier (see socrata_fetch.py); pass the same mapping
+# everywhere a dataset is fetched, since it is part of the snapshot's cache key
+socrata_dtypes = {spec['identifier']: spec.get('dtypes', {}) for spec in datasets.values()}
+
+socrata_domain = 'data.lacity.org'
+
+
+class BudgetYear:
+    """The folders and files of one fiscal year's budget (fiscal_year is the year it ends in)."""
+
+    def __init__(self, fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage):
+        if stage not in stage_folders:
+            raise ValueError(f'unknown budget stage {stage!r}; expected one of {sorted(stage_folders)}')
+        self.fiscal_year = int(fiscal_year)
+        self.data_root = data_root
+        self.stage = stage
+
+    def __repr__(self):
+        return f'BudgetYear({self.fiscal_year}, {self.data_root!r}, {self.stage!r})'
+
+    def fields(self):
+        """For 2022: label='FY21-22', fy_long='2021-2022', yy='2122', end='22', stage='Adopted', stage_letter='A'."""
+        start, end = str(self.fiscal_year - 1)[2:], str(self.fiscal_year)[2:]
+        return {
+            'label': f'FY{start}-{end}',
+            'fy_long': f'{self.fiscal_year - 1}-{self.fiscal_year}',
+            'yy': f'{start}{end}',
+            'end': end,
+            'stage': self.stage,
+            'stage_letter': self.stage[0],
+        }
+
+    @property
+    def folder(self):
+        """The folder of the year's input files, where the outputs are written too (ends in a separator)."""
+        return os.path.join(self.data_root, stage_folders[self.stage], self.fields()['label'], '')
+
+    def input_file(self, name):
+        return os.path.join(self.folder, input_files[name].format(**self.fields()))
+
+    def output_file(self, name):
+        """The file written for a dataset (a key of datasets) or any other file name in the folder."""
+        return os.path.join(self.folder, datasets[name]['output'] if name in datasets else name)
+
+    def data_file(self, name):
+        """A file or folder directly under the data root, e.g. program_priority_index.csv."""
+        return os.path.join(self.data_root, name)
+
+
+def socrata_client(login=False):
+    """
+    A sodapy client for the portal; reading public data needs no credentials, pushing to it
+    does (fill them in credentials.py).
+    """
+    from sodapy import Socrata
+
+    if not login:
+        return Socrata(socrata_domain, None)
+    import credentials
+
+    return Socrata(socrata_domain, credentials.lahub_auth, username=credentials.lahub_user,
+                   password=credentials.lahub_pass)
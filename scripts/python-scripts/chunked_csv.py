@@ -0,0 +1,37 @@
+# chunked_csv.py
+# write a csv file one data frame at a time
+#
+# Used by the out-of-core modes, which never hold the whole output in memory: the header is
+# written with the first chunk, and every later chunk is appended with its columns put in the
+# same order (columns a chunk doesn't have are left empty).
+
+
+class ChunkedCsvWriter:
+    """
+    with ChunkedCsvWriter('new_expenses.csv') as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    """
+
+    def __init__(self, path, columns=None, **to_csv_options):
+        self.path = path
+        self.columns = list(columns) if columns is not None else None
+        self.options = dict({'index': False}, **to_csv_options)
+        self.rows = 0
+        self.started = False
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'w', newline='')
+        return self
+
+    def write(self, chunk):
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        chunk.reindex(columns=self.columns).to_csv(self.file, header=not self.started, **self.options)
+        self.started = True
+        self.rows += len(chunk)
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+        return False
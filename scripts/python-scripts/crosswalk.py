@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# crosswalk.py
+# stable IDs for the departments and programs, across fiscal years
+#
+# Department and program codes and names drift between fiscal years: 'Public Works - Bureau of
+# Sanitation' becomes 'Bureau of Sanitation' under the same code, a program is renumbered but
+# keeps its name, the non-departmental funds have no code at all. Joining the years on the raw
+# (dept_code, prog_code) or on the names loses rows. The crosswalk collects every code/name
+# variant seen in the historical datasets and assigns each one the ID of the entity it belongs to:
+#
+#   - two variants belong to the same department when they share the code or the (normalized)
+#     name; the same goes for programs, within a department
+#   - every variant keeps the first and last fiscal year it was seen in, and the datasets it was
+#     seen in; the validity range of an entity is that of its variants
+#
+# The crosswalk is kept in one file, and rebuilding it only adds to it: variants already in the
+# file keep their ID, so the IDs can be stored by other datasets. When new observations show that
+# two entities are one, the lower ID is kept. Lookups go through hashed indexes (Crosswalk).
+#
+# Usage (from scripts/python-scripts), to rebuild the crosswalk from everything under data/:
+#   python3 crosswalk.py
+
+import glob
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import parquet_store
+from backfill import folder_fiscal_year, stage_folders
+from dataset_specs import read_table
+from priority_index import normalize_codes
+
+# where the crosswalk is kept, relative to scripts/python-scripts
+default_crosswalk_path = '../../data/code_crosswalk.csv'
+
+crosswalk_columns = ['entity_id', 'kind', 'dept_id', 'dept_code', 'code', 'name', 'name_key',
+                     'first_year', 'last_year', 'sources']
+
+# the historical datasets the variants are collected from (see parquet_store.py), besides the long
+# tables written by backfill.py to data/backfill/, if they exist, and the description files
+store_datasets = ['appropriations', 'budget_long', 'positions', 'performance_measures', 'gfrev']
+
+# the names the code and name columns go by in those datasets
+dept_code_columns = ['dept_code', 'department_code']
+dept_name_columns = ['department_name', 'dept_name']
+prog_code_columns = ['prog_code', 'program_code']
+prog_name_columns = ['program_name', 'prog_name']
+
+# the yearly description files: (pattern of the file name, code column, name column)
+description_files = {
+    'department': (r'(Department|Dept)[ _](Name|Description)[ _]Text', ['Dept Number', 'Department Number'],
+                   ['Dept Name', 'Department Name']),
+    'program': (r'Program[ _]Description[ _]Text', ['Program Number'], ['Program Name']),
+}
+
+id_prefixes = {'department': 'D', 'program': 'P'}
+
+
+def name_keys(names):
+    """Matching key of each name: 'Public Works - Bureau of Sanitation*' -> 'publicworksbureauofsanitation'."""
+    return (names.astype(object).where(names.notna(), '').astype(str).str.lower()
+            .str.replace('&', 'and', regex=False)
+            .str.replace(r'[^a-z0-9]', '', regex=True))
+
+
+def _first_present(df, columns):
+    for column in columns:
+        if column in df.columns:
+            return df[column]
+    return pd.Series('', index=df.index, dtype=object)
+
+
+def observations(df, source, fiscal_year=None):
+    """
+    The distinct (dept_code, dept_name, prog_code, prog_name, fiscal_year) of a dataset, with the
+    source name; the fiscal year comes from the fiscal_year column unless given.
+    """
+    seen = pd.DataFrame({
+        'dept_code': normalize_codes(_first_present(df, dept_code_columns)),
+        'dept_name': _first_present(df, dept_name_columns).astype(object).fillna('').astype(str).str.strip(),
+        'prog_code': normalize_codes(_first_present(df, prog_code_columns)),
+        'prog_name': _first_present(df, prog_name_columns).astype(object).fillna('').astype(str).str.strip(),
+        'fiscal_year': fiscal_year if fiscal_year is not None else pd.to_numeric(df['fiscal_year'], errors='coerce'),
+    })
+    seen = seen.dropna(subset=['fiscal_year']).drop_duplicates()
+    seen['fiscal_year'] = seen['fiscal_year'].astype(int)
+    seen['source'] = source
+    return seen
+
+
+def _description_observations(data_root):
+    # the department and program description files of every fiscal-year folder
+    frames = []
+    for folder_name, stage in stage_folders.items():
+        for folder in sorted(glob.glob(os.path.join(data_root, folder_name, 'FY*'))):
+            fiscal_year = folder_fiscal_year(folder)
+            if fiscal_year is None:
+                continue
+            for filename in sorted(glob.glob(os.path.join(folder, '**', '*'), recursive=True)):
+                name = os.path.basename(filename)
+                if stage.lower() not in name.lower():
+                    continue
+                for kind, (pattern, code_columns, name_columns) in description_files.items():
+                    if not re.search(pattern, name, re.IGNORECASE):
+                        continue
+                    df = read_table(filename, dtype=str)
+                    codes = _first_present(df, code_columns)
+                    names = _first_present(df, name_columns)
+                    if kind == 'department':
+                        df = pd.DataFrame({'dept_code': codes, 'department_name': names})
+                    else:
+                        # program numbers are the department number followed by two digits
+                        digits = codes.astype(object).fillna('').astype(str).str.fullmatch(r'\d{3,4}')
+                        dept_codes = codes.str[:-2].where(digits, '')
+                        df = pd.DataFrame({'dept_code': dept_codes, 'prog_code': codes, 'program_name': names})
+                    frames.append(observations(df, name, fiscal_year))
+    return frames
+
+
+def collect_observations(data_root='../../data/'):
+    """Every code/name combination seen in the historical datasets under data_root."""
+    frames = []
+    for dataset in store_datasets:
+        frames.append(observations(parquet_store.load(dataset, data_root=data_root), dataset))
+    for filename in sorted(glob.glob(os.path.join(data_root, 'backfill', '*.csv'))):
+        header = pd.read_csv(filename, nrows=0).columns
+        usecols = [c for c in header if c in dept_code_columns + dept_name_columns + prog_code_columns +
+                   prog_name_columns + ['fiscal_year']]
+        df = pd.read_csv(filename, usecols=usecols, dtype=str)
+        frames.append(observations(df, f'backfill/{os.path.basename(filename)}'))
+    frames.extend(_description_observations(data_root))
+    return pd.concat(frames, ignore_index=True).drop_duplicates()
+
+
+def _components(left, right):
+    """Connected components of the graph whose edges are the pairs (left[i], right[i]) of node numbers."""
+    n = int(max(left.max(initial=-1), right.max(initial=-1))) + 1
+    labels = np.arange(n)
+    while True:
+        smallest = np.minimum(labels[left], labels[right])
+        updated = labels.copy()
+        np.minimum.at(updated, left, smallest)
+        np.minimum.at(updated, right, smallest)
+        # pointer jumping: a node takes the label of its label
+        while True:
+            jumped = updated[updated]
+            if (jumped == updated).all():
+                break
+            updated = jumped
+        if (updated == labels).all():
+            return labels
+        labels = updated
+
+
+def _ambiguous(seen, scope, column, other):
+    # rows whose value of column one dataset uses for more than one value of other in the same scope
+    # and fiscal year, like the placeholder program code '100' of the revenue dataset: it identifies
+    # nothing. Only the new observations count, the rows of the existing crosswalk have an ID already
+    keys = pd.DataFrame({'scope': scope, 'key': seen[column], 'other': seen[other], 'year': seen['fiscal_year'],
+                         'source': seen['source']})
+    keys = keys[(keys['key'] != '') & (keys['other'] != '') & (seen['entity_id'] == '')].drop_duplicates()
+    counts = keys.groupby(['scope', 'key', 'year', 'source']).size()
+    ambiguous = pd.MultiIndex.from_frame(counts[counts > 1].reset_index()[['scope', 'key']])
+    return pd.MultiIndex.from_arrays([scope, seen[column]]).isin(ambiguous)
+
+
+def _group(seen, scope):
+    """
+    The component of each observation: observations sharing a code or a name key within the same
+    scope (e.g. the department of a program) are one entity, unless that code or name is ambiguous.
+    """
+    scope = pd.Series(scope, index=seen.index, dtype=object)
+    codes = seen['code'].where(~_ambiguous(seen, scope, 'code', 'name_key'), '')
+    names = seen['name_key'].where(~_ambiguous(seen, scope, 'name_key', 'code'), '')
+    code_nodes = np.where(codes != '', scope + '|c|' + codes, '')
+    name_nodes = np.where(names != '', scope + '|n|' + names, '')
+    # a variant with neither is its own node
+    alone = (code_nodes == '') & (name_nodes == '')
+    code_nodes = np.where(alone, scope + '|v|' + pd.Series(np.arange(len(seen)), index=seen.index, dtype=str), code_nodes)
+    code_nodes = np.where(code_nodes == '', name_nodes, code_nodes)
+    name_nodes = np.where(name_nodes == '', code_nodes, name_nodes)
+    nodes, _ = pd.factorize(np.concatenate([code_nodes, name_nodes]))
+    labels = _components(nodes[:len(seen)], nodes[len(seen):])
+    return labels[nodes[:len(seen)]]
+
+
+def _assign_ids(components, kind, existing_ids):
+    # a component keeps the lowest ID already given to one of its variants; the others get new ones
+    prefix = id_prefixes[kind]
+    numbers = pd.to_numeric(pd.Series(existing_ids).str[len(prefix):], errors='coerce').to_numpy()
+    kept = pd.Series(numbers).groupby(components).min()
+    next_number = int(np.nanmax(numbers)) + 1 if np.isfinite(numbers).any() else 1
+    new = kept[kept.isna()].index
+    kept[new] = np.arange(next_number, next_number + len(new))
+    width = max(4, len(str(int(kept.max())))) if len(kept) else 4
+    return pd.Series(kept.astype(int).map(lambda n: f'{prefix}{n:0{width}d}')).reindex(components).to_numpy()
+
+
+def _variants(seen, kind):
+    # one row per distinct (dept_id, dept_code, code, name key), with its spelling and years
+    grouped = seen.groupby(['dept_id', 'dept_code', 'code', 'name_key'], sort=True)
+    variants = grouped.agg(first_year=('fiscal_year', 'min'), last_year=('fiscal_year', 'max'),
+                           sources=('source', lambda s: ';'.join(sorted(set(';'.join(s).split(';'))))),
+                           entity_id=('entity_id', 'min')).reset_index()
+    # the most recent spelling of the name
+    latest = seen.sort_values('fiscal_year', kind='stable').drop_duplicates(
+        ['dept_id', 'dept_code', 'code', 'name_key'], keep='last')
+    variants = variants.merge(latest[['dept_id', 'dept_code', 'code', 'name_key', 'name']],
+                              on=['dept_id', 'dept_code', 'code', 'name_key'])
+    variants['kind'] = kind
+    return variants
+
+
+def build_crosswalk(seen, crosswalk=None):
+    """
+    Assign every observation (see collect_observations) to a department and program entity.
+
+    crosswalk is the existing crosswalk, whose variants keep their IDs. Returns the new crosswalk,
+    one row per variant.
+    """
+    if crosswalk is None:
+        crosswalk = pd.DataFrame(columns=crosswalk_columns)
+    old = crosswalk.astype({'first_year': int, 'last_year': int})
+
+    # departments: the observations plus the known variants, with their IDs
+    departments = pd.concat([
+        pd.DataFrame({'dept_id': '', 'dept_code': '', 'code': seen['dept_code'], 'name': seen['dept_name'],
+                      'fiscal_year': seen['fiscal_year'], 'source': seen['source'], 'entity_id': ''}),
+        _known(old[old['kind'] == 'department']),
+    ], ignore_index=True)
+    departments = departments[(departments['code'] != '') | (departments['name'] != '')]
+    departments['name_key'] = name_keys(departments['name'])
+    components = _group(departments, '')
+    departments['entity_id'] = _assign_ids(components, 'department', departments['entity_id'])
+    department_variants = _variants(departments, 'department')
+
+    # programs, within their department
+    dept_ids = Crosswalk(department_variants).department_ids(seen['dept_code'], seen['dept_name'])
+    programs = pd.concat([
+        pd.DataFrame({'dept_id': dept_ids, 'dept_code': seen['dept_code'], 'code': seen['prog_code'],
+                      'name': seen['prog_name'], 'fiscal_year': seen['fiscal_year'], 'source': seen['source'],
+                      'entity_id': ''}),
+        _known(old[old['kind'] == 'program']),
+    ], ignore_index=True)
+    programs = programs[(programs['code'] != '') | (programs['name'] != '')]
+    programs['dept_id'] = _merged_ids(programs['dept_id'], old, department_variants)
+    programs['name_key'] = name_keys(programs['name'])
+    components = _group(programs, programs['dept_id'].to_numpy(dtype=object))
+    programs['entity_id'] = _assign_ids(components, 'program', programs['entity_id'])
+    program_variants = _variants(programs, 'program')
+
+    result = pd.concat([department_variants, program_variants], ignore_index=True)
+    return result[crosswalk_columns]
+
+
+def _known(variants):
+    # the variants of an existing crosswalk as observations of their first and last year
+    known = pd.concat([variants.assign(fiscal_year=variants['first_year']),
+                       variants.assign(fiscal_year=variants['last_year'])], ignore_index=True)
+    return known[['dept_id', 'dept_code', 'code', 'name', 'fiscal_year', 'sources', 'entity_id']].rename(
+        columns={'sources': 'source'}).astype({'dept_id': object, 'dept_code': object, 'code': object,
+                                               'name': object, 'entity_id': object}).fillna('')
+
+
+def _merged_ids(dept_ids, old, department_variants):
+    # department IDs of the existing crosswalk that were merged into another department since
+    old_departments = old[old['kind'] == 'department']
+    renamed = old_departments[['entity_id', 'code', 'name_key']].merge(
+        department_variants[['entity_id', 'code', 'name_key']], on=['code', 'name_key'], suffixes=('_old', ''))
+    renamed = renamed[renamed['entity_id_old'] != renamed['entity_id']].drop_duplicates('entity_id_old')
+    return dept_ids.replace(dict(zip(renamed['entity_id_old'], renamed['entity_id'])))
+
+
+def entities(crosswalk):
+    """One row per entity: its current code and name (from its most recent variant) and validity range."""
+    # named variants before the ones only known by their code
+    latest = crosswalk.assign(named=crosswalk['name'] != '').sort_values(
+        ['named', 'last_year', 'first_year'], kind='stable').drop_duplicates('entity_id', keep='last')
+    ranges = crosswalk.groupby('entity_id').agg(first_year=('first_year', 'min'), last_year=('last_year', 'max'),
+                                                variants=('entity_id', 'size'))
+    return (latest[['entity_id', 'kind', 'dept_id', 'code', 'name']].set_index('entity_id')
+            .join(ranges).reset_index().sort_values('entity_id', ignore_index=True))
+
+
+class Crosswalk:
+    """
+    Hashed lookups of entity IDs by code and name.
+
+    Every method takes array-likes of equal length and returns an array of IDs ('' where the
+    variant is unknown). The code is tried first, then the name.
+    """
+
+    def __init__(self, crosswalk):
+        crosswalk = crosswalk.astype({c: object for c in ['entity_id', 'kind', 'dept_id', 'code', 'name_key']}).fillna('')
+        departments = crosswalk[crosswalk['kind'] == 'department']
+        programs = crosswalk[crosswalk['kind'] == 'program']
+        self._department_codes = self._index(departments['code'], departments['entity_id'])
+        self._department_names = self._index(departments['name_key'], departments['entity_id'])
+        self._program_codes = self._index(programs['dept_id'] + '|' + programs['code'], programs['entity_id'])
+        self._program_names = self._index(programs['dept_id'] + '|' + programs['name_key'], programs['entity_id'])
+        # program codes that belong to a single program in any department
+        unique = programs[programs['code'] != ''].drop_duplicates(['code', 'entity_id'])
+        unique = unique[~unique['code'].duplicated(keep=False)]
+        self._program_only_codes = self._index(unique['code'], unique['entity_id'])
+
+    @staticmethod
+    def _index(keys, ids):
+        # keys with an empty part, and keys of more than one entity (ambiguous codes), are left out
+        pairs = pd.DataFrame({'key': keys.to_numpy(dtype=object), 'id': ids.to_numpy(dtype=object)}).drop_duplicates()
+        pairs = pairs[(pairs['key'] != '') & ~pairs['key'].str.endswith('|')]
+        pairs = pairs[~pairs['key'].duplicated(keep=False)]
+        return pd.Index(pairs['key']), pairs['id'].to_numpy(dtype=object)
+
+    @staticmethod
+    def _get(index, keys, found):
+        # ids of the keys not found yet, in place
+        keys_index, ids = index
+        position = keys_index.get_indexer(keys)
+        missing = (found == '') & (position >= 0)
+        found[missing] = ids[position[missing]]
+
+    def department_ids(self, codes, names=None):
+        codes = normalize_codes(pd.Series(codes, dtype=object)).to_numpy(dtype=object)
+        found = np.full(len(codes), '', dtype=object)
+        self._get(self._department_codes, codes, found)
+        if names is not None:
+            self._get(self._department_names, name_keys(pd.Series(names, dtype=object)).to_numpy(dtype=object), found)
+        return found
+
+    def program_ids(self, dept_codes, prog_codes, names=None, dept_names=None):
+        dept_ids = self.department_ids(dept_codes, dept_names)
+        codes = normalize_codes(pd.Series(prog_codes, dtype=object)).to_numpy(dtype=object)
+        found = np.full(len(codes), '', dtype=object)
+        self._get(self._program_codes, dept_ids + '|' + codes, found)
+        if names is not None:
+            keys = name_keys(pd.Series(names, dtype=object)).to_numpy(dtype=object)
+            self._get(self._program_names, dept_ids + '|' + keys, found)
+        # rows without a known department, by a program code that is used only once
+        self._get(self._program_only_codes, codes, found)
+        return found
+
+
+def load_crosswalk(path=default_crosswalk_path):
+    """Read the crosswalk, or return an empty one if it doesn't exist yet."""
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=crosswalk_columns)
+    return pd.read_csv(path, dtype=str, keep_default_na=False).astype({'first_year': int, 'last_year': int})
+
+
+def save_crosswalk(crosswalk, path=default_crosswalk_path):
+    crosswalk.sort_values(['kind', 'entity_id', 'dept_code', 'code', 'name_key']).to_csv(path, index=False)
+
+
+def update_crosswalk(data_root='../../data/', path=None):
+    """
+    Rebuild the crosswalk file (code_crosswalk.csv in data_root, or path) from the datasets under
+    data_root, keeping the existing IDs.
+    """
+    path = path or os.path.join(data_root, os.path.basename(default_crosswalk_path))
+    crosswalk = build_crosswalk(collect_observations(data_root), load_crosswalk(path))
+    save_crosswalk(crosswalk, path)
+    counts = entities(crosswalk)['kind'].value_counts()
+    print(f"{path}: {len(crosswalk):,} variants of {counts.get('department', 0)} departments and "
+          f"{counts.get('program', 0)} programs")
+    return crosswalk
+
+
+if __name__ == '__main__':
+    update_crosswalk()
+    sys.exit(0)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# data_quality.py
+# declarative data-quality checks, run on the outputs before they are written or uploaded
+#
+# The scripts used to rely on spot checks by hand ("Quality check of the data is still
+# required"). Each output is now described by a list of rules below, and gate() runs them all
+# before the output is saved: every check is one vectorized pass over the frame, and the result
+# is a machine-readable report (JSON) with the number of failing rows and a few examples of each.
+#
+#   columns          the required columns are present
+#   not_null         the columns have no missing values
+#   unique           no two rows have the same natural key
+#   dtypes           the values of each column parse as the declared kind (number, integer)
+#   fiscal_year      the fiscal-year column is present, holds years, and includes the year being added
+#   section_totals   (Exhibit B) the lines of each section add up to the section's "Total ..." line,
+#                    and the sections to the "Total Receipts" line
+#   year_over_year   totals per key that moved by more than a share of the previous fiscal year's
+#
+# Checks have a severity: 'error' stops the pipeline (gate raises QualityError), 'warning' is
+# only reported. The rules of each output are declared in quality_rules.py.
+#
+# Usage (from scripts/python-scripts), to check a csv file against the rules of a dataset:
+#   python3 data_quality.py expenses ../../data/approved_budget/FY21-22/new_expenses.csv --fiscal-year 2022
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from parquet_store import fiscal_year_of
+from quality_rules import rules
+
+# examples of failing rows kept in the report, per check
+max_examples = 5
+
+
+class QualityError(ValueError):
+    """Raised by gate() when a check with severity 'error' fails; report has the details."""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
+def check_columns(df, context, required):
+    missing = [c for c in required if c not in df.columns]
+    return pd.DataFrame({'column': missing})
+
+
+def _new_year_rows(df, context, year, labels=False):
+    # the rows of the fiscal year being added, if the check is given the fiscal-year column and the year is known
+    if year is None or context.get('fiscal_year') is None or year not in df.columns:
+        return df
+    years = fiscal_year_of(df[year]) if labels else pd.to_numeric(df[year], errors='coerce')
+    return df[(years == context['fiscal_year']).to_numpy()]
+
+
+def check_not_null(df, context, columns, year=None, labels=False):
+    """With year (the fiscal-year column), only the rows of the fiscal year being added are checked."""
+    df = _new_year_rows(df, context, year, labels)
+    present = [c for c in columns if c in df.columns]
+    nulls = df[present].isna()
+    failing = nulls.any(axis=1).to_numpy()
+    return df.loc[failing, present]
+
+
+def check_unique(df, context, key, year=None, labels=False):
+    """With year (the fiscal-year column), only the rows of the fiscal year being added are checked."""
+    missing = [c for c in key if c not in df.columns]
+    if missing:
+        return pd.DataFrame({'missing_key_column': missing})
+    df = _new_year_rows(df, context, year, labels)
+    duplicated = df.duplicated(subset=key, keep=False).to_numpy()
+    counts = df.loc[duplicated, key].astype(str).value_counts().rename('rows').reset_index()
+    return counts
+
+
+def check_dtypes(df, context, types, year=None, labels=False):
+    """With year (the fiscal-year column), only the rows of the fiscal year being added are checked."""
+    df = _new_year_rows(df, context, year, labels)
+    failures = []
+    for column, kind in types.items():
+        if column not in df.columns:
+            failures.append(pd.DataFrame({'column': [column], 'value': [None], 'rows': [len(df)]}))
+            continue
+        values = df[column]
+        numbers = pd.to_numeric(values, errors='coerce')
+        bad = values.notna() & numbers.isna()
+        if kind == 'integer':
+            bad |= numbers.notna() & (numbers % 1 != 0)
+        if bad.any():
+            counts = values[bad].astype(str).value_counts().rename('rows').rename_axis('value').reset_index()
+            counts.insert(0, 'column', column)
+            failures.append(counts)
+    return pd.concat(failures, ignore_index=True) if failures else pd.DataFrame()
+
+
+def check_fiscal_year(df, context, column, labels=False, first_year=2000):
+    """labels=True for columns like '2021-22 Adopted Budget', rather than the year itself."""
+    if column not in df.columns:
+        return pd.DataFrame({'problem': [f'no {column} column']})
+    years = fiscal_year_of(df[column]) if labels else pd.to_numeric(df[column], errors='coerce')
+    current = context.get('fiscal_year') or (int(years.max()) if years.notna().any() else None)
+    bad = years.isna() | (years < first_year) | (years > (current or 0) + 1) | (years % 1 != 0)
+    failures = df.loc[bad.to_numpy(), [column]].astype(str).value_counts().rename('rows').reset_index()
+    if context.get('fiscal_year') is not None and not (years == context['fiscal_year']).any():
+        failures = pd.concat([failures, pd.DataFrame({'problem': [f"no rows for fiscal year {context['fiscal_year']}"]})],
+                             ignore_index=True)
+    return failures
+
+
+def check_section_totals(df, context, amount='amount', fund_type='fund_type', total='total', tolerance=1,
+                         grand_total='All Receipts'):
+    # one set of sections per budget, if the frame holds several
+    budget = df['budget'] if 'budget' in df.columns else pd.Series('', index=df.index)
+    is_total = df[total] if df[total].dtype == bool else df[total].astype(str).str.lower().isin(['true', '1'])
+    amounts = pd.to_numeric(df[amount], errors='coerce').fillna(0)
+    frame = pd.DataFrame({'budget': budget, 'fund_type': df[fund_type], 'amount': amounts, 'total': is_total})
+    totals, lines = frame[frame['total']], frame[~frame['total']]
+
+    # every section against its total line, then the sections against the grand total
+    summed = lines.groupby(['budget', 'fund_type'], sort=False)['amount'].sum()
+    stated = totals[totals['fund_type'] != grand_total].groupby(['budget', 'fund_type'], sort=False)['amount'].sum()
+    sections = pd.concat([summed.rename('sum'), stated.rename('total')], axis=1)
+    grand = pd.concat([stated.groupby(level='budget').sum().rename('sum'),
+                       totals[totals['fund_type'] == grand_total].groupby('budget')['amount'].sum().rename('total')], axis=1)
+    grand.index = pd.MultiIndex.from_arrays([grand.index, [grand_total] * len(grand)], names=['budget', 'fund_type'])
+
+    checked = pd.concat([sections, grand]).fillna(0).reset_index()
+    checked['difference'] = checked['sum'] - checked['total']
+    return checked[checked['difference'].abs() > tolerance]
+
+
+def check_year_over_year(df, context, key, value, year, labels=False, threshold=0.5, min_amount=1_000_000):
+    """Totals per key of the latest (or the given) fiscal year against the previous fiscal year."""
+    years = fiscal_year_of(df[year]) if labels else pd.to_numeric(df[year], errors='coerce')
+    amounts = pd.to_numeric(df[value], errors='coerce').fillna(0)
+    totals = amounts.groupby([df[c] for c in key] + [years.rename('_year')], dropna=False).sum()
+    totals = totals.unstack('_year')
+    if totals.shape[1] < 2:
+        return pd.DataFrame()
+    current = context.get('fiscal_year') or totals.columns.max()
+    earlier = [y for y in totals.columns if y < current]
+    if current not in totals.columns or not earlier:
+        return pd.DataFrame()
+    now, before = totals[current], totals[max(earlier)]
+    both = now.notna() & before.notna() & ((now.abs() >= min_amount) | (before.abs() >= min_amount))
+    change = (now - before) / before.abs().replace(0, np.nan)
+    swings = both & (change.abs() > threshold)
+    return pd.DataFrame({'previous': before[swings], 'current': now[swings], 'change': change[swings].round(3)}).reset_index()
+
+
+checks = {
+    'columns': check_columns,
+    'not_null': check_not_null,
+    'unique': check_unique,
+    'dtypes': check_dtypes,
+    'fiscal_year': check_fiscal_year,
+    'section_totals': check_section_totals,
+    'year_over_year': check_year_over_year,
+}
+
+def _examples(failures):
+    # the first few failing rows, as JSON-friendly records
+    head = failures.head(max_examples).astype(object)
+    return head.where(head.notna(), None).to_dict(orient='records')
+
+
+def validate(df, dataset, fiscal_year=None):
+    """Run the rules of dataset on df and return the report (a dict)."""
+    start = time.perf_counter()
+    context = {'fiscal_year': int(fiscal_year) if fiscal_year is not None else None}
+    results = []
+    for rule in rules[dataset]:
+        params = {k: v for k, v in rule.items() if k not in ('check', 'severity')}
+        check_start = time.perf_counter()
+        failures = checks[rule['check']](df, context, **params)
+        results.append({
+            'check': rule['check'],
+            'severity': rule.get('severity', 'error'),
+            'passed': len(failures) == 0,
+            'failures': int(len(failures)),
+            'examples': _examples(failures),
+            'seconds': round(time.perf_counter() - check_start, 4),
+        })
+    failed = [r for r in results if not r['passed']]
+    return {
+        'dataset': dataset,
+        'rows': int(len(df)),
+        'fiscal_year': context['fiscal_year'],
+        'passed': not any(r['severity'] == 'error' for r in failed),
+        'errors': sum(r['severity'] == 'error' for r in failed),
+        'warnings': sum(r['severity'] == 'warning' for r in failed),
+        'seconds': round(time.perf_counter() - start, 4),
+        'checks': results,
+    }
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+
+def gate(df, dataset, fiscal_year=None, report_path=None):
+    """
+    Validate df and print a summary; raises QualityError if a check with severity 'error' fails.
+    The report is written to report_path (JSON), if given, whether or not the checks pass.
+    """
+    report = validate(df, dataset, fiscal_year)
+    if report_path:
+        write_report(report, report_path)
+    for result in report['checks']:
+        if not result['passed']:
+            print(f"  {dataset}: {result['check']} {result['severity']}: {result['failures']} failing, "
+                  f"e.g. {result['examples'][:2]}")
+    print(f"data quality {dataset}: {report['errors']} errors, {report['warnings']} warnings "
+          f"({report['rows']:,} rows, {report['seconds']:.2f}s)")
+    if not report['passed']:
+        failed = [r['check'] for r in report['checks'] if not r['passed'] and r['severity'] == 'error']
+        raise QualityError(f'{dataset} failed the data quality checks {failed}'
+                           + (f'; see {report_path}' if report_path else ''), report)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check a csv file against the data quality rules of a dataset.')
+    parser.add_argument('dataset', choices=sorted(rules))
+    parser.add_argument('filename')
+    parser.add_argument('--fiscal-year', type=int, help='the fiscal year being added (e.g. 2022)')
+    parser.add_argument('--report', help='where to write the JSON report (default: next to the file)')
+    args = parser.parse_args(argv)
+    df = pd.read_csv(args.filename, dtype=str)
+    report_path = args.report or os.path.splitext(args.filename)[0] + '_quality.json'
+    try:
+        gate(df, args.dataset, args.fiscal_year, report_path)
+    except QualityError as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
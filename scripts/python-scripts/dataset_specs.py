@@ -0,0 +1,202 @@
+# dataset_specs.py
+# declarative specs for reading the yearly budget files, and the engine that applies them
+#
+# The scripts used to read each full csv, rename the columns with a hand-written dict, add a
+# constant budget/fiscal year column and then subset to the columns they need, with the year's
+# column names (e.g. '2021-22 Adopted') hardcoded. Each dataset is now described by a spec:
+#
+#   columns   source column -> (target column, dtype), in output order
+#   value     target name and dtype of the year's value column, and the patterns its source
+#             column name may follow; the first pattern found in the file's header is used
+#   constants target column -> pattern of a constant value added to every row
+#   dropna    drop the rows where the value column is empty
+#   aliases   (optional) other names a source column had in earlier years -> its name in the spec
+#
+# Patterns are filled in with fiscal_year_fields(), e.g. '{fy} {stage}' -> '2021-22 Adopted', and
+# matched regardless of case. read_dataset() reads only the columns in the spec, with explicit
+# dtypes, and applies the whole mapping in one pass. Older years only exist as Excel workbooks
+# (.xls/.xlsx); those are read through the conversion cache in excel_cache.py.
+
+import pandas as pd
+
+import excel_cache
+
+# dtypes used in the specs. 'code' columns are read as text and have leading zeros removed from
+# purely numeric codes ('0201' -> '201'), the way they are stored on Socrata
+code = 'code'
+text = 'str'
+amount = 'float64'
+
+specs = {
+    'expenses': {
+        'columns': {
+            'Dept Code': ('dept_code', code),
+            'Dept Name': ('department_name', text),
+            'Org Level 5 Code': ('subdept_code', code),
+            'Org Level 5 Name': ('subdepartment_name', text),
+            'Prog Code': ('prog_code', code),
+            'Prog Name': ('program_name', text),
+            'Source Fund Code': ('source_fund_code', code),
+            'Source Fund Name': ('source_fund_name', text),
+            'Account Code': ('account_code', code),
+            'Account Name': ('account_name', text),
+        },
+        'value': ('appropriation', amount, ['{fy} {stage}', '{fy} {stage} Budget']),
+        'constants': {},
+        'dropna': True,
+    },
+    'gfrev': {
+        'columns': {
+            'Dept Code': ('dept_code', code),
+            'Dept Name': ('department_name', text),
+            'Prog Code': ('program_code', code),
+            'Prog Name': ('program_name', text),
+            'Fund Code': ('fund_code', code),
+            'Fund Name': ('fund_name', text),
+            'Account Code': ('account_code', code),
+            'Account Name': ('account_name', text),
+        },
+        'value': ('revenue', amount, ['{fy} {stage}', '{fy} {stage} Budget']),
+        'constants': {'fiscal_year': '{fy_underscore}_{stage_lower}'},
+        'dropna': True,
+    },
+    'positions': {
+        'columns': {
+            'Dept Code': ('department_code', code),
+            'Dept Name': ('department_name', text),
+            'Prog Code': ('program_code', code),
+            'Prog Name': ('program_name', text),
+            'Fund Code': ('fund_code', code),
+            'Source Fund Code': ('source_fund_code', code),
+            'Source Fund Name': ('source_fund_name', text),
+            'Account Code': ('account_code', code),
+            'Account Name': ('account_name', text),
+        },
+        'value': ('positions', amount, ['{fy} {stage}', '{fy} {stage} Budget']),
+        'constants': {'budget': '{fy_long} {stage} Budget'},
+        'dropna': False,
+    },
+    'inc': {
+        'columns': {
+            'Department Code': ('department_code', code),
+            'Department Name': ('department_name', text),
+            'Program Code': ('program_code', code),
+            'Program Name': ('program_name', text),
+            'Fund Code': ('fund_code', code),
+            'Fund Name': ('fund_name', text),
+            'Source Fund Code': ('source_fund_code', code),
+            'Source Fund Name': ('source_fund_name', text),
+            'Budget Request Description': ('budget_request_description', text),
+            'Budget Request Category': ('budget_request_category', text),
+            'Budget Object Code': ('account_code', code),
+            'Audit Budget Object Name': ('account_name', text),
+            'One Time/ On-going': ('one_time_ongoing', text),
+        },
+        'value': ('incremental_change', amount, [
+            '{fy} ({stage}) Incremental change from {prev_fy} Adopted Budget',
+            '{fy} {stage} Incremental change from {prev_fy} Adopted Budget',
+            '{fy} Incremental change from {prev_fy} Adopted Budget',
+        ]),
+        'constants': {'budget': '{fy} {stage} Budget Incremental Change from {prev_fy} Adopted'},
+        'dropna': False,
+        # the FY17-18 Sec4 files still used the old account column names
+        'aliases': {'Account': 'Budget Object Code', 'Account Name': 'Audit Budget Object Name'},
+    },
+    'pm': {
+        'columns': {
+            'Dept Code': ('department_code', code),
+            'Department Name': ('department_name', text),
+            'Org Level 5 Code': ('subdept_code', code),
+            'Org Level 5 Name': ('subdept_name', text),
+            'Prog Code': ('program_code', code),
+            'Program Name': ('program_name', text),
+            'PM Code': ('performance_measure_code', text),
+            'Performance Measure Name': ('performance_measure_name', text),
+            'Unit/Value': ('unit', text),
+        },
+        'value': ('performance_measure_amount', amount, ['{fy} {stage}', '{fy} {stage} Budget']),
+        'constants': {'budget': '{fy} {stage}'},
+        'dropna': False,
+    },
+}
+
+
+def fiscal_year_fields(fiscal_year, stage='Adopted'):
+    """
+    The fields the patterns can use, for the fiscal year ending in fiscal_year, e.g. for 2022:
+    fy='2021-22', prev_fy='2020-21', fy_long='2021-2022', fy_underscore='2021_22', stage='Adopted',
+    stage_lower='adopted'.
+    """
+    fiscal_year = int(fiscal_year)
+    start = fiscal_year - 1
+    return {
+        'fy': f'{start}-{str(fiscal_year)[2:]}',
+        'prev_fy': f'{start - 1}-{str(start)[2:]}',
+        'fy_long': f'{start}-{fiscal_year}',
+        'fy_underscore': f'{start}_{str(fiscal_year)[2:]}',
+        'stage': stage,
+        'stage_lower': stage.lower(),
+    }
+
+
+def value_column(spec, header, fields):
+    """The source column holding the year's values: the first pattern of the spec found in header."""
+    candidates = [pattern.format(**fields) for pattern in spec['value'][2]]
+    columns = {str(column).lower(): column for column in header}
+    for candidate in candidates:
+        if candidate.lower() in columns:
+            return columns[candidate.lower()]
+    raise KeyError(f'none of the expected value columns {candidates} is in the file; columns are {list(header)}')
+
+
+def normalize_codes(codes):
+    # numeric codes lose their leading zeros ('02' -> '2'); codes like '16A' or '02LVL5' are kept
+    digits = codes.str.fullmatch(r'\d+', na=False)
+    return codes.where(~digits, codes.str.lstrip('0').replace('', '0'))
+
+
+def is_excel(filename):
+    return filename.lower().endswith(('.xls', '.xlsx'))
+
+
+def read_table(filename, usecols=None, dtype=None, nrows=None):
+    """Read a csv export or the first sheet of an Excel workbook."""
+    if is_excel(filename):
+        return excel_cache.read_excel(filename, usecols=usecols, dtype=dtype, nrows=nrows)
+    return pd.read_csv(filename, usecols=usecols, dtype=dtype, nrows=nrows, encoding='utf-8-sig')
+
+
+def read_dataset(name, filename, fiscal_year, stage='Adopted'):
+    """Read one yearly file according to its spec and return the renamed, typed frame."""
+    spec = specs[name]
+    fields = fiscal_year_fields(fiscal_year, stage)
+
+    # the header alone tells which value column to read, and which columns go by an older name
+    header = read_table(filename, nrows=0).columns
+    source_value = value_column(spec, header, fields)
+    target_value, value_dtype, _ = spec['value']
+    aliases = {old: new for old, new in spec.get('aliases', {}).items() if old in header and new not in header}
+    sources = {new: old for old, new in aliases.items()}
+
+    columns = {sources.get(source, source): target for source, (target, _) in spec['columns'].items()}
+    columns[source_value] = target_value
+    dtypes = {sources.get(source, source): (str if dtype in (code, text) else dtype)
+              for source, (_, dtype) in spec['columns'].items()}
+    dtypes[source_value] = value_dtype
+
+    df = read_table(filename, usecols=list(columns), dtype=dtypes)
+
+    # rename, put the columns in spec order, and clean up the codes
+    df = df[list(columns)]
+    df.columns = list(columns.values())
+    for source, (target, dtype) in spec['columns'].items():
+        if dtype == code:
+            df[target] = normalize_codes(df[target])
+
+    if spec['dropna']:
+        df = df.dropna(how='all', subset=[target_value])
+
+    for column, pattern in spec['constants'].items():
+        df[column] = pattern.format(**fields)
+
+    return df
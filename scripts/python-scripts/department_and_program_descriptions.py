@@ -2,6 +2,9 @@
 # update the department and program descriptions on Socrata
 # written by Adam Scherling, June 12, 2018
 # edited/updated Irene Tang, July 2021
+#
+# run() is the whole pipeline for one fiscal year; `python3 department_and_program_descriptions.py`
+# runs it for the default year (see budget_config.py)
 
 ###################
 # Setup
@@ -10,156 +13,162 @@
 # make sure to install these packages before running:
 # pip install pandas
 # pip install sodapy
+# pip install pyarrow
 
 import datetime
 import pandas as pd
-import credentials
-from sodapy import Socrata
+from budget_config import BudgetYear, datasets, default_data_root, default_fiscal_year, default_stage, socrata_client, \
+    socrata_dtypes
+from snapshot_cache import cached_fetch
+from socrata_sync import drop_system_fields
+from priority_outcomes import extract_priorities
+from priority_index import load_index, save_index, update_index, descriptions_precedence
+from description_index import add_year, year_documents
+from tracing import Tracer
 
 # url for the dataset
 socrata_url = 'https://data.lacity.org/A-Well-Run-City/LA-City-Department-and-Program-Descriptions/cd49-p4un'
 
 # Identifier for the dataset
-socrata_identifier = 'cd49-p4un'
+socrata_identifier = datasets['descriptions']['identifier']
 
 # API endpoint for the dataset
 socrata_endpoint = 'https://data.lacity.org/resource/cd49-p4un.json'
 
-# filenames
-filepath_prefix = '../../data/approved_budget/FY21-22/'
-filenames = {
-    'departments': '../../data/approved_budget/FY21-22/QRY_Department_Name_Text_2122_Adopted.csv',
-    'programs': '../../data/approved_budget/FY21-22/QRY_Program_Description_Text_2122_Adopted.csv',
-}
-
-# set up Socrata client
-client = Socrata('data.lacity.org', None)
 
-# uncomment if you are going to log in / push to the data portal
-# username = credentials.lahub_user
-# password = credentials.lahub_pass
-# apptoken = credentials.lahub_auth
-# client = Socrata('data.lacity.org', apptoken, username=username, password=password)
+def run(fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage, client=None,
+        chrome_trace=False):
+    """
+    Build new_descriptions.csv, new_annotations.csv and new_program_priorities.csv for the fiscal
+    year from the year's department and program description files; returns the new descriptions.
+
+    The year's descriptions are also added to the search index of every year seen
+    (description_index/ in the data root, see description_index.py).
 
-timestamp = datetime.datetime.now()
+    client is a sodapy client (a public one by default). The stages are traced to
+    trace_descriptions_<time>.json in the year's folder (see tracing.py).
+    """
+    # filenames
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    filepath_prefix = budget.folder
+    filenames = {
+        'departments': budget.input_file('departments'),
+        'programs': budget.input_file('programs'),
+    }
+    index_path = budget.data_file('program_priority_index.csv')
 
-####################
-## Read in existing data
-####################
+    client = client or socrata_client()
+    timestamp = datetime.datetime.now()
+    tracer = Tracer('descriptions')
 
-# Read the previous dataset from Socrata and save a local copy
-old_descriptions = pd.DataFrame.from_records(client.get(socrata_identifier, limit=99999999999999))
-old_descriptions.to_csv(f'{filepath_prefix}old_descriptions_{timestamp}.csv', index=False)
+    ####################
+    ## Read in existing data
+    ####################
+
+    # Read the previous dataset from Socrata and save a local copy
+    tracer.begin('fetch socrata')
+    socrata_descriptions = cached_fetch(client, socrata_identifier, cache_dir=budget.data_file('.socrata_cache/'),
+                                        exclude_system_fields=False, dtypes=socrata_dtypes[socrata_identifier])
+    old_descriptions = drop_system_fields(socrata_descriptions)
+    old_descriptions.to_csv(f'{filepath_prefix}old_descriptions_{timestamp}.csv', index=False)
+    tracer.end(rows_out=old_descriptions)
 
-####################
-## Read in new program data
-####################
+    ####################
+    ## Read in new program data
+    ####################
 
-# read in the new programs
-new_programs = pd.read_csv(filenames.get('programs'))
+    # read in the new programs
+    tracer.begin('read programs')
+    new_programs = pd.read_csv(filenames.get('programs'))
 
-# rename the columns to match the Socrata dataset
-new_programs.columns = ['program_number', 'entity_name', 'description']
+    # rename the columns to match the Socrata dataset
+    new_programs.columns = ['program_number', 'entity_name', 'description']
 
-# drop the row if the whole row is empty
-new_programs.dropna(how='all', inplace=True)
+    # drop the row if the whole row is empty
+    new_programs.dropna(how='all', inplace=True)
 
+    # add an entity type column
+    new_programs['entity_type'] = 'Program'
+    tracer.end(rows_out=new_programs)
 
-# add an entity type column
-new_programs['entity_type'] = 'Program'
+    ####################
+    ## Handle priority outcomes
+    ####################
 
+    # many of the programs have a priority outcome in the description. these should be removed from the descriptions, but saved in a separate file that can be used to label the priority of programs in the expenses data
 
-####################
-## Handle priority outcomes
-####################
+    # the priority outcome is split off every description in one vectorized pass (see priority_outcomes.py)
+    tracer.begin('priority outcomes', rows_in=new_programs)
+    new_programs, program_priority_df = extract_priorities(new_programs)
 
-# many of the programs have a priority outcome in the description. these should be removed from the descriptions, but saved in a separate file that can be used to label the priority of programs in the expenses data
+    # write the program priorities to csv
+    program_priority_df = program_priority_df[['program_number', 'program_name', 'program_priority']]
+    program_priority_df.to_csv(f'{filepath_prefix}new_program_priorities.csv', index=False)
 
-# first, convert any NA descriptions to blank strings
-new_programs['description'] = new_programs['description'].fillna('')
+    # add the new priorities to the program priority index used by expenses.py
+    priority_index = update_index(load_index(index_path), program_priority_df.rename(columns={'program_number': 'prog_code'}),
+                                  f'{filepath_prefix}new_program_priorities.csv', descriptions_precedence)
+    save_index(priority_index, index_path)
+    tracer.end(rows_out=program_priority_df)
 
-# now loop over all the descriptions and separate out the program priorities
-program_priority = []
-new_desc = ''
-for i, old_desc in enumerate(new_programs.description):
-    new_desc = ''
-    old_desc = old_desc.strip()
-    # if a program priority is given
-    if ('Priority Outcome:' in old_desc[:18]) or ('Priority Outcomes:' in old_desc[:18]):
-        end_priority_name = old_desc.find('\r')
-        begin_priority_name = old_desc.find(':') + 1
+    # remove the program number from the new_programs data frame - no longer needed (except by the search index)
+    indexed_programs = new_programs[['program_number', 'entity_name', 'description']]
+    new_programs.drop(columns=['program_number'], inplace=True)
 
-        priority = old_desc[begin_priority_name:end_priority_name].strip()
-        new_desc = old_desc[end_priority_name:].strip()
-    # else if not given
-    else:
-        priority = 'NA'
-    program_priority.append(priority)
-    new_programs.description[i] = new_desc
+    ####################
+    ## Read in the new department data
+    ####################
 
-# convert program priorities to language used in the expenses data
-for i, old_priority in enumerate(program_priority):
-    new_priority = ''
-    if('livable' in old_priority):
-        new_priority = 'A Livable and Sustainable City'
-    elif('best' in old_priority):
-        new_priority = 'A Well Run City'
-    elif('jobs' in old_priority):
-        new_priority = 'A Prosperous City'
-    elif('safe' in old_priority):
-        new_priority = 'A Safe City'
-    program_priority[i] = new_priority
+    # read in the new department descriptions (don't want the first column)
+    tracer.begin('read departments and combine')
+    department_file = pd.read_csv(filenames.get('departments'))
+    new_departments = department_file.iloc[:, 1:]
 
-# create a data frame of the program priorities and write to csv
-program_priority_df = pd.DataFrame({
-    'program_number' : new_programs.program_number.astype('Int64'),
-    'program_name' : new_programs.entity_name,
-    'program_priority' : program_priority,
-})
-program_priority_df.to_csv(f'{filepath_prefix}new_program_priorities.csv', index=False)
+    # drop the row if the whole row is empty
+    new_departments.dropna(how='all', inplace=True)
 
-# remove the program number from the new_programs data frame - no longer needed
-new_programs.drop(columns=['program_number'], inplace=True)
+    # add an entity type column
+    new_departments['entity_type'] = 'Department'
 
-####################
-## Read in the new department data 
-####################
+    # rename the columns to match the Socrata dataset
+    new_departments.columns = new_programs.columns
 
-# read in the new department descriptions (don't want the first column)
-new_departments = pd.read_csv(filenames.get('departments')).iloc[:, 1:]
+    # combine the two files
+    new_descriptions = pd.concat([new_departments, new_programs], axis=0)
+
+    # rearrange the columns
+    new_descriptions = new_descriptions[old_descriptions.columns]
+    tracer.end(rows_out=new_descriptions)
+
+    ####################
+    ## Save data
+    ####################
+
+    # write to csv
+    with tracer.stage('write csv', rows_in=new_descriptions):
+        new_descriptions.to_csv(budget.output_file('descriptions'), index=False)
+
+    # upload the data to Socrata with `python3 labudget.py publish descriptions`, which pushes only the
+    # inserted, changed and deleted rows (see publish.py), or replace the whole dataset:
+    # client.replace(socrata_identifier, new_descriptions)
 
-# drop the row if the whole row is empty
-new_departments.dropna(how='all', inplace=True)
+    # reformat for uploading as annotations on the open budget site
+    annotations = new_descriptions.copy()
+    annotations['entity_type'] = annotations['entity_type'].replace(['Program', 'Department'], ['program_name', 'department_name'])
+    annotations.columns = ['column', 'entity', 'text']
 
+    # write to csv
+    with tracer.stage('write annotations', rows_in=annotations):
+        annotations.to_csv(f'{filepath_prefix}new_annotations.csv', index=False)
 
-# add an entity type column
-new_departments['entity_type'] = 'Department'
+    # add the year's descriptions to the search index, with their department and program codes
+    with tracer.stage('search index', rows_in=new_descriptions):
+        add_year(year_documents(department_file, indexed_programs, fiscal_year, stage),
+                 budget.data_file('description_index/'))
 
-# rename the columns to match the Socrata dataset
-new_departments.columns = new_programs.columns
+    tracer.finish(filepath_prefix, chrome=chrome_trace)
+    return new_descriptions
 
-# combine the two files
-new_descriptions = pd.concat([new_departments, new_programs], axis=0)
 
-# rearrange the columns
-new_descriptions = new_descriptions[old_descriptions.columns]
-
-
-####################
-## Save data
-####################
-
-# write to csv
-new_descriptions.to_csv(f'{filepath_prefix}new_descriptions.csv', index=False)
-
-# upload the data to Socrata
-# client.replace(socrata_identifier, new_descriptions)
-
-
-
-# reformat for uploading as annotations on the open budget site
-new_descriptions['entity_type'] = new_descriptions['entity_type'].replace(['Program', 'Department'], ['program_name', 'department_name'])
-new_descriptions.columns = ['column', 'entity', 'text']
-
-# write to csv
-new_descriptions.to_csv(f'{filepath_prefix}new_annotations.csv', index=False)
+if __name__ == '__main__':
+    run()
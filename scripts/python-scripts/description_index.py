@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# description_index.py
+# full-text search over the department and program descriptions of every fiscal year
+#
+# department_and_program_descriptions.py adds the year's descriptions to documents.csv in the
+# index folder (one row per fiscal year, stage, department or program, with its dept_code and
+# prog_code in the form of the appropriations dataset) and rebuilds the index from it. The text
+# of a document is its name (counted twice, so a match on the name ranks first) and description,
+# split into lowercase words, without stop words, and stemmed (so 'services', 'serviced' and
+# 'service' are the same term, and so are 'plan', 'plans', 'planned' and 'planning').
+#
+# The index is one binary file, read with np.memmap, so opening it only reads its header:
+#
+#   terms      the sorted terms, as fixed-width bytes (looked up with a binary search)
+#   offsets    where the postings of each term start
+#   postings   document of each posting, and its BM25 score for the term (k1=1.2, b=0.75),
+#              computed when the index is built
+#   documents  fiscal year and entity type of each document, for filtering
+#
+# A query adds up the scores of the postings of its terms, so it only reads those postings.
+# The hits carry dept_code and prog_code for joining with the appropriations.
+#
+# Usage (from scripts/python-scripts):
+#   python3 description_index.py "senior nutrition" --fiscal-year 2022 --type Program
+#   python3 description_index.py --rebuild      # index the description files of every year under data/
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from budget_config import BudgetYear, default_data_root, stage_folders
+from priority_index import normalize_codes
+from priority_outcomes import split_priorities
+
+# relative to scripts/python-scripts
+default_index_dir = '../../data/description_index/'
+
+document_columns = ['fiscal_year', 'stage', 'entity_type', 'dept_code', 'prog_code', 'entity_name', 'description']
+entity_types = ['Department', 'Program']
+
+# BM25 parameters
+k1 = 1.2
+b = 0.75
+
+# the version changes whenever the terms do (e.g. a change to stem()), so an older index is rebuilt
+magic = b'LADESCIX2\n'
+
+stop_words = frozenset('''
+a about all also an and any are as at be been by for from has have in into is it its of on or other
+such that the their these this those through to was which with within will
+'''.split())
+
+# suffixes removed by stem(), longest first; the stem keeps at least three letters
+_suffixes = [
+    ('ational', 'ate'), ('ization', 'ize'), ('fulness', 'ful'), ('iveness', 'ive'), ('ousness', 'ous'),
+    ('tional', 'tion'), ('ements', ''), ('ement', ''), ('ments', ''), ('ities', ''), ('ness', ''),
+    ('ment', ''), ('ings', ''), ('ies', 'y'), ('ity', ''), ('ing', ''), ('ers', ''), ('ed', ''),
+    ('es', ''), ('er', ''), ('ly', ''), ('s', ''), ('e', ''),
+]
+
+_word = re.compile(r'[^\W_]+')
+
+
+def _undouble(word):
+    # 'plann' -> 'plan', but 'staff' -> 'staf' too, so a word and its inflections agree; ll, ss and zz are kept
+    if len(word) > 2 and word[-1] == word[-2] and word[-1] not in 'aeioulsz':
+        return word[:-1]
+    return word
+
+
+def stem(word):
+    """
+    A light suffix-stripping stemmer: 'services' -> 'servic', 'planning' -> 'plan'. A word and its
+    inflections give the same term:
+
+    >>> {stem(w) for w in ['plan', 'plans', 'planned', 'planning', 'planner']}
+    {'plan'}
+    >>> {stem(w) for w in ['run', 'runs', 'running', 'runner']}
+    {'run'}
+    >>> {stem(w) for w in ['staff', 'staffs', 'staffed', 'staffing']}
+    {'staf'}
+    >>> {stem(w) for w in ['service', 'services', 'serviced', 'servicing']}
+    {'servic'}
+    >>> {stem(w) for w in ['add', 'adds', 'added', 'adding']}
+    {'ad'}
+    >>> sorted({stem(w) for w in ['class', 'classes', 'fall', 'falling']})
+    ['class', 'fall']
+    """
+    if word.isdigit():
+        return word
+    if len(word) <= 3:
+        return _undouble(word)
+    for suffix, replacement in _suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) + len(replacement) >= 3:
+            if suffix == 's' and word.endswith('ss'):
+                return word
+            return _undouble(word[:-len(suffix)] + replacement)
+    return _undouble(word)
+
+
+def tokenize(text):
+    """The terms of a text, in order."""
+    return [stem(word) for word in _word.findall(str(text).lower()) if word not in stop_words]
+
+
+####################
+## Documents
+####################
+
+def year_documents(departments, programs, fiscal_year, stage):
+    """
+    The documents of one year from its department and program description files (as read with
+    pd.read_csv: number, name, description). The priority outcomes are removed from the program
+    descriptions.
+    """
+    departments = departments.iloc[:, :3].set_axis(['number', 'entity_name', 'description'], axis=1)
+    programs = programs.iloc[:, :3].set_axis(['number', 'entity_name', 'description'], axis=1)
+    program_numbers = normalize_codes(programs['number'])
+    # a program number is its department's number followed by two digits
+    program_departments = program_numbers.str[:-2].where(program_numbers.str.fullmatch(r'\d{3,}'), '')
+    documents = pd.concat([
+        pd.DataFrame({'entity_type': 'Department', 'dept_code': normalize_codes(departments['number']), 'prog_code': '',
+                      'entity_name': departments['entity_name'], 'description': departments['description']}),
+        pd.DataFrame({'entity_type': 'Program', 'dept_code': program_departments, 'prog_code': program_numbers,
+                      'entity_name': programs['entity_name'], 'description': split_priorities(programs['description'])[0]}),
+    ], ignore_index=True)
+    documents = documents.dropna(subset=['entity_name'])
+    documents['description'] = documents['description'].fillna('')
+    documents.insert(0, 'stage', stage)
+    documents.insert(0, 'fiscal_year', int(fiscal_year))
+    return documents[document_columns]
+
+
+def load_documents(index_dir=default_index_dir):
+    """The documents of every year indexed so far (empty if none)."""
+    path = os.path.join(index_dir, 'documents.csv')
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=document_columns)
+    return pd.read_csv(path, dtype=str, keep_default_na=False).astype({'fiscal_year': int})
+
+
+def add_documents(documents, new):
+    """documents with the years and stages of new replaced by new."""
+    years = set(zip(new['fiscal_year'], new['stage']))
+    keep = [(year, stage) not in years for year, stage in zip(documents['fiscal_year'], documents['stage'])]
+    combined = pd.concat([documents[keep], new], ignore_index=True)
+    return combined.sort_values(['fiscal_year', 'stage', 'entity_type'], kind='stable').reset_index(drop=True)
+
+
+####################
+## Index file
+####################
+
+def _arrays(documents):
+    # the arrays of the index file
+    doc_terms = [tokenize(f'{name} {name} {text}') for name, text in zip(documents['entity_name'], documents['description'])]
+    lengths = np.array([len(terms) for terms in doc_terms], dtype=np.float64)
+    average_length = lengths.mean() if len(lengths) and lengths.mean() else 1.0
+
+    # one (term, document, frequency) row per distinct term of each document
+    pairs = pd.DataFrame({
+        'term': [term for terms in doc_terms for term in terms],
+        'document': np.repeat(np.arange(len(doc_terms), dtype=np.int32), lengths.astype(int)),
+    })
+    counts = pairs.groupby(['term', 'document']).size().reset_index(name='tf')
+    terms, term_ids = np.unique(np.array([term.encode() for term in counts['term']], dtype=bytes).astype('S'),
+                                return_inverse=True)
+    # the postings of each term together, in the (byte) order of the terms
+    order = np.argsort(term_ids, kind='stable')
+    counts, term_ids = counts.iloc[order], term_ids[order]
+    df = np.bincount(term_ids, minlength=len(terms))
+    idf = np.log(1 + (len(doc_terms) - df + 0.5) / (df + 0.5))
+    tf = counts['tf'].to_numpy(dtype=np.float64)
+    norm = k1 * (1 - b + b * lengths[counts['document'].to_numpy()] / average_length)
+    scores = idf[term_ids] * tf * (k1 + 1) / (tf + norm)
+
+    return {
+        'terms': terms.astype(f'S{max(terms.dtype.itemsize, 1)}'),
+        'offsets': np.concatenate([[0], np.cumsum(df)]).astype(np.int64),
+        'posting_documents': counts['document'].to_numpy(dtype=np.int32),
+        'posting_scores': scores.astype(np.float32),
+        'fiscal_years': documents['fiscal_year'].to_numpy(dtype=np.int32),
+        'entity_types': np.array([entity_types.index(t) for t in documents['entity_type']], dtype=np.int8),
+    }
+
+
+def write_index(documents, index_dir=default_index_dir):
+    """Write documents.csv and the index file built from it (atomically)."""
+    os.makedirs(index_dir, exist_ok=True)
+    documents = documents.reset_index(drop=True)
+    arrays = _arrays(documents)
+
+    layout, position = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position += -(-array.nbytes // 8) * 8
+    header = json.dumps({
+        'arrays': layout,
+        'documents': {c: documents[c].astype(str).tolist() for c in ['stage', 'dept_code', 'prog_code', 'entity_name']},
+    }).encode()
+    start = -(-(len(magic) + 8 + len(header)) // 8) * 8
+
+    path = os.path.join(index_dir, 'descriptions.idx')
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(magic + np.uint64(len(header)).tobytes() + header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + position)
+    os.replace(f'{path}.tmp', path)
+
+    documents.to_csv(os.path.join(index_dir, 'documents.csv.tmp'), index=False)
+    os.replace(os.path.join(index_dir, 'documents.csv.tmp'), os.path.join(index_dir, 'documents.csv'))
+    return path
+
+
+def add_year(new, index_dir=default_index_dir):
+    """Add (or replace) the documents of a year in the index folder and rebuild the index file."""
+    documents = add_documents(load_documents(index_dir), new)
+    write_index(documents, index_dir)
+    return documents
+
+
+####################
+## Queries
+####################
+
+class DescriptionIndex:
+    """A read-only, memory-mapped description index."""
+
+    def __init__(self, index_dir=default_index_dir):
+        self.path = os.path.join(index_dir, 'descriptions.idx')
+        with open(self.path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(f'{self.path} is not a description index of this version; '
+                                 f'rebuild it with `python3 description_index.py --rebuild`')
+            header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_length))
+        start = -(-(len(magic) + 8 + header_length) // 8) * 8
+        self.documents = header['documents']
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if math.prod(shape) == 0:
+                array = np.zeros(shape, dtype=spec['dtype'])
+            else:
+                array = np.memmap(self.path, dtype=spec['dtype'], mode='r', offset=start + spec['offset'], shape=shape)
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.fiscal_years)
+
+    def scores(self, query):
+        """The BM25 score of every document for the query."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            key = term.encode()
+            position = int(np.searchsorted(self.terms, key))
+            if len(key) > self.terms.dtype.itemsize or position == len(self.terms) or self.terms[position] != key:
+                continue
+            first, last = self.offsets[position], self.offsets[position + 1]
+            np.add.at(scores, self.posting_documents[first:last], self.posting_scores[first:last])
+        return scores
+
+    def search(self, query, limit=10, fiscal_year=None, entity_type=None):
+        """
+        The documents matching the query, best first: a DataFrame of fiscal_year, stage,
+        entity_type, dept_code, prog_code, entity_name and score. fiscal_year (a year or a list of
+        years) and entity_type ('Department' or 'Program') restrict the hits.
+        """
+        scores = self.scores(query)
+        if fiscal_year is not None:
+            scores[~np.isin(self.fiscal_years, np.atleast_1d(fiscal_year))] = 0
+        if entity_type is not None:
+            scores[self.entity_types != entity_types.index(entity_type)] = 0
+        hits = np.flatnonzero(scores > 0)
+        if limit is not None and len(hits) > limit:
+            hits = hits[np.argpartition(-scores[hits], limit - 1)[:limit]]
+        hits = hits[np.lexsort((hits, -scores[hits]))]
+        return pd.DataFrame({
+            'fiscal_year': self.fiscal_years[hits].astype(int),
+            'stage': [self.documents['stage'][i] for i in hits],
+            'entity_type': [entity_types[t] for t in self.entity_types[hits]],
+            'dept_code': [self.documents['dept_code'][i] for i in hits],
+            'prog_code': [self.documents['prog_code'][i] for i in hits],
+            'entity_name': [self.documents['entity_name'][i] for i in hits],
+            'score': scores[hits].round(4),
+        })
+
+
+def search(query, index_dir=default_index_dir, **options):
+    """Search the index in index_dir; see DescriptionIndex.search."""
+    return DescriptionIndex(index_dir).search(query, **options)
+
+
+####################
+## Rebuilding from the files on disk
+####################
+
+def description_years(data_root=default_data_root):
+    """(fiscal_year, stage) of every year folder under data_root with both description files."""
+    years = []
+    for stage, folder in stage_folders.items():
+        for name in sorted(os.listdir(os.path.join(data_root, folder))) if os.path.isdir(os.path.join(data_root, folder)) else []:
+            match = re.fullmatch(r'FY\d\d-(\d\d)', name)
+            if match:
+                budget = BudgetYear(2000 + int(match.group(1)), data_root, stage)
+                if os.path.exists(budget.input_file('departments')) and os.path.exists(budget.input_file('programs')):
+                    years.append((budget.fiscal_year, stage))
+    return years
+
+
+def rebuild(data_root=default_data_root, index_dir=default_index_dir):
+    """Index the description files of every year under data_root, from scratch."""
+    documents = pd.DataFrame(columns=document_columns)
+    for fiscal_year, stage in description_years(data_root):
+        budget = BudgetYear(fiscal_year, data_root, stage)
+        new = year_documents(pd.read_csv(budget.input_file('departments'), dtype=str),
+                             pd.read_csv(budget.input_file('programs'), dtype=str), fiscal_year, stage)
+        documents = add_documents(documents, new)
+    write_index(documents, index_dir)
+    return documents
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search the department and program descriptions.')
+    parser.add_argument('query', nargs='?', help='words to search for')
+    parser.add_argument('--fiscal-year', type=int, action='append', help='only this fiscal year (repeatable)')
+    parser.add_argument('--type', choices=entity_types, help='only departments or only programs')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--index-dir', default=default_index_dir)
+    parser.add_argument('--data-root', default=default_data_root)
+    parser.add_argument('--rebuild', action='store_true', help='index the description files of every year first')
+    args = parser.parse_args(argv)
+
+    if args.rebuild:
+        documents = rebuild(args.data_root, args.index_dir)
+        print(f'indexed {len(documents)} descriptions of {documents[["fiscal_year", "stage"]].drop_duplicates().shape[0]} years')
+    if not args.query:
+        return 0
+    if not os.path.exists(os.path.join(args.index_dir, 'descriptions.idx')):
+        raise SystemExit(f'no index in {args.index_dir}; run with --rebuild or run the descriptions pipeline first')
+
+    start = time.perf_counter()
+    hits = search(args.query, args.index_dir, limit=args.limit, fiscal_year=args.fiscal_year, entity_type=args.type)
+    elapsed = time.perf_counter() - start
+    print(hits.to_string(index=False) if len(hits) else 'no matches')
+    print(f'{len(hits)} hits in {elapsed * 1000:.1f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# dimensions.py
+# one shared dictionary encoding of the name columns of every dataset
+#
+# department_name, program_name, source_fund_name, account_name and subdepartment_name repeat on
+# every line item of every dataset and fiscal year. As object columns each row holds a pointer to
+# a Python string, and pd.concat of the old and new data copies them all. A Vocabulary keeps one
+# list of values per dimension (department, subdepartment, program, fund, account), shared by
+# every dataset and pipeline, and encode() turns the name columns into categoricals over it: one
+# int32 code per row, and the same CategoricalDtype for the same dimension in every frame, so
+# concat keeps the codes instead of copying a string per row.
+#
+# The vocabulary only grows: a new value is appended, and the code of every value already in it
+# never changes, so frames encoded earlier are brought up to date (align) without rehashing their
+# values. It is saved to data/dimension_vocabulary.json, so the values of earlier runs keep their
+# codes in the next one. save() locks the file and appends the values it doesn't have yet, so
+# pipelines running in other processes don't undo each other's additions; values first seen in two
+# processes at the same time may have other codes in each than in the file. The codes are never
+# written out (the outputs hold the names), so they only need to agree within a process.
+#
+#   vocabulary = shared_vocabulary()
+#   expenses = vocabulary.concat([new_expenses, old_expenses])    # encoded, then concatenated
+#   vocabulary.save()
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, which locks with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+# relative to scripts/python-scripts
+default_vocabulary_path = '../../data/dimension_vocabulary.json'
+
+# the columns holding the values of each dimension, in any dataset. the fund and the source fund of a
+# line item (both in the incremental changes) are names from the same list of City funds, so they share
+# a dimension and compare as codes
+dimension_columns = {
+    'department': ['department_name', 'dept_name'],
+    'subdepartment': ['subdepartment_name', 'subdept_name'],
+    'program': ['program_name', 'prog_name'],
+    'fund': ['source_fund_name', 'fund_name'],
+    'account': ['account_name'],
+}
+column_dimensions = {column: dimension for dimension, columns in dimension_columns.items() for column in columns}
+
+
+@contextmanager
+def _locked(path):
+    # an exclusive lock on the file at path, held until the block ends
+    with open(path, 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+            return
+        while True:
+            try:
+                # tries for 10 seconds, then raises
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _factorize(column):
+    # local codes (-1 for missing) and the distinct values they point to
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories
+    codes, uniques = pd.factorize(column, use_na_sentinel=True)
+    return codes, pd.Index(uniques.astype(object), dtype=object)
+
+
+class Vocabulary:
+    """The values of every dimension, in the order they were first seen."""
+
+    def __init__(self, values=None, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._values = {dimension: pd.Index([], dtype=object) for dimension in dimension_columns}
+        self._dtypes = {}
+        for dimension, dimension_values in (values or {}).items():
+            self._values[dimension] = pd.Index(list(dict.fromkeys(dimension_values)), dtype=object)
+
+    def __len__(self):
+        return sum(len(values) for values in self._values.values())
+
+    def values(self, dimension):
+        return self._values[dimension]
+
+    def dtype(self, dimension):
+        """The categorical dtype of the dimension, as it is now."""
+        with self._lock:
+            if dimension not in self._dtypes:
+                self._dtypes[dimension] = pd.CategoricalDtype(self._values[dimension], ordered=False)
+            return self._dtypes[dimension]
+
+    def add(self, dimension, values):
+        """Append the values the dimension doesn't have yet (sorted, so the order doesn't depend on the rows)."""
+        values = pd.Index(values, dtype=object).dropna().unique()
+        with self._lock:
+            known = self._values[dimension]
+            new = values[known.get_indexer(values) < 0]
+            if len(new):
+                self._values[dimension] = known.append(pd.Index(sorted(new), dtype=object))
+                self._dtypes.pop(dimension, None)
+            return len(new)
+
+    def encode_column(self, column, dimension):
+        """The column as a categorical over the dimension's vocabulary, adding its new values."""
+        local_codes, uniques = _factorize(column)
+        self.add(dimension, uniques)
+        dtype = self.dtype(dimension)
+        if isinstance(column.dtype, pd.CategoricalDtype) and column.dtype == dtype:
+            return column
+        # the distinct values are looked up once; the rows only go through integer indexing
+        mapping = dtype.categories.get_indexer(uniques).astype(np.int32)
+        codes = np.where(local_codes >= 0, mapping[np.maximum(local_codes, 0)], -1).astype(np.int32)
+        return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=column.index, name=column.name)
+
+    def encode(self, df, columns=None):
+        """A copy of df with its dimension columns (or the given {column: dimension}) encoded."""
+        columns = columns or {c: column_dimensions[c] for c in df.columns if c in column_dimensions}
+        return df.assign(**{column: self.encode_column(df[column], dimension) for column, dimension in columns.items()})
+
+    def align(self, df):
+        """Bring the encoded columns of df up to the current vocabulary (their codes stay valid)."""
+        updated = {}
+        for column in df.columns:
+            dimension = column_dimensions.get(column)
+            if dimension is None or not isinstance(df[column].dtype, pd.CategoricalDtype):
+                continue
+            dtype = self.dtype(dimension)
+            if df[column].dtype != dtype:
+                # the old categories are a prefix of the new ones, unless the column wasn't encoded here
+                if df[column].cat.categories.equals(dtype.categories[:len(df[column].cat.categories)]):
+                    updated[column] = pd.Categorical.from_codes(df[column].cat.codes.to_numpy(), dtype=dtype)
+                else:
+                    updated[column] = self.encode_column(df[column], dimension).array
+        return df.assign(**updated) if updated else df
+
+    def concat(self, frames, **kwargs):
+        """pd.concat of the frames with their dimension columns encoded alike, so they stay categorical."""
+        frames = [self.encode(df) for df in frames]
+        return pd.concat([self.align(df) for df in frames], **kwargs)
+
+    def decode(self, df):
+        """A copy of df with its encoded dimension columns back as plain strings."""
+        return df.assign(**{column: df[column].astype(object) for column in df.columns
+                            if column in column_dimensions and isinstance(df[column].dtype, pd.CategoricalDtype)})
+
+    def save(self, path=None):
+        """
+        Write the vocabulary: the values already in the file (first, in their order), then the new ones.
+        The file is locked from the read to the replace, so saves of other processes wait their turn.
+        """
+        path = path or self.path or default_vocabulary_path
+        with self._lock:
+            current = {dimension: values.tolist() for dimension, values in self._values.items()}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with _locked(f'{path}.lock'):
+            if os.path.exists(path):
+                with open(path) as f:
+                    on_disk = json.load(f)
+                current = {dimension: list(dict.fromkeys(on_disk.get(dimension, []) + values))
+                           for dimension, values in current.items()}
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(current, f, indent=0)
+            os.replace(tmp, path)
+
+
+def load_vocabulary(path=default_vocabulary_path):
+    """The vocabulary saved at path (empty if there is none yet)."""
+    values = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            values = json.load(f)
+    return Vocabulary(values, path)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_vocabulary(path=default_vocabulary_path):
+    """The vocabulary of path, loaded once per process and shared by every pipeline in it."""
+    with _shared_lock:
+        if path not in _shared:
+            _shared[path] = load_vocabulary(path)
+        return _shared[path]
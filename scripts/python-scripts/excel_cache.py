@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# excel_cache.py
+# content-hashed cache of the Excel workbooks under data/, converted to Parquet
+#
+# The older years only exist as Excel (.xls/.xlsx), and parsing a workbook with pandas takes one
+# to two orders of magnitude longer than reading a columnar file. Each workbook is converted
+# once: every sheet is written to a Parquet file named after the SHA-256 of the workbook's
+# content, so a replaced workbook is converted again automatically and a copy of the same
+# workbook elsewhere is never converted twice. Later reads come from the Parquet files.
+#
+# Text columns (which may mix numbers and text, e.g. program codes) are stored as strings, with
+# whole numbers written without a decimal point; numeric columns keep their type.
+#
+# Usage (from scripts/python-scripts), to convert every workbook under data/ up front:
+#   python3 excel_cache.py
+#
+# requires xlrd (.xls), openpyxl (.xlsx) and pyarrow: pip install xlrd openpyxl pyarrow
+
+import glob
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+# where the converted sheets are kept, relative to scripts/python-scripts
+default_cache_dir = '../../data/.excel_cache/'
+
+excel_extensions = ('.xls', '.xlsx')
+
+# content hashes already computed in this process, keyed on (path, size, mtime)
+_hashes = {}
+
+
+def content_hash(filename):
+    """SHA-256 of the file's content, remembered for as long as the file is unchanged."""
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _hashes:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def _manifest_path(cache_dir, digest):
+    return os.path.join(cache_dir, f'{digest}.json')
+
+
+def _sheet_path(cache_dir, digest, position):
+    return os.path.join(cache_dir, f'{digest}_{position}.parquet')
+
+
+def _as_text(series):
+    # mixed number/text cells -> strings; 201.0 -> '201'; blanks stay missing
+    def text(value):
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+    return series.map(text, na_action='ignore').astype('string')
+
+
+def _typed(df):
+    df.columns = [str(column) for column in df.columns]
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = _as_text(df[column])
+    return df
+
+
+def convert(filename, cache_dir=default_cache_dir):
+    """Convert every sheet of a workbook (if not converted yet) and return its manifest."""
+    digest = content_hash(filename)
+    manifest_path = _manifest_path(cache_dir, digest)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    sheets = pd.read_excel(filename, sheet_name=None)
+    os.makedirs(cache_dir, exist_ok=True)
+    for position, df in enumerate(sheets.values()):
+        path = _sheet_path(cache_dir, digest, position)
+        _typed(df).to_parquet(f'{path}.tmp', index=False)
+        os.replace(f'{path}.tmp', path)
+
+    # the manifest is written last, so an interrupted conversion never looks complete
+    manifest = {'source': os.path.basename(filename), 'sheets': list(sheets)}
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    print(f'{filename}: converted {len(sheets)} sheet(s)')
+    return manifest
+
+
+def read_excel(filename, sheet_name=0, usecols=None, dtype=None, nrows=None, cache_dir=default_cache_dir):
+    """
+    Read one sheet of a workbook through the cache; sheet_name is a position or a name.
+
+    usecols, dtype and nrows work like in pandas.read_excel (usecols as a list of column names).
+    dtype str gives the text of the cells, without '.0' on whole numbers.
+    """
+    digest = content_hash(filename)
+    manifest = convert(filename, cache_dir)
+    position = sheet_name if isinstance(sheet_name, int) else manifest['sheets'].index(sheet_name)
+
+    df = pd.read_parquet(_sheet_path(cache_dir, digest, position), columns=usecols)
+    if nrows is not None:
+        df = df.head(nrows)
+    if dtype is not None:
+        if not isinstance(dtype, dict):
+            dtype = {column: dtype for column in df.columns}
+        for column, column_dtype in dtype.items():
+            if column not in df.columns:
+                continue
+            if column_dtype is str:
+                df[column] = _as_text(df[column]).astype(object).where(df[column].notna())
+            else:
+                df[column] = df[column].astype(column_dtype)
+    return df
+
+
+def find_workbooks(data_root='../../data/'):
+    """Every Excel workbook under data_root."""
+    return sorted(filename for filename in glob.glob(os.path.join(data_root, '**', '*'), recursive=True)
+                  if filename.lower().endswith(excel_extensions))
+
+
+def _convert_quietly(filename, cache_dir):
+    try:
+        convert(filename, cache_dir)
+        return None
+    except Exception as e:
+        return f'{filename}: {e}'
+
+
+def convert_all(filenames, cache_dir=default_cache_dir, workers=None):
+    """Convert many workbooks in a process pool; returns the list of failures."""
+    pending = [filename for filename in filenames
+               if not os.path.exists(_manifest_path(cache_dir, content_hash(filename)))]
+    if not pending:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_convert_quietly, pending, [cache_dir] * len(pending))
+        return [failure for failure in results if failure]
+
+
+if __name__ == '__main__':
+    failures = convert_all(find_workbooks())
+    for failure in failures:
+        print(f'failed: {failure}')
+    sys.exit(1 if failures else 0)
@@ -3,6 +3,9 @@
 # prep the expenses data and push to Socrata
 # Adam Scherling April 18, 2018. Updated June 11, 2018
 # Converted/Updated July 2021, Irene Tang
+#
+# run() is the whole pipeline for one fiscal year; `python3 expenses.py` runs it for the default
+# year (see budget_config.py), `python3 labudget.py build expenses --fiscal-year ...` for any year.
 
 
 ####################
@@ -12,12 +15,23 @@
 # make sure to install these packages before running:
 # pip install pandas
 # pip install sodapy
+# pip install pyarrow
 
 import datetime
 import pandas as pd
-import numpy as np
-import credentials
-from sodapy import Socrata
+from budget_config import BudgetYear, datasets, default_data_root, default_fiscal_year, default_stage, socrata_client, \
+    socrata_dtypes
+from snapshot_cache import cached_fetch, cached_chunks
+from socrata_sync import drop_system_fields
+from dataset_specs import read_dataset
+from parquet_store import load as load_dataset, datasets as stored_datasets
+from rollup_cube import update_cube
+from chunked_csv import ChunkedCsvWriter
+from crosswalk import Crosswalk, load_crosswalk
+from data_quality import gate
+from dimensions import shared_vocabulary
+from tracing import Tracer
+from priority_index import load_index, save_index, update_index, assign_priorities, socrata_precedence, descriptions_precedence
 
 # url for the dataset
 socrata_url = 'https://data.lacity.org/A-Prosperous-City/Open-Budget-Appropriations-Fiscal-Years-2010-2019/5242-pnmt'
@@ -26,136 +40,199 @@ socrata_url = 'https://data.lacity.org/A-Prosperous-City/Open-Budget-Appropriati
 socrata_endpoint = 'https://data.lacity.org/resource/5242-pnmt.json'
 
 # Identifier for the dataset
-socrata_identifier = '5242-pnmt'
-
-# set up Socrata client
-client = Socrata('data.lacity.org', None)
-
-# uncomment if you are going to log in / push to the data portal
-# username = credentials.lahub_user
-# password = credentials.lahub_pass
-# apptoken = credentials.lahub_auth
-# client = Socrata('data.lacity.org', apptoken, username=username, password=password)
-
-# get the fiscal year being updated; default to the year after the current date
-timestamp = datetime.datetime.now()
-current_year = timestamp.year
-new_fiscal_year = current_year + 1
-
-####################
-## Read in existing data
-####################
-filepath_prefix = '../../data/approved_budget/FY21-22/'
-
-# read in the existing data on Socrata
-old_expenses = pd.DataFrame.from_records(client.get(socrata_identifier, limit=99999999999999))
-
-# save a copy as a local backup -- especially before pushing the output back to overwrite the existing data on Socrata
-old_expenses.to_csv(
-    f'{filepath_prefix}old_expenses_{timestamp}.csv', index=False)
-
-# filter out any data from the fiscal year that's being updated (only keep the rows where fiscal_year!=new_fiscal_year)
-old_expenses = old_expenses[old_expenses['fiscal_year']!=new_fiscal_year]
-
-####################
-## Read in new data
-####################
-
-# read in the new expenses data. section 2 only
-csv_file = '../../data/approved_budget/FY21-22/Expenditures_Sec2_for_2122_Adopted.csv'
-new_expenses = pd.read_csv(csv_file)
-
-# keep only the desired columns
-# assumes that the last column contains the data of interest (correct fiscal year, proposed/adopted as desired)
-appropriation = new_expenses.columns[-1]  # e.g. '2021-22 Adopted'
-new_expenses = new_expenses[['Dept Code', 'Dept Name', 'Org Level 5 Code', 'Org Level 5 Name', 'Prog Code', 'Prog Name', 'Source Fund Code', 'Source Fund Name', 'Account Code', 'Account Name', appropriation]]
-
-# rename the columns of the new data to match the old data
-# missing columns: Program_Priority, Expense_Type
-new_expenses.columns = ['dept_code', 'department_name', 'subdept_code', 'subdepartment_name', 'prog_code', 'program_name', 'source_fund_code', 'source_fund_name', 'account_code', 'account_name', 'appropriation']
-
-# remove rows with no appropriation data
-new_expenses.dropna(how='all', subset=['appropriation'], inplace=True)
-
-
-
-####################
-## Get Program Priorities
-# assign a category to each expenditure, e.g. A Well Run City, A Safe City
-####################
-
-## first, an attempt is made to do this by matching the categories in the old dataset to new observations with the same department and program codes. unfortunately this doesn't work all that well
-priorities1 = old_expenses[['dept_code', 'prog_code', 'program_priority']]
-# TODO unsure about the logic of this line? it was in the original .R so I kept it here commented-out
-# priorities1 = priorities1.drop_duplicates(subset='program_priority', keep='first')
-priorities1.dropna(inplace=True)
-
-# remove duplicate Dept_Code, Prog_Code combinations
-priorities1.drop_duplicates(subset=['dept_code', 'prog_code'], keep='first', inplace=True)
-
-## merge in the program_priorities1
-new_expenses = pd.merge(new_expenses, priorities1, on=['dept_code', 'prog_code'], how='left')
-new_expenses.loc[new_expenses['program_priority']=='','program_priority']='Not Categorized'
-new_expenses['program_priority'].fillna('Not Categorized', inplace = True)
-
-new_expenses = new_expenses.astype({'prog_code': str})
-
-## second, assign program priority using the descriptions dataset
-program_priorities2_filename = '../../data/approved_budget/FY18-19/program_priorities.csv'
-priorities2 = pd.read_csv(program_priorities2_filename)
-
-priorities2.dropna(inplace=True)
-priorities2 = priorities2[['Prog_Code', 'Program_Priority']]
-
-priorities2.columns = [x.lower() for x in priorities2.columns]
-priorities2 = priorities2.astype({'prog_code': str})
-
-
-## merge in the program_priorities2 -- this will create two columns: program_priority_x, program_priority_y (one for each attempt)
-new_expenses = pd.merge(new_expenses, priorities2, on='prog_code', how='left')
-
-## consolidate the two estimates of priority, giving preference to the one from the descriptions dataset
-new_expenses['program_priority'] = np.where(new_expenses.program_priority_y, new_expenses.program_priority_y, new_expenses.program_priority_y)
-
-# fill the empty slots with 'Not Categorized'
-new_expenses['program_priority'].fillna('Not Categorized', inplace = True)
-new_expenses.loc[new_expenses['program_priority']=='','program_priority']='Not Categorized'
-
-# delete columns program_priority_x, program_priority_y
-new_expenses.drop(['program_priority_x', 'program_priority_y'], axis=1, inplace=True)
-
-
-
-####################
-### Miscellaneous data transformations
-####################
-
-# add a fiscal year column
-new_expenses['fiscal_year'] = new_fiscal_year
-
-# add a blank expense_type column. this is no longer provided
-new_expenses['expense_type'] = None
-
-# arrange columns in the same order as the old expenses data
-new_expenses = new_expenses[old_expenses.columns]
-
-# convert appropriation column to character
-# new_expenses.assign(Appropriation=lambda x: str(x))
-
-# combine the old and new data
-expenses = pd.concat([new_expenses, old_expenses], axis=0)
-
-# sort according to fiscal year, department name, program name, account name
-expenses = expenses.astype({'fiscal_year': int})
-expenses.sort_values(by=['fiscal_year'], ascending=False)
-expenses.sort_values(by=['department_name', 'program_name', 'account_name'], ascending=True)
-
-####################
-## Save data
-####################
-
-# write to csv
-expenses.to_csv(f'{filepath_prefix}new_expenses.csv')
-
-# upload the data to Socrata
-# client.replace(socrata_identifier, expenses)
+socrata_identifier = datasets['expenses']['identifier']
+
+# the columns of the dataset. the pages of the portal leave out null values, so a column that is null on every row
+# of a page (or of the whole history) would otherwise be missing from it
+expense_columns = datasets['expenses']['columns']
+
+# out-of-core mode: stream the Socrata history in chunks of chunk_size rows instead of holding it in memory,
+# so memory use stays the same however many fiscal years have accumulated. the sync of publish.py compares
+# the whole old and new datasets in memory, so a chunked build is better published with --mode replace
+default_chunk_size = 100000
+
+
+def run(fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage, client=None,
+        chunked=False, chunk_size=default_chunk_size, chrome_trace=False):
+    """
+    Build new_expenses.csv for the fiscal year (the year it ends in) from the year's expenditures
+    file and the appropriations on Socrata; returns the new rows (chunked) or the whole dataset.
+
+    client is a sodapy client (a public one by default; use budget_config.socrata_client(login=True)
+    to push). The time, memory use and row counts of every stage are written to
+    trace_expenses_<time>.json in the year's folder (see tracing.py); chrome_trace=True also writes
+    a trace that chrome://tracing or Perfetto can show.
+    """
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    filepath_prefix = budget.folder
+    new_fiscal_year = budget.fiscal_year
+    client = client or socrata_client()
+    timestamp = datetime.datetime.now()
+    tracer = Tracer('expenses')
+
+    # the maintained indexes and caches under the data root
+    index_path = budget.data_file('program_priority_index.csv')
+    cache_dir = budget.data_file('.socrata_cache/')
+
+    ####################
+    ## Read in existing data
+    ####################
+
+    backup_filename = f'{filepath_prefix}old_expenses_{timestamp}.csv'
+    socrata_source = f'socrata {socrata_identifier}'
+
+    tracer.begin('fetch socrata')
+    if not chunked:
+        # read in the existing data on Socrata (including the ':id' system field, which is needed to sync changes)
+        socrata_expenses = cached_fetch(client, socrata_identifier, cache_dir=cache_dir, exclude_system_fields=False,
+                                        dtypes=socrata_dtypes[socrata_identifier])
+        old_expenses = drop_system_fields(socrata_expenses).reindex(columns=expense_columns)
+
+        # save a copy as a local backup -- especially before pushing the output back to overwrite the existing data on Socrata
+        old_expenses.to_csv(backup_filename, index=False)
+
+        # filter out any data from the fiscal year that's being updated (only keep the rows where fiscal_year!=new_fiscal_year).
+        old_expenses = old_expenses[pd.to_numeric(old_expenses['fiscal_year']) != new_fiscal_year]
+        old_columns = old_expenses.columns
+    else:
+        # stream the existing data into the local backup, chunk by chunk; the merge below reads the backup back in chunks.
+        # the priorities of the old rows are collected on the way, if the priority index doesn't have them yet (see below)
+        priority_index = load_index(index_path)
+        seed_priorities = not (priority_index['source'] == socrata_source).any()
+        seeds = []
+        with ChunkedCsvWriter(backup_filename, columns=expense_columns) as backup:
+            for chunk in cached_chunks(client, socrata_identifier, chunk_size, cache_dir=cache_dir,
+                                       exclude_system_fields=False, dtypes=socrata_dtypes[socrata_identifier]):
+                chunk = drop_system_fields(chunk)
+                backup.write(chunk)
+                if seed_priorities:
+                    seeds.append(chunk[['dept_code', 'prog_code', 'program_priority']].drop_duplicates())
+            if not backup.started:
+                # no history on Socrata yet: the backup is only a header
+                backup.write(pd.DataFrame(columns=expense_columns))
+        old_columns = pd.Index(backup.columns)
+        if seeds:
+            priority_index = update_index(priority_index, pd.concat(seeds), socrata_source, socrata_precedence)
+            save_index(priority_index, index_path)
+    tracer.end(rows_out=old_expenses if not chunked else backup.rows)
+
+    ####################
+    ## Read in new data
+    ####################
+
+    # read in the new expenses data. section 2 only
+    # only the columns in the spec are read (see dataset_specs.py), renamed to match the old data, and
+    # rows with no appropriation data are removed. the appropriation column is the one for the fiscal year
+    # being updated, e.g. '2021-22 Adopted'
+    # missing columns: Program_Priority, Expense_Type
+    csv_file = budget.input_file('expenses')
+    tracer.begin('read new expenses')
+    new_expenses = read_dataset('expenses', csv_file, new_fiscal_year, budget.stage)
+    tracer.end(rows_out=new_expenses)
+
+    ####################
+    ## Get Program Priorities
+    # assign a category to each expenditure, e.g. A Well Run City, A Safe City
+    ####################
+
+    # priorities are looked up in the maintained index (see priority_index.py), keyed on (dept_code, prog_code).
+    # the descriptions pipeline adds each year's new_program_priorities.csv to the index; the sources below
+    # only need to be added once
+    tracer.begin('program priorities', rows_in=new_expenses)
+    priority_index = load_index(index_path)
+
+    ## first, the categories of the old dataset, for rows with the same department and program codes. unfortunately this doesn't work all that well, so it has the lowest precedence
+    ## (in chunked mode they were already added while streaming the old data)
+    if not chunked and not (priority_index['source'] == socrata_source).any():
+        priority_index = update_index(priority_index, old_expenses, socrata_source, socrata_precedence)
+
+    ## second, the priorities from the descriptions dataset, which are preferred
+    program_priorities2_filename = budget.data_file(stored_datasets['program_priorities']['source'])
+    if not (priority_index['source'] == program_priorities2_filename).any():
+        priorities2 = load_dataset('program_priorities', data_root=data_root)
+        priority_index = update_index(priority_index, priorities2, program_priorities2_filename, descriptions_precedence)
+
+    save_index(priority_index, index_path)
+
+    # look up the priority of every new row; rows that aren't in the index under their codes get the entry of the same
+    # program under its earlier codes (see crosswalk.py, rebuilt with `python3 crosswalk.py`), the rest are 'Not Categorized'
+    code_crosswalk = load_crosswalk(budget.data_file('code_crosswalk.csv'))
+    new_expenses['program_priority'] = assign_priorities(new_expenses, priority_index,
+                                                         crosswalk=Crosswalk(code_crosswalk) if len(code_crosswalk) else None)
+    tracer.end(rows_out=new_expenses)
+
+    ####################
+    ### Miscellaneous data transformations
+    ####################
+
+    tracer.begin('combine', rows_in=new_expenses)
+
+    # add a fiscal year column
+    new_expenses['fiscal_year'] = new_fiscal_year
+
+    # add a blank expense_type column. this is no longer provided
+    new_expenses['expense_type'] = None
+
+    # arrange columns in the same order as the old expenses data
+    new_expenses = new_expenses[old_columns]
+
+    # convert appropriation column to character
+    # new_expenses.assign(Appropriation=lambda x: str(x))
+
+    if not chunked:
+        # combine the old and new data, with the name columns encoded over the vocabulary shared by every dataset
+        # (see dimensions.py): the concat copies int32 codes instead of a string per row
+        vocabulary = shared_vocabulary(budget.data_file('dimension_vocabulary.json'))
+        expenses = vocabulary.concat([new_expenses, old_expenses], axis=0)
+        vocabulary.save()
+
+        # sort according to fiscal year, department name, program name, account name
+        expenses = expenses.astype({'fiscal_year': int})
+        expenses.sort_values(by=['fiscal_year'], ascending=False)
+        expenses.sort_values(by=['department_name', 'program_name', 'account_name'], ascending=True)
+    tracer.end(rows_out=expenses if not chunked else new_expenses)
+
+    ####################
+    ## Save data
+    ####################
+
+    # check the data before it is saved and uploaded (see data_quality.py); stops here if a check fails. in chunked
+    # mode only the new rows are in memory
+    with tracer.stage('quality gate'):
+        gate(expenses if not chunked else new_expenses, 'expenses', fiscal_year=new_fiscal_year,
+             report_path=f'{filepath_prefix}quality_expenses.json')
+
+    cube_dir = budget.data_file('rollup_cube/')
+    output_filename = budget.output_file('expenses')
+    if not chunked:
+        # write to csv
+        with tracer.stage('write csv', rows_in=expenses):
+            expenses.to_csv(output_filename, index=False)
+
+        # update the rollup cube and treemaps (see rollup_cube.py); only the years whose line items changed are recomputed
+        with tracer.stage('rollup cube', rows_in=expenses):
+            update_cube(expenses, cube_dir=cube_dir)
+    else:
+        # write the new rows, then the old rows of the other fiscal years, read back from the backup one chunk at a time
+        with tracer.stage('write csv') as span:
+            with ChunkedCsvWriter(output_filename, columns=old_columns) as output:
+                output.write(new_expenses)
+                for chunk in pd.read_csv(backup_filename, dtype=str, chunksize=chunk_size):
+                    output.write(chunk[pd.to_numeric(chunk['fiscal_year']) != new_fiscal_year])
+            span.rows_out = output.rows
+        print(f'wrote {output.rows} rows to {output_filename}')
+
+        # only the new fiscal year's part of the rollup cube changes
+        with tracer.stage('rollup cube', rows_in=new_expenses):
+            update_cube(new_expenses, cube_dir=cube_dir, years=[new_fiscal_year], complete=False)
+
+    # upload the data to Socrata with `python3 labudget.py publish expenses`, which pushes only the inserted,
+    # changed and deleted rows (see publish.py), or replace the whole dataset:
+    # client.replace(socrata_identifier, expenses)
+
+    tracer.finish(filepath_prefix, chrome=chrome_trace)
+    return expenses if not chunked else new_expenses
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# labudget.py
+# one command line for every step of the budget refresh
+#
+# Every subcommand takes the fiscal year (the year it ends in), the budget stage and the data
+# root, so nothing needs editing for a new year. pandas, sodapy and the pipelines are only
+# imported by the subcommands that use them: --help and `validate --schema-only` only load the
+# standard library.
+#
+#   fetch          bring the local snapshots of the Socrata datasets up to date, all at once
+#   build          run a pipeline: expenses, revenue, other (gfrev, positions, inc, pm),
+#                  descriptions, or all of them concurrently
+#   parse-pdf      parse the year's Exhibit B into new_revenues.csv and available_balances.csv
+#   validate       check an output file against the data-quality rules of its dataset
+#   publish        push an output file to its Socrata dataset (sync or chunked replace)
+#   search         find departments and programs by the words of their descriptions
+#
+# Usage (from scripts/python-scripts):
+#   python3 labudget.py build expenses --fiscal-year 2022
+#   python3 labudget.py validate expenses --schema-only
+#   python3 labudget.py publish positions --mode replace --dry-run
+#   python3 labudget.py search "street lighting" --type Program
+
+import argparse
+import csv
+import os
+import sys
+
+from budget_config import BudgetYear, datasets, default_data_root, default_fiscal_year, default_stage, stage_folders
+from quality_rules import header_problems, rules
+
+# the module whose run() each build target calls
+pipelines = {
+    'expenses': 'expenses',
+    'revenue': 'revenue',
+    'other': 'open_budget_other',
+    'descriptions': 'department_and_program_descriptions',
+    'all': 'pipeline_runner',
+}
+
+
+def _budget(args):
+    return BudgetYear(args.fiscal_year, args.data_root, args.stage)
+
+
+def run_fetch(args):
+    from socrata_async import prefetch
+
+    identifiers = [datasets[name]['identifier'] if name in datasets else name for name in args.datasets] or None
+    options = {'identifiers': identifiers} if identifiers else {}
+    prefetch(concurrency=args.concurrency, cache_dir=_budget(args).data_file('.socrata_cache/'), **options)
+    return 0
+
+
+def run_build(args):
+    import importlib
+
+    options = {'fiscal_year': args.fiscal_year, 'data_root': args.data_root, 'stage': args.stage,
+               'chrome_trace': args.chrome_trace}
+    if args.chunked:
+        if args.pipeline != 'expenses':
+            raise SystemExit('--chunked only applies to the expenses pipeline')
+        options['chunked'] = True
+    importlib.import_module(pipelines[args.pipeline]).run(**options)
+    return 0
+
+
+def run_parse_pdf(args):
+    import parse_revenues
+
+    parse_revenues.run(args.fiscal_year, args.data_root, args.stage, pdf_filename=args.pdf,
+                       chrome_trace=args.chrome_trace)
+    return 0
+
+
+def run_validate(args):
+    filename = args.filename
+    if filename is None:
+        if args.dataset not in datasets:
+            raise SystemExit(f'give the file to check; {args.dataset} has no output file of its own')
+        filename = _budget(args).output_file(args.dataset)
+
+    if not os.path.exists(filename):
+        raise SystemExit(f'{filename} not found; build it first or give the file to check')
+
+    if args.schema_only:
+        with open(filename, newline='', encoding='utf-8-sig') as f:
+            header = next(csv.reader(f), [])
+        problems = header_problems(args.dataset, header)
+        for check, severity, missing in problems:
+            print(f'  {args.dataset}: {check} {severity}: missing columns {missing}')
+        errors = sum(severity == 'error' for _, severity, _ in problems)
+        print(f'schema {args.dataset}: {len(header)} columns, {errors} errors, {len(problems) - errors} warnings')
+        return 1 if errors else 0
+
+    import data_quality
+
+    argv = [args.dataset, filename, '--fiscal-year', str(args.fiscal_year)]
+    return data_quality.main(argv + (['--report', args.report] if args.report else []))
+
+
+def run_publish(args):
+    import publish
+
+    publish.publish(args.dataset, args.fiscal_year, args.data_root, args.stage, mode=args.mode,
+                    dry_run=args.dry_run)
+    return 0
+
+
+def run_search(args):
+    import description_index
+
+    index_dir = os.path.join(args.data_root, 'description_index', '')
+    argv = [args.query, '--index-dir', index_dir, '--data-root', args.data_root, '--limit', str(args.limit)]
+    argv += ['--fiscal-year', str(args.fiscal_year)] if args.this_year else []
+    argv += ['--type', args.type] if args.type else []
+    return description_index.main(argv + (['--rebuild'] if args.rebuild else []))
+
+
+def parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--fiscal-year', type=int, default=default_fiscal_year,
+                        help=f'the year the fiscal year ends in (default: {default_fiscal_year})')
+    common.add_argument('--data-root', default=default_data_root,
+                        help=f'folder holding approved_budget/ and proposed_budget/ (default: {default_data_root})')
+    common.add_argument('--stage', default=default_stage, choices=sorted(stage_folders),
+                        help=f'budget stage (default: {default_stage})')
+
+    main_parser = argparse.ArgumentParser(prog='labudget', description='Refresh the LA City budget datasets.')
+    commands = main_parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('fetch', parents=[common], help='bring the local Socrata snapshots up to date')
+    p.add_argument('datasets', nargs='*', help=f'datasets or identifiers (default: all of {sorted(datasets)})')
+    p.add_argument('--concurrency', type=int, default=8, help='requests in flight at the same time')
+    p.set_defaults(func=run_fetch)
+
+    p = commands.add_parser('build', parents=[common], help='run a pipeline')
+    p.add_argument('pipeline', choices=list(pipelines))
+    p.add_argument('--chunked', action='store_true', help='expenses: stream the Socrata history out of core')
+    p.add_argument('--chrome-trace', action='store_true', help='also write a Chrome trace of the stages')
+    p.set_defaults(func=run_build)
+
+    p = commands.add_parser('parse-pdf', parents=[common], help="parse the year's Exhibit B")
+    p.add_argument('--pdf', help="the PDF (default: the year's 05-Exhibit B)")
+    p.add_argument('--chrome-trace', action='store_true', help='also write a Chrome trace of the stages')
+    p.set_defaults(func=run_parse_pdf)
+
+    p = commands.add_parser('validate', parents=[common], help='check a file against the data-quality rules')
+    p.add_argument('dataset', choices=sorted(rules))
+    p.add_argument('filename', nargs='?', help="the csv file (default: the dataset's output of the year)")
+    p.add_argument('--schema-only', action='store_true', help='only check the columns in the header')
+    p.add_argument('--report', help='where to write the JSON report (default: next to the file)')
+    p.set_defaults(func=run_validate)
+
+    p = commands.add_parser('publish', parents=[common], help='push an output file to Socrata')
+    p.add_argument('dataset', choices=sorted(datasets))
+    p.add_argument('--mode', default='sync', choices=['sync', 'replace'],
+                   help='sync: upsert the changed rows; replace: replace the dataset in resumable chunks')
+    p.add_argument('--dry-run', action='store_true', help='count the changes or chunks without sending anything')
+    p.set_defaults(func=run_publish)
+
+    p = commands.add_parser('search', parents=[common], help='search the department and program descriptions')
+    p.add_argument('query', help='words to search for')
+    p.add_argument('--this-year', action='store_true', help='only the descriptions of --fiscal-year (default: every year)')
+    p.add_argument('--type', choices=['Department', 'Program'], help='only departments or only programs')
+    p.add_argument('--limit', type=int, default=10)
+    p.add_argument('--rebuild', action='store_true', help='index the description files of every year first')
+    p.set_defaults(func=run_search)
+    return main_parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
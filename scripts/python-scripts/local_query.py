@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+# local_query.py
+# query the pipeline outputs locally with a subset of SoQL, instead of data.lacity.org
+#
+# LocalDataset loads one output file (new_expenses.csv, final_revenues.csv, new_positions.csv,
+# ...) and builds a hash index (value -> row positions) on each code column and fiscal_year.
+# query() accepts the SoQL parameters the scripts and the analysts use:
+#
+#   $select   columns, *, and count(*) / count / sum / avg / min / max (col), with AS aliases
+#   $where    = != <> < <= > >=, IN (...), NOT IN (...), BETWEEN .. AND .., LIKE, IS [NOT] NULL,
+#             combined with AND, OR, NOT and parentheses; as on the portal, a comparison with a null
+#             value neither holds nor fails, so `x != 'a'` and `NOT x = 'a'` leave out the rows where x is null
+#   $group    columns
+#   $order    output columns or select expressions, ASC / DESC
+#   $limit, $offset
+#
+# Equality and IN conditions on an indexed column are answered from the index, and the other
+# conditions of an AND are then only evaluated on the rows the index returned, so a filtered
+# lookup does not scan the table. Rows come back as lists of dicts of strings, the way the
+# portal returns them (empty values left out).
+#
+# LocalSocrata serves the datasets by their Socrata identifiers with sodapy's get() and
+# get_metadata(), so code written for the portal (e.g. socrata_fetch.fetch_dataset) can point
+# at the local files.
+#
+# Usage (from scripts/python-scripts):
+#   python3 local_query.py ../../data/approved_budget/FY21-22/new_expenses.csv \
+#       --select "department_name, sum(appropriation) AS total" --where "fiscal_year = 2022" \
+#       --group department_name --order "total DESC" --limit 10
+
+import argparse
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# the pipeline outputs, by Socrata identifier, relative to the data folder
+default_datasets = {
+    '5242-pnmt': 'approved_budget/FY21-22/new_expenses.csv',
+    'ih6g-qkwz': 'approved_budget/FY21-22/final_revenues.csv',
+    'qrkr-kfbh': 'approved_budget/FY21-22/new_gfrev.csv',
+    '46qe-t7np': 'approved_budget/FY21-22/new_positions.csv',
+    'k4k6-bwwv': 'approved_budget/FY21-22/new_incremental_changes.csv',
+    'bywz-284j': 'approved_budget/FY21-22/new_performance_measures.csv',
+    'cd49-p4un': 'approved_budget/FY21-22/new_descriptions.csv',
+}
+
+# columns that get an index when present
+index_columns = ['dept_code', 'department_code', 'prog_code', 'program_code', 'fund_code',
+                 'source_fund_code', 'account_code', 'fiscal_year']
+
+aggregates = {'count', 'sum', 'avg', 'min', 'max'}
+
+
+class SoQLError(ValueError):
+    pass
+
+
+####################
+## Parsing
+####################
+
+_token = re.compile(r"""
+    \s*(?:
+      (?P<string>'(?:[^']|'')*')
+    | (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<op><>|!=|<=|>=|=|<|>|\(|\)|,|\*)
+    | (?P<name>:?[A-Za-z_][A-Za-z0-9_.]*|`[^`]+`)
+    )""", re.VERBOSE)
+
+_keywords = {'and', 'or', 'not', 'in', 'between', 'like', 'is', 'null', 'as', 'asc', 'desc', 'true', 'false'}
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _token.match(text, position)
+        if not match or match.end() == position:
+            raise SoQLError(f'cannot parse {text[position:]!r}')
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            tokens.append(('literal', value[1:-1].replace("''", "'")))
+        elif kind == 'number':
+            tokens.append(('literal', float(value) if '.' in value else int(value)))
+        elif kind == 'name' and value.lower() in _keywords:
+            tokens.append(('keyword', value.lower()))
+        elif kind == 'name':
+            tokens.append(('name', value.strip('`')))
+        else:
+            tokens.append(('op', value))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.i = 0
+
+    def peek(self, kind=None, value=None):
+        if self.i >= len(self.tokens):
+            return None
+        token = self.tokens[self.i]
+        if (kind and token[0] != kind) or (value is not None and token[1] != value):
+            return None
+        return token
+
+    def take(self, kind=None, value=None):
+        token = self.peek(kind, value)
+        if token is None:
+            found = self.tokens[self.i][1] if self.i < len(self.tokens) else 'the end'
+            raise SoQLError(f'expected {value or kind}, found {found!r}')
+        self.i += 1
+        return token
+
+    def done(self):
+        if self.i < len(self.tokens):
+            raise SoQLError(f'unexpected {self.tokens[self.i][1]!r}')
+
+    # $where
+    def condition(self):
+        node = self.conjunction()
+        while self.peek('keyword', 'or'):
+            self.take()
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.peek('keyword', 'and'):
+            self.take()
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.peek('keyword', 'not'):
+            self.take()
+            return ('not', self.negation())
+        if self.peek('op', '('):
+            self.take()
+            node = self.condition()
+            self.take('op', ')')
+            return node
+        return self.predicate()
+
+    def literal(self):
+        if self.peek('keyword', 'true') or self.peek('keyword', 'false'):
+            return self.take()[1] == 'true'
+        return self.take('literal')[1]
+
+    def predicate(self):
+        column = self.take('name')[1]
+        negate = bool(self.peek('keyword', 'not')) and self.take()
+        if self.peek('keyword', 'in'):
+            self.take()
+            self.take('op', '(')
+            values = [self.literal()]
+            while self.peek('op', ','):
+                self.take()
+                values.append(self.literal())
+            self.take('op', ')')
+            node = ('in', column, values)
+        elif self.peek('keyword', 'between'):
+            self.take()
+            low = self.literal()
+            self.take('keyword', 'and')
+            node = ('between', column, low, self.literal())
+        elif self.peek('keyword', 'like'):
+            self.take()
+            node = ('like', column, self.take('literal')[1])
+        elif self.peek('keyword', 'is'):
+            self.take()
+            is_not = bool(self.peek('keyword', 'not')) and self.take()
+            self.take('keyword', 'null')
+            node = ('notnull' if is_not else 'null', column)
+        else:
+            if negate:
+                raise SoQLError(f'unexpected NOT after {column}')
+            op = self.take('op')[1]
+            if op not in ('=', '!=', '<>', '<', '<=', '>', '>='):
+                raise SoQLError(f'unexpected {op!r} after {column}')
+            node = ('cmp', '!=' if op == '<>' else op, column, self.literal())
+        return ('not', node) if negate else node
+
+    # $select
+    def expression(self):
+        name = self.take('name')[1] if not self.peek('op', '*') else self.take()[1]
+        if name.lower() in aggregates and self.peek('op', '('):
+            self.take()
+            argument = self.take('op', '*')[1] if self.peek('op', '*') else self.take('name')[1]
+            self.take('op', ')')
+            function = name.lower()
+            default = 'count' if argument == '*' else f'{function}_{argument}'
+            expression = (function, argument)
+        else:
+            default = name
+            expression = ('column', name)
+        alias = default
+        if self.peek('keyword', 'as'):
+            self.take()
+            alias = self.take('name')[1]
+        return expression, alias
+
+    def expressions(self):
+        items = [self.expression()]
+        while self.peek('op', ','):
+            self.take()
+            items.append(self.expression())
+        return items
+
+    def orderings(self):
+        items = []
+        while True:
+            expression, alias = self.expression()
+            descending = False
+            if self.peek('keyword', 'asc') or self.peek('keyword', 'desc'):
+                descending = self.take()[1] == 'desc'
+            items.append((expression, alias, descending))
+            if not self.peek('op', ','):
+                return items
+            self.take()
+
+
+def _parse(text, method):
+    parser = _Parser(text)
+    result = getattr(parser, method)()
+    parser.done()
+    return result
+
+
+####################
+## Evaluation
+####################
+
+def _key(value):
+    # index key of a cell or literal: 2022, 2022.0 and '2022' are the same key
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _text_column(column):
+    # a column as the portal returns it: strings, whole numbers without '.0', missing as None
+    if pd.api.types.is_float_dtype(column):
+        whole = column.dropna()
+        if (whole == whole.round()).all():
+            column = column.astype('Int64')
+    text = column.map(str, na_action='ignore').to_numpy(dtype=object)
+    text[column.isna().to_numpy()] = None
+    return text
+
+
+def _like(pattern):
+    parts = ['.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern]
+    return '^' + ''.join(parts) + '$'
+
+
+class LocalDataset:
+    """One output table with hash indexes on its code and fiscal_year columns."""
+
+    def __init__(self, data, indexed=None):
+        if isinstance(data, str):
+            self.source = data
+            data = pd.read_parquet(data) if data.endswith('.parquet') else pd.read_csv(data, dtype=str)
+            data = data.drop(columns=[c for c in data.columns if c.startswith('Unnamed:')])
+            # numbers are typed for comparisons and sums, codes stay text; a sample of each
+            # column decides whether the whole column is tried
+            for column in data.columns:
+                if column in index_columns:
+                    continue
+                sample = data[column].dropna().head(1000)
+                if len(sample) and pd.to_numeric(sample, errors='coerce').notna().all():
+                    converted = pd.to_numeric(data[column], errors='coerce')
+                    if converted.notna().sum() == data[column].notna().sum():
+                        data[column] = converted
+        else:
+            self.source = None
+        # text as plain object arrays: row lookups (take) on them are much faster than on arrow strings
+        text = [c for c in data.columns if pd.api.types.is_string_dtype(data[c]) and data[c].dtype != object]
+        self.df = data.astype({c: object for c in text}).reset_index(drop=True)
+        self.indexes = {}
+        for column in (indexed if indexed is not None else index_columns):
+            if column in self.df.columns:
+                keys = self.df[column]
+                if pd.api.types.is_numeric_dtype(keys):
+                    keys = keys.map(_key, na_action='ignore')
+                # hashed group positions; each array is sorted
+                self.indexes[column] = keys.groupby(keys, sort=False, observed=True).indices
+
+    def __len__(self):
+        return len(self.df)
+
+    def _column(self, name):
+        if name not in self.df.columns:
+            raise SoQLError(f'no such column: {name}')
+        return self.df[name]
+
+    def _values(self, name, rows):
+        column = self._column(name)
+        return column if rows is None else column.iloc[rows]
+
+    def _compare(self, values, op, literal):
+        if isinstance(literal, str) and pd.api.types.is_numeric_dtype(values):
+            literal = pd.to_numeric(literal)
+        elif not isinstance(literal, str) and not pd.api.types.is_numeric_dtype(values):
+            values = pd.to_numeric(values, errors='coerce')
+        # a comparison with a null value doesn't hold, whatever the operator (as in SoQL)
+        holds = {'=': values.eq, '!=': values.ne, '<': values.lt, '<=': values.le,
+                 '>': values.gt, '>=': values.ge}[op](literal).fillna(False)
+        return (holds & values.notna()).to_numpy(dtype=bool)
+
+    def _mask(self, node, rows):
+        kind = node[0]
+        if kind == 'cmp':
+            _, op, column, literal = node
+            return self._compare(self._values(column, rows), op, literal)
+        if kind == 'in':
+            values = self._values(node[1], rows)
+            return values.map(_key, na_action='ignore').isin([_key(v) for v in node[2]]).to_numpy(dtype=bool)
+        if kind == 'between':
+            values = self._values(node[1], rows)
+            return self._compare(values, '>=', node[2]) & self._compare(values, '<=', node[3])
+        if kind == 'like':
+            values = self._values(node[1], rows).astype('string')
+            return values.str.match(_like(node[2]), case=True).fillna(False).to_numpy(dtype=bool)
+        if kind in ('null', 'notnull'):
+            missing = self._values(node[1], rows).isna().to_numpy()
+            return missing if kind == 'null' else ~missing
+        raise SoQLError(f'cannot evaluate {kind}')
+
+    def _indexed(self, node):
+        return node[0] in ('cmp', 'in') and node[-2 if node[0] == 'in' else 2] in self.indexes \
+            and (node[0] == 'in' or node[1] == '=')
+
+    def _lookup(self, node):
+        index = self.indexes[node[1] if node[0] == 'in' else node[2]]
+        keys = node[2] if node[0] == 'in' else [node[3]]
+        found = [index[_key(k)] for k in keys if _key(k) in index]
+        if len(found) == 1:
+            return found[0]
+        # different keys never share a row, so sorting is enough
+        return np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+
+    def _filter(self, node, rows):
+        """Row positions (sorted) among rows (None = all) where node holds."""
+        kind = node[0]
+        if kind == 'and':
+            # answer the indexed conditions first, then test the rest on fewer rows
+            parts = []
+            stack = [node]
+            while stack:
+                part = stack.pop()
+                if part[0] == 'and':
+                    stack += [part[2], part[1]]
+                else:
+                    parts.append(part)
+            parts.sort(key=lambda part: not self._indexed(part))
+            for part in parts:
+                rows = self._filter(part, rows)
+            return rows
+        if kind == 'or':
+            return np.union1d(self._filter(node[1], rows), self._filter(node[2], rows))
+        if kind == 'not':
+            return self._false(node[1], rows)
+        if self._indexed(node):
+            found = self._lookup(node)
+            return found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        everything = np.arange(len(self.df)) if rows is None else rows
+        return everything[self._mask(node, rows)]
+
+    def _false(self, node, rows):
+        """
+        Row positions (sorted) among rows (None = all) where node fails. As in SoQL, a condition on a
+        null value neither holds nor fails, so NOT leaves those rows out too.
+        """
+        kind = node[0]
+        if kind == 'and':
+            return np.union1d(self._false(node[1], rows), self._false(node[2], rows))
+        if kind == 'or':
+            return np.intersect1d(self._false(node[1], rows), self._false(node[2], rows), assume_unique=True)
+        if kind == 'not':
+            return self._filter(node[1], rows)
+        everything = np.arange(len(self.df)) if rows is None else rows
+        if kind not in ('null', 'notnull'):
+            everything = everything[self._values(node[2] if kind == 'cmp' else node[1], rows).notna().to_numpy()]
+        return np.setdiff1d(everything, self._filter(node, rows), assume_unique=True)
+
+    def query(self, params=None, **kwargs):
+        """
+        Run a SoQL query; params/kwargs are select, where, group, order, limit, offset (with or
+        without the leading $). Returns a data frame.
+        """
+        params = {k.lstrip('$').lower(): v for k, v in dict(params or {}, **kwargs).items() if v is not None}
+        unknown = set(params) - {'select', 'where', 'group', 'order', 'limit', 'offset'}
+        if unknown:
+            raise SoQLError(f'unsupported parameters: {sorted(unknown)}')
+
+        rows = self._filter(_parse(params['where'], 'condition'), None) if params.get('where') else None
+        df = self.df if rows is None else self.df.iloc[rows]
+
+        selected = _parse(params.get('select', '*'), 'expressions')
+        group = [name.strip().strip('`') for name in params['group'].split(',')] if params.get('group') else []
+        if group or any(expression[0] != 'column' for expression, _ in selected):
+            df = self._aggregate(df, selected, group)
+        else:
+            columns, names = [], []
+            for (_, name), alias in selected:
+                if name == '*':
+                    columns += list(self.df.columns)
+                    names += list(self.df.columns)
+                else:
+                    self._column(name)
+                    columns.append(name)
+                    names.append(alias)
+            df = df[columns]
+            df.columns = names
+
+        if params.get('order'):
+            df = self._order(df, _parse(params['order'], 'orderings'))
+        offset = int(params.get('offset', 0))
+        limit = params.get('limit')
+        return df.iloc[offset:offset + int(limit) if limit is not None else None]
+
+    def _aggregate(self, df, selected, group):
+        for name in group:
+            self._column(name)
+        named = {}
+        for (function, argument), alias in selected:
+            if function == 'column':
+                if argument not in group:
+                    raise SoQLError(f'{argument} must be in $group or inside an aggregate')
+                continue
+            if argument != '*':
+                self._column(argument)
+            source = group[0] if argument == '*' and group else argument
+            how = {'avg': 'mean', 'count': 'size' if argument == '*' else 'count'}.get(function, function)
+            named[alias] = (source, how)
+        if group:
+            out = df.groupby(group, sort=False, dropna=False).agg(**named).reset_index() if named \
+                else df[group].drop_duplicates()
+        else:
+            out = pd.DataFrame({alias: [len(df) if how == 'size' else getattr(df[source], how)()]
+                                for alias, (source, how) in named.items()})
+        order = [alias if function != 'column' else argument for (function, argument), alias in selected]
+        out = out[order]
+        out.columns = [alias for _, alias in selected]
+        return out
+
+    def _order(self, df, orderings):
+        by, ascending = [], []
+        for (function, argument), alias, descending in orderings:
+            if argument == ':id' and ':id' not in df.columns:
+                # the local rows are already in :id (file) order
+                continue
+            name = alias if alias in df.columns else argument
+            if name not in df.columns:
+                raise SoQLError(f'cannot order by {alias}: not in the output')
+            by.append(name)
+            ascending.append(not descending)
+        return df.sort_values(by, ascending=ascending, kind='stable') if by else df
+
+    def get(self, params=None, system_fields=False, **kwargs):
+        """
+        query() as the portal returns it: a list of dicts of strings, empty values left out.
+        system_fields adds the ':id' of each row to the rows of a plain (not aggregated) query.
+        """
+        df = self.query(params, **kwargs)
+        if system_fields and list(df.columns) == list(self.df.columns):
+            df = df.assign(**{':id': 'row-' + df.index.astype(str)})
+        columns = list(df.columns)
+        values = [_text_column(df[c]) for c in columns]
+        return [{c: v for c, v in zip(columns, row) if v is not None} for row in zip(*values)]
+
+
+class LocalSocrata:
+    """Stand-in for sodapy.Socrata serving local files by dataset identifier."""
+
+    def __init__(self, datasets=None, data_root='../../data/'):
+        datasets = default_datasets if datasets is None else datasets
+        self.paths = {identifier: os.path.join(data_root, path) for identifier, path in datasets.items()}
+        self.loaded = {}
+
+    def dataset(self, identifier):
+        if identifier not in self.loaded:
+            if identifier not in self.paths:
+                raise KeyError(f'no local file for dataset {identifier}')
+            self.loaded[identifier] = LocalDataset(self.paths[identifier])
+        return self.loaded[identifier]
+
+    def get(self, identifier, content_type='json', exclude_system_fields=True, **kwargs):
+        return self.dataset(identifier).get(system_fields=not exclude_system_fields, **kwargs)
+
+    def get_metadata(self, identifier, content_type='json'):
+        modified = int(os.path.getmtime(self.paths[identifier]))
+        return {'id': identifier, 'rowsUpdatedAt': modified, 'viewLastModified': modified}
+
+    def close(self):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query a pipeline output file with a subset of SoQL.')
+    parser.add_argument('filename')
+    for name in ['select', 'where', 'group', 'order', 'limit', 'offset']:
+        parser.add_argument(f'--{name}')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    dataset = LocalDataset(args.filename)
+    loaded = time.perf_counter()
+    result = dataset.query({name: getattr(args, name) for name in ['select', 'where', 'group', 'order', 'limit', 'offset']})
+    done = time.perf_counter()
+    print(result.to_string(index=False))
+    print(f'{len(result)} rows; loaded {len(dataset):,} rows in {loaded - start:.2f}s, query took {(done - loaded) * 1000:.1f}ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
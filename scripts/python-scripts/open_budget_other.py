@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
-# open_data_ther.py
+# open_budget_other.py
 # Chelsea Ursaner. Edited by Adam Scherling. 6/11/2018
 # Converted/Updated July 2021, Irene Tang
+#
+# stages() declares the pipelines of the four datasets for one fiscal year; `python3 open_budget_other.py`
+# runs them for the default year (see budget_config.py)
 
 ####################
 ## Setup
@@ -10,29 +13,22 @@
 # make sure to install these packages before running:
 # pip install pandas
 # pip install sodapy
+# pip install pyarrow
 
 import datetime
-import pandas as pd
-import credentials
-from sodapy import Socrata
-
-# set up Socrata client
-client = Socrata('data.lacity.org', None)
-
-# uncomment if you are going to log in / push to the data portal
-# username = credentials.lahub_user
-# password = credentials.lahub_pass
-# apptoken = credentials.lahub_auth
-# client = Socrata('data.lacity.org', apptoken, username=username, password=password)
-
-# csv sheet filenames
-csv_filenames = {
-    'gfrev': '../../data/approved_budget/FY21-22/General_Fund_Revenue_2122_Adopted.csv',
-    'positions': '../../data/approved_budget/FY21-22/Positions_2122_Adopted.csv',
-    'inc': '../../data/approved_budget/FY21-22/Budget_Requests_Detail_Sec2_2122_Adopted.csv',
-    'pm': '../../data/approved_budget/FY21-22/Performance_Measures_2122_Adopted.csv',
-}
-filepath_prefix = '../../data/approved_budget/FY21-22/'
+from budget_config import BudgetYear, datasets, default_data_root, default_fiscal_year, default_stage, socrata_client, \
+    socrata_dtypes
+from snapshot_cache import cached_fetch
+from socrata_sync import drop_system_fields
+from functools import partial
+from dataset_specs import read_dataset
+from data_quality import gate
+from dimensions import shared_vocabulary
+from pipeline_runner import Stage, run_stages
+from tracing import Tracer
+
+# the csv sheet filenames, the output filenames and the folder they are in come from the fiscal year
+# (see budget_config.BudgetYear)
 
 # # Socrata urls
 # urls = {
@@ -51,183 +47,92 @@ filepath_prefix = '../../data/approved_budget/FY21-22/'
 # }
 
 # Socrata identifiers
-identifiers = {
-    'gfrev': 'qrkr-kfbh',
-    'positions': '46qe-t7np',
-    'inc': 'k4k6-bwwv',
-    'pm': 'bywz-284j'
-}
+identifiers = {name: datasets[name]['identifier'] for name in ['gfrev', 'positions', 'inc', 'pm']}
 
 
 timestamp = datetime.datetime.now()
 
-####################
-## General fund revenue
-####################
-
-# Read the previous dataset from Socrata and save a local copy
-gfrev_existing = pd.DataFrame.from_records(client.get(identifiers.get('gfrev'), limit=99999999999999))
-gfrev_existing.to_csv(f'{filepath_prefix}old_gfrev_{timestamp}.csv', index=False)
-
-# Read the new file
-gfrev_current = pd.read_csv(csv_filenames.get('gfrev'))
-
-# Rename to match original
-gfrev_current.rename(columns={
-    'Dept Code': 'dept_code',
-    'Dept Name': 'department_name',
-    'Prog Code': 'program_code',
-    'Prog Name': 'program_name',
-    'Fund Code': 'fund_code',
-    'Fund Name': 'fund_name',
-    'Account Code': 'account_code',
-    'Account Name': 'account_name',
-    '2021-22 Adopted': 'revenue'
-}, inplace=True)
-
-# add a fiscal year column
-gfrev_current['fiscal_year'] = '2021_22_adopted'
-
-# filter out rows with no revenue
-gfrev_current.dropna(how='all', subset=['revenue'], inplace=True)
-
-# select only the relevant columns
-gfrev_current = gfrev_current[gfrev_existing.columns]
-
-# Make new dataset
-gfrev_new = pd.concat([gfrev_existing, gfrev_current], axis=0)
-gfrev_new.to_csv(f'{filepath_prefix}new_gfrev.csv', index=False)
-
-# upload the data to Socrata
-# client.replace(identifiers.get('gfrev'), gfrev_new)
-
-
-###################
-# Positions
-###################
-
-# Read the previous dataset from Socrata and save a local copy
-positions_existing = pd.DataFrame.from_records(client.get(identifiers.get('positions'), limit=99999999999999))
-positions_existing.to_csv(f'{filepath_prefix}old_positions_{timestamp}.csv', index=False)
-
-
-# Read the new file
-positions_current = pd.read_csv(csv_filenames.get('positions'))
-
-# Rename to match original
-positions_current.rename(columns={
-    'Dept Code': 'department_code',
-    'Dept Name': 'department_name',
-    'Prog Code': 'program_code',
-    'Prog Name': 'program_name',
-    'Fund Code': 'fund_code',
-    'Source Fund Code': 'source_fund_code',
-    'Source Fund Name': 'source_fund_name',
-    'Account Code': 'account_code',
-    'Account Name': 'account_name',
-    '2021-22 Adopted': 'positions'
-}, inplace=True)
-
-# add a budget column
-positions_current['budget'] = '2021-2022 Adopted Budget'
-
-
-# select only the relevant columns
-positions_current = positions_current[positions_existing.columns]
-
-# Make new dataset
-positions_new = pd.concat([positions_existing, positions_current], axis=0)
-positions_new.to_csv(f'{filepath_prefix}new_positions.csv', index=False)
-
-
-# upload the data to Socrata
-# client.replace(identifiers.get('positions'), positions_new)
-
-
-###################
-# Incremental changes
-###################
-
-# Read the previous dataset from Socrata and save a local copy
-inc_existing = pd.DataFrame.from_records(client.get(identifiers.get('inc'), limit=99999999999999))
-inc_existing.to_csv(f'{filepath_prefix}old_incremental_{timestamp}.csv', index=False)
-
-
-# Read the new file
-inc_current = pd.read_csv(csv_filenames.get('inc'))
-
-# Rename to match original
-inc_current.rename(columns={
-    'Department Code': 'department_code',
-    'Department Name': 'department_name',
-    'Program Code': 'program_code',
-    'Program Name': 'program_name',
-    'Fund Code': 'fund_code',
-    'Fund Name': 'fund_name',
-    'Source Fund Code': 'source_fund_code',
-    'Source Fund Name': 'source_fund_name',
-    'Budget Request Description': 'budget_request_description',
-    'Budget Request Category': 'budget_request_category',
-    'Budget Object Code': 'account_code',
-    'Audit Budget Object Name': 'account_name',
-    'One Time/ On-going': 'one_time_ongoing',
-    '2021-22 (Adopted) Incremental change from 2020-21 Adopted Budget': 'incremental_change'
-}, inplace=True)
-
-
-# add a fiscal year column
-inc_current['budget'] = '2021-22 Adopted Budget Incremental Change from 2020-21 Adopted'
-
-# select only the relevant columns
-inc_current = inc_current[inc_existing.columns]
-
-# Make new dataset
-inc_new = pd.concat([inc_existing, inc_current], axis=0)
-inc_new.to_csv(f'{filepath_prefix}new_incremental_changes.csv', index=False)
-
+# names of the local backups of the Socrata data
+backup_names = {
+    'gfrev': 'old_gfrev',
+    'positions': 'old_positions',
+    'inc': 'old_incremental',
+    'pm': 'old_performance',
+}
 
-# upload the data to Socrata
-# client.replace(identifiers.get('inc'), inc_new)
+# the columns of the new files and how they map to the Socrata datasets are declared in dataset_specs.py
 
 
 ####################
-## Performance Measures
+## Pipeline stages
 ####################
 
-# Read the previous dataset from Socrata and save a local copy
-pm_existing = pd.DataFrame.from_records(client.get(identifiers.get('pm'), limit=99999999999999))
-pm_existing.to_csv(f'{filepath_prefix}old_performance_{timestamp}.csv', index=False)
-
-
-# Read the new file
-pm_current = pd.read_csv(csv_filenames.get('pm'))
-
-# Rename to match original
-pm_current.rename(columns={
-    'Dept Code': 'department_code',
-    'Department Name': 'department_name',
-    'Org Level 5 Code': 'subdept_code',
-    'Org Level 5 Name': 'subdept_name',
-    'Prog Code': 'program_code',
-    'Program Name': 'program_name',
-    'PM Code': 'performance_measure_code',
-    'Performance Measure Name': 'performance_measure_name',
-    'Unit/Value': 'unit',
-    '2021-22 Adopted': 'performance_measure_amount'
-}, inplace=True)
-
-
-# add a fiscal year column
-pm_current['budget'] = '2021-22 Adopted'
-
-# select only the relevant columns
-pm_current = pm_current[pm_existing.columns]
-
-
-# Make new dataset
-pm_new = pd.concat([pm_existing, pm_current], axis=0)
-pm_new.to_csv(f'{filepath_prefix}new_performance_measures.csv', index=False)
-
-
-# upload the data to Socrata
-# client.replace(identifiers.get('pm'), pm_new)
+def fetch_existing(name, budget, client):
+    # Read the previous dataset from Socrata and save a local copy
+    socrata = cached_fetch(client, identifiers.get(name), cache_dir=budget.data_file('.socrata_cache/'),
+                           exclude_system_fields=False, dtypes=socrata_dtypes[identifiers.get(name)])
+    existing = drop_system_fields(socrata)
+    existing.to_csv(f'{budget.folder}{backup_names.get(name)}_{timestamp}.csv', index=False)
+    return socrata
+
+
+def read_current(name, budget):
+    # Read the new file: only the columns in the spec, renamed to match original, with a budget / fiscal year
+    # column added (and, for gfrev, the rows with no revenue filtered out)
+    return read_dataset(name, budget.input_file(name), budget.fiscal_year, budget.stage)
+
+
+def build_new(name, budget, socrata, current):
+    existing = drop_system_fields(socrata)
+
+    # select only the relevant columns
+    current = current[existing.columns]
+
+    # Make new dataset, with the name columns encoded over the vocabulary shared by every dataset (see dimensions.py),
+    # and check it before it is saved and uploaded (see data_quality.py)
+    vocabulary = shared_vocabulary(budget.data_file('dimension_vocabulary.json'))
+    new = vocabulary.concat([existing, current], axis=0)
+    vocabulary.save()
+    gate(new, name, fiscal_year=budget.fiscal_year, report_path=f'{budget.folder}quality_{name}.json')
+    new.to_csv(budget.output_file(name), index=False)
+
+    # upload the data to Socrata with `python3 labudget.py publish <name>`, which pushes only the inserted,
+    # changed and deleted rows (see publish.py), or replace the whole dataset:
+    # client.replace(identifiers.get(name), new)
+
+    # or, for the large datasets, in resumable chunks with `python3 labudget.py publish <name> --mode replace`
+    # (see socrata_upload.py)
+
+    return new
+
+
+def stages(names=('gfrev', 'positions', 'inc', 'pm'), fiscal_year=default_fiscal_year, data_root=default_data_root,
+           stage=default_stage, client=None):
+    # fetch and read are independent; build needs both. client is a sodapy client (a public one by default)
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    client = client or socrata_client()
+    out = []
+    for name in names:
+        out += [
+            Stage(f'{name}_fetch', partial(fetch_existing, name, budget, client)),
+            Stage(f'{name}_read', partial(read_current, name, budget)),
+            Stage(f'{name}_build', partial(build_new, name, budget), deps=[f'{name}_fetch', f'{name}_read']),
+        ]
+    return out
+
+
+def run(names=('gfrev', 'positions', 'inc', 'pm'), fiscal_year=default_fiscal_year, data_root=default_data_root,
+        stage=default_stage, client=None, chrome_trace=False):
+    """
+    Build the new files of the datasets for the fiscal year; returns {name: new dataset}. The
+    datasets are independent, so they are processed concurrently; every stage is traced to
+    trace_open_budget_other_<time>.json in the year's folder (see tracing.py).
+    """
+    tracer = Tracer('open_budget_other')
+    results, _ = run_stages(stages(names, fiscal_year, data_root, stage, client), tracer=tracer)
+    tracer.finish(BudgetYear(fiscal_year, data_root, stage).folder, chrome=chrome_trace)
+    return {name: results[f'{name}_build'] for name in names}
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# parquet_store.py
+# typed, compressed Parquet copies of the historical datasets under data/
+#
+# The history lives as CSV under data/approved_budget and data/proposed_budget, and every read
+# re-parses the text with inferred dtypes. Each dataset below is declared with an explicit
+# schema (codes and names as categoricals, amounts as float64) and converted once to Parquet,
+# partitioned by fiscal year. load() then reads only the requested columns and fiscal years.
+#
+# Usage (from scripts/python-scripts), to convert everything up front:
+#   python3 parquet_store.py
+# load() also converts a dataset on first use, and again whenever its source file changes. Every
+# function takes the data root the sources are under; the store is kept in its parquet/ folder.
+#
+# requires pyarrow: pip install pyarrow
+
+import os
+import re
+import shutil
+
+import pandas as pd
+
+# relative to scripts/python-scripts; the store of a data root is its parquet/ folder
+data_root = '../../data/'
+store_root = os.path.join(data_root, 'parquet', '')
+
+# column names are normalized (see normalize_column) before the schema is applied
+code = 'category'
+name = 'category'
+text = 'string'
+amount = 'float64'
+
+# the declared datasets: the source file under data/, the schema, and the column the fiscal year
+# is derived from (None for datasets that aren't split by year)
+datasets = {
+    'appropriations': {
+        'source': 'proposed_budget/FY18-19/old_expenses2.csv',
+        'year_column': 'fiscal_year',
+        'schema': {
+            'dept_code': code, 'department_name': name, 'subdept_code': code, 'subdepartment_name': name,
+            'prog_code': code, 'program_name': name, 'program_priority': name,
+            'source_fund_code': code, 'source_fund_name': name, 'account_code': code, 'account_name': name,
+            'appropriation': amount, 'expense_type': name,
+        },
+    },
+    'budget_long': {
+        'source': 'approved_budget/FY17-18/final_budget_la_2014_2018_long.csv',
+        'year_column': 'budget_year',
+        'schema': {
+            'dept_code': code, 'dept_name': name, 'prog_code': code, 'prog_name': name,
+            'fund_code': code, 'fund_name': name, 'account_code': code, 'account_name': name,
+            'new_key': code, 'budget_year': name, 'budget_amount': amount,
+        },
+    },
+    'actuals_long': {
+        'source': 'approved_budget/FY17-18/final_actuals_budget_la_2014_2018_long.csv',
+        'year_column': 'budget_year',
+        'schema': {
+            'dept_code': code, 'dept_name': name, 'prog_code': code, 'prog_name': name,
+            'fund_code': code, 'fund_name': name, 'account_code': code, 'account_name': name,
+            'new_key': code, 'budget_year': name, 'revenue_amount': amount,
+        },
+    },
+    'revenues': {
+        'source': 'approved_budget/FY18-19/revenues.csv',
+        'year_column': 'fiscal_year_shorthand',
+        'rename': {'fiscal_year': 'fiscal_year_label'},
+        'schema': {
+            'revenue_source': name, 'amount': amount, 'fund_type': name, 'fiscal_year_label': name,
+        },
+    },
+    'gfrev': {
+        'source': 'approved_budget/FY18-19/old_gfrev_2018-06-26_10.58.19.csv',
+        'year_column': 'budget',
+        'rename': {'fiscal_year': 'budget'},
+        'schema': {
+            'dept_code': code, 'department_name': name, 'program_code': code, 'program_name': name,
+            'fund_code': code, 'fund_name': name, 'account_code': code, 'account_name': name,
+            'budget': name, 'revenue_amount': amount,
+        },
+    },
+    'positions': {
+        'source': 'approved_budget/FY18-19/positions_new.csv',
+        'year_column': 'budget',
+        'schema': {
+            'department_code': code, 'department_name': name, 'program_code': code, 'program_name': name,
+            'fund_code': code, 'source_fund_code': code, 'source_fund_name': name,
+            'account_code': code, 'account_name': name, 'budget': name, 'positions': amount,
+        },
+    },
+    'performance_measures': {
+        'source': 'approved_budget/FY18-19/pm_new.csv',
+        'year_column': 'budget',
+        'schema': {
+            'department_code': code, 'department_name': name, 'subdept_code': code, 'subdept_name': name,
+            'program_code': code, 'program_name': name,
+            'performance_measure_code': code, 'performance_measure_name': name, 'unit': name,
+            'budget': name, 'performance_measure_amount': amount,
+        },
+    },
+    'incremental_changes': {
+        'source': 'approved_budget/FY18-19/old_increments_2018-06-26_11.50.02.csv',
+        'year_column': 'budget',
+        'rename': {'one_time_01_on_going_bb': 'one_time_ongoing'},
+        'schema': {
+            'department_code': code, 'department_name': name, 'program_code': code, 'program_name': name,
+            'fund_code': code, 'fund_name': name, 'source_fund_code': code, 'source_fund_name': name,
+            'budget_request_description': text, 'budget_request_category': name,
+            'account_code': code, 'account_name': name, 'one_time_ongoing': name,
+            'budget': name, 'incremental_change': amount,
+        },
+    },
+    'program_priorities': {
+        'source': 'approved_budget/FY18-19/program_priorities.csv',
+        'year_column': None,
+        'schema': {
+            'prog_code': code, 'program_name': name, 'program_priority': name,
+        },
+    },
+}
+
+
+def normalize_column(column):
+    # 'Dept_Code', 'Dept.Code' and 'Dept Code' all become 'dept_code'
+    column = re.sub(r'[^0-9a-z]+', '_', column.strip().lstrip('﻿').lower())
+    return column.strip('_')
+
+
+def fiscal_year_of(labels):
+    """
+    The fiscal year (as the year it ends in) of labels like 2018, '2017-18 Adopted Budget',
+    '2017_18_adopted' or '2017-2018'.
+    """
+    labels = labels.astype(str)
+    span = labels.str.extract(r'(\d{4})\s*[-_]\s*(\d{2,4})')
+    start = pd.to_numeric(span[0], errors='coerce')
+    year = (start + 1).where(span[0].notna(), pd.to_numeric(labels.str.extract(r'(\d{4})')[0], errors='coerce'))
+    return year.astype('Int64')
+
+
+def apply_schema(df, schema):
+    """Cast the columns of df to the declared dtypes; undeclared columns are kept as strings."""
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype == amount:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def _store_path(dataset, data_root=data_root):
+    return os.path.join(data_root, 'parquet', dataset)
+
+
+def _marker_path(dataset, data_root=data_root):
+    # written after a successful conversion; its mtime tells whether the source changed since
+    return os.path.join(_store_path(dataset, data_root), '_converted')
+
+
+def convert(dataset, data_root=data_root):
+    """Convert one declared dataset under the data root to Parquet and return the path of the store."""
+    spec = datasets[dataset]
+    source = os.path.join(data_root, spec['source'])
+
+    df = pd.read_csv(source, dtype=str, encoding='utf-8-sig')
+    df.columns = [normalize_column(c) for c in df.columns]
+    df.rename(columns=spec.get('rename', {}), inplace=True)
+    df = apply_schema(df, spec['schema'])
+
+    path = _store_path(dataset, data_root)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    year_column = spec['year_column']
+    if year_column is None:
+        df.to_parquet(os.path.join(path, 'data.parquet'), index=False, compression='zstd')
+    else:
+        # the fiscal year derived from year_column is the partition column
+        df['fiscal_year'] = fiscal_year_of(df[year_column]).fillna(0).astype('int64')
+        df.to_parquet(path, index=False, partition_cols=['fiscal_year'], compression='zstd')
+
+    open(_marker_path(dataset, data_root), 'w').close()
+    print(f'{dataset}: converted {len(df)} rows from {source}')
+    return path
+
+
+def is_stale(dataset, data_root=data_root):
+    marker = _marker_path(dataset, data_root)
+    source = os.path.join(data_root, datasets[dataset]['source'])
+    return not os.path.exists(marker) or os.path.getmtime(source) > os.path.getmtime(marker)
+
+
+def load(dataset, columns=None, fiscal_years=None, data_root=data_root):
+    """
+    Read a declared dataset from the Parquet store of the data root, converting it first if needed.
+
+    columns limits the columns that are read; fiscal_years (e.g. [2017, 2018]) limits the
+    partitions that are read, for the datasets that are split by fiscal year.
+    """
+    if is_stale(dataset, data_root):
+        convert(dataset, data_root)
+
+    path = _store_path(dataset, data_root)
+    if datasets[dataset]['year_column'] is None:
+        return pd.read_parquet(os.path.join(path, 'data.parquet'), columns=columns)
+
+    filters = [('fiscal_year', 'in', [int(y) for y in fiscal_years])] if fiscal_years is not None else None
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    if 'fiscal_year' in df.columns:
+        # partition values come back as a categorical
+        df['fiscal_year'] = df['fiscal_year'].astype(int)
+    return df
+
+
+if __name__ == '__main__':
+    for dataset in datasets:
+        convert(dataset)
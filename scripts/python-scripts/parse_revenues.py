@@ -1,125 +1,51 @@
 # parse_revenues.py
+# convert the revenue tables of one Exhibit B PDF to the two csv files read by revenue.py:
+# new_revenues.csv (general and special fund receipts) and available_balances.csv
+#
+# the parsing itself is done in revenue_parser.py, which can also parse every Exhibit B PDF
+# under data/ at once: python3 revenue_parser.py
 
 # import libraries
 
-# for changing working directory
-import os
-# for reading PDF text
-import PyPDF2
-# for regular expression matching
-import re
-
-# set directory
-# os.chdir('/Users/adamscherling/github/laBudget/data/approved_budget/FY18-19')
-
-# pull text from pdf file
-pdfFileObject = open('../../data/approved_budget/FY18-19/05-Exhibit B 22A.pdf', 'rb')
-pdfReader = PyPDF2.PdfFileReader(pdfFileObject)
-
-# combine text from all pages into a single string
-count = pdfReader.numPages
-pdfText = ''
-for i in range(count):
-    page = pdfReader.getPage(i)
-    pdfText = pdfText + page.extractText()
-
-# remove gratuitous newline characters, commas, $, %
-pdfText = pdfText.replace('\n', '')
-pdfText = pdfText.replace(',', '')
-pdfText = pdfText.replace('$', '')
-pdfText = pdfText.replace('%', '')
-
-# pick out the text for General Receipts, Special Receipts, and Available Balances
-start = pdfText.find("General Receipts:")
-# end = pdfText.find("Available Balances:")
-pdfText = pdfText[start:]
-
-end = pdfText.find("Total General Receipts")
-GF_receipts = pdfText[17:end]
-
-start = pdfText.find("Special Receipts:")
-end = pdfText.find("Total Special Receipts...")
-SF_receipts = pdfText[(start+17):end]
-
-start = pdfText.find("Available Balances:")
-end = pdfText.find("Total Available Balances...")
-SF_balances = pdfText[(start+19):end]
-
-# close the file
-pdfFileObject.close()
-
-# print the current text
-print(GF_receipts)
-print('***')
-print(SF_receipts)
-print('***')
-print(SF_balances)
-
-
-# remove column titles
-colTitles = re.compile(r'EXHIBIT B|BUDGET SUMMARY|RECEIPTS| of Total| ofTotal|Total')
-GF_receipts = colTitles.sub('', GF_receipts)
-SF_receipts = colTitles.sub('', SF_receipts)
-SF_balances = colTitles.sub('', SF_balances)
-
-# convert double hyphens after a period to a zero
-doubleHyphen = re.compile(r'\.--')
-GF_receipts = doubleHyphen.sub('0', GF_receipts)
-SF_receipts = doubleHyphen.sub('0', SF_receipts)
-SF_balances = doubleHyphen.sub('0', SF_balances)
-
-# remove the dots
-# https://stackoverflow.com/questions/14488557/remove-consecutive-dotsperiods-from-a-string
-consecutivedots = re.compile(r'\.{3,}')
-GF_receipts = consecutivedots.sub(',', GF_receipts)
-SF_receipts = consecutivedots.sub(',', SF_receipts)
-SF_balances = consecutivedots.sub(',', SF_balances)
-
-# convert space between numbers to commas
-spaceBetweenNumbers = re.compile(r'(\d)(\ {1,})(\d)')
-GF_receipts = spaceBetweenNumbers.sub(r'\1,\3', GF_receipts)
-SF_receipts = spaceBetweenNumbers.sub(r'\1,\3', SF_receipts)
-SF_balances = spaceBetweenNumbers.sub(r'\1,\3', SF_balances)
-
-# insert newlines wherever a digit meets a letter
-digitMeetsLetter = re.compile(r'(\d)([A-Z])')
-GF_receipts = digitMeetsLetter.sub(r'\1\n\2', GF_receipts)
-SF_receipts = digitMeetsLetter.sub(r'\1\n\2', SF_receipts)
-SF_balances = digitMeetsLetter.sub(r'\1\n\2', SF_balances)
-
-# remove spaces before commas
-spaceBeforeComma = re.compile(r'\ ,')
-GF_receipts = spaceBeforeComma.sub(',', GF_receipts)
-SF_receipts = spaceBeforeComma.sub(',', SF_receipts)
-SF_balances = spaceBeforeComma.sub(',', SF_balances)
-
-# print the result
-print(GF_receipts)
-print('***')
-print(SF_receipts)
-print('***')
-print(SF_balances)
-
-# add a newline to the end of each
-GF_receipts = GF_receipts + '\n'
-SF_receipts = SF_receipts + '\n'
-
-# add fund type to receipts data
-endOfLine = re.compile(r'\n')
-GF_receipts = endOfLine.sub(',General Fund\n', GF_receipts)
-SF_receipts = endOfLine.sub(',Special Fund\n', SF_receipts)
-
-# write the files to CSV
-rev = open('../../new_revenues.csv', 'w')
-rev.write('Revenue.Source,Amount,Percent,Fund.Type\n')
-rev.write(GF_receipts)
-rev.write(SF_receipts)
-rev.close()
-
-bal = open('../../available_balances.csv', 'w')
-bal.write('Revenue.Source,Available.Balance,Percent\n')
-bal.write(SF_balances)
-bal.close()
-
-
-
+# for parsing the PDF
+from revenue_parser import parse_exhibit_b, write_revenue_csvs
+from budget_config import BudgetYear, default_data_root, default_fiscal_year, default_stage
+from data_quality import gate
+from tracing import Tracer
+
+
+def run(fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage, pdf_filename=None,
+        chrome_trace=False):
+    """
+    Parse the year's Exhibit B (e.g. '05-Exhibit B 22A.pdf' in the year's folder, or pdf_filename)
+    and write the csv files next to it; returns the parsed lines. The stages are traced to
+    trace_parse_revenues_<time>.json (see tracing.py).
+    """
+    # the PDF to parse, and where to write the csv files
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    pdf_filename = pdf_filename or budget.input_file('exhibit_b')
+    filepath_prefix = budget.folder
+    tracer = Tracer('parse_revenues')
+
+    # pull the revenue lines out of the pdf, one page at a time
+    with tracer.stage('parse pdf') as span:
+        records = parse_exhibit_b(pdf_filename)
+        span.rows_out = records
+
+    # print the result
+    for fund_type, section in records.groupby('fund_type', sort=False):
+        print(section.to_string(index=False))
+        print('***')
+
+    # check that the lines of each section add up to its total (see data_quality.py), then write the files to CSV
+    with tracer.stage('quality gate'):
+        gate(records, 'exhibit_b')
+    with tracer.stage('write csv', rows_in=records):
+        write_revenue_csvs(records, filepath_prefix)
+
+    tracer.finish(filepath_prefix, chrome=chrome_trace)
+    return records
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# pipeline_runner.py
+# run the budget pipelines as a DAG of stages, with independent stages running concurrently
+#
+# open_budget_other.py used to handle gfrev, positions, incremental changes and performance
+# measures one after another, and the other scripts were run separately by hand. The pipelines
+# are independent, so this runner declares each dataset's stages (fetch, read, build, ...) with
+# their dependencies and runs every stage as soon as its inputs are ready. The whole refresh
+# then takes roughly as long as its slowest dataset instead of the sum of all of them.
+#
+# Usage (from scripts/python-scripts):
+#   python3 pipeline_runner.py
+#
+# With a tracing.Tracer, every thread stage is also traced (time, memory, rows in and out); the
+# process stages are the run() functions of the other pipelines, which write their own traces.
+
+import importlib
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+
+from budget_config import BudgetYear, default_data_root, default_fiscal_year, default_stage
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    func is called with the results of the stages named in deps, in that order. Stages with
+    kind='thread' share the runner's thread pool (network and pandas I/O release the GIL);
+    kind='process' stages run in a process pool, so their func and arguments must be picklable.
+    """
+
+    def __init__(self, name, func, deps=(), kind='thread'):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.kind = kind
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, deps={self.deps}, kind={self.kind!r})'
+
+
+def _check_dag(stages):
+    # every dependency must exist, names must be unique and there must be no cycles
+    names = [s.name for s in stages]
+    duplicates = {n for n in names if names.count(n) > 1}
+    if duplicates:
+        raise ValueError(f'duplicate stage names: {sorted(duplicates)}')
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        unknown = [d for d in s.deps if d not in by_name]
+        if unknown:
+            raise ValueError(f'stage {s.name!r} depends on unknown stages {unknown}')
+
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f'dependency cycle through stage {name!r}')
+        visiting.add(name)
+        for d in by_name[name].deps:
+            visit(d)
+        visiting.discard(name)
+        visited.add(name)
+
+    for s in stages:
+        visit(s.name)
+
+
+def _run_traced(tracer, name, func, *args):
+    # the row counts are those of the frames going in and of the result
+    frames = [a for a in args if hasattr(a, 'shape')]
+    rows_in = sum(len(a) for a in frames) if frames else None
+    with tracer.stage(name, rows_in=rows_in) as span:
+        result = func(*args)
+        if hasattr(result, 'shape'):
+            span.rows_out = result
+    return result
+
+
+def run_stages(stages, threads=8, processes=None, report=True, tracer=None):
+    """
+    Run the stages, each as soon as all of its dependencies have finished.
+
+    Returns (results, timings): the return value of every stage and its (start, end) times in
+    seconds since the run began. If a stage raises, no new stages are started and the exception
+    is re-raised once the running stages have finished. The thread stages are traced in tracer
+    (a tracing.Tracer), if given.
+    """
+    _check_dag(stages)
+    pending = {s.name: s for s in stages}
+    results = {}
+    timings = {}
+    running = {}
+    error = None
+    run_start = time.perf_counter()
+
+    thread_pool = ThreadPoolExecutor(max_workers=threads)
+    process_pool = None
+    if any(s.kind == 'process' for s in stages):
+        process_pool = ProcessPoolExecutor(max_workers=processes)
+
+    try:
+        while pending or running:
+            # start everything whose dependencies are done
+            if error is None:
+                for name, stage in list(pending.items()):
+                    if all(d in results for d in stage.deps):
+                        pool = process_pool if stage.kind == 'process' else thread_pool
+                        args = [results[d] for d in stage.deps]
+                        timings[name] = [time.perf_counter() - run_start, None]
+                        if tracer is not None and stage.kind == 'thread':
+                            future = pool.submit(_run_traced, tracer, name, stage.func, *args)
+                        else:
+                            future = pool.submit(stage.func, *args)
+                        running[future] = name
+                        del pending[name]
+            else:
+                pending.clear()
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                timings[name][1] = time.perf_counter() - run_start
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f'stage {name!r} failed: {e!r}')
+                    error = error or e
+    finally:
+        thread_pool.shutdown()
+        if process_pool is not None:
+            process_pool.shutdown()
+
+    timings = {name: tuple(t) for name, t in timings.items()}
+    if report:
+        print_report(timings, time.perf_counter() - run_start)
+    if error is not None:
+        raise error
+    return results, timings
+
+
+def print_report(timings, total):
+    """Print the wall time of every stage, in the order the stages started."""
+    print(f'{"stage":<32} {"start":>8} {"end":>8} {"wall (s)":>9}')
+    for name, (start, end) in sorted(timings.items(), key=lambda item: item[1][0]):
+        if end is None:
+            print(f'{name:<32} {start:>8.2f} {"-":>8} {"-":>9}')
+        else:
+            print(f'{name:<32} {start:>8.2f} {end:>8.2f} {end - start:>9.2f}')
+    print(f'{"total":<32} {"":>8} {"":>8} {total:>9.2f}')
+
+
+def run_pipeline(module, **options):
+    """Run the run() function of one of the pipeline modules (used as a process stage)."""
+    importlib.import_module(module).run(**options)
+    # the result stays in the worker process; the outputs are on disk
+
+
+def _after(func, *results):
+    # call func without the results of the stages it waited for
+    return func()
+
+
+def annual_refresh_stages(fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage):
+    """
+    The stages of the full annual refresh of a fiscal year: every dataset of every pipeline. The
+    Socrata snapshots of all the datasets are brought up to date first, concurrently (see
+    socrata_async.py), and the fetch stages then read them from the cache.
+    """
+    import open_budget_other
+    from socrata_async import prefetch
+
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    options = {'fiscal_year': fiscal_year, 'data_root': data_root, 'stage': stage}
+
+    stages = [Stage('socrata_prefetch', partial(prefetch, cache_dir=budget.data_file('.socrata_cache/')))]
+    for step in open_budget_other.stages(**options):
+        if step.name.endswith('_fetch'):
+            step = Stage(step.name, partial(_after, step.func), deps=['socrata_prefetch'], kind=step.kind)
+        stages.append(step)
+    # expenses reads the program priority index after the descriptions pipeline has added the year's priorities,
+    # rather than racing it to save the index
+    deps = {'expenses': ['socrata_prefetch', 'department_and_program_descriptions']}
+    for module in ['department_and_program_descriptions', 'expenses', 'revenue']:
+        stages.append(Stage(module, partial(_after, partial(run_pipeline, module, **options)),
+                            deps=deps.get(module, ['socrata_prefetch']), kind='process'))
+    return stages
+
+
+def run(fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage, chrome_trace=False):
+    """Run the full annual refresh; the stages are traced to trace_annual_refresh_<time>.json."""
+    from tracing import Tracer
+
+    tracer = Tracer('annual_refresh')
+    results, timings = run_stages(annual_refresh_stages(fiscal_year, data_root, stage), tracer=tracer)
+    tracer.finish(BudgetYear(fiscal_year, data_root, stage).folder, chrome=chrome_trace)
+    return results, timings
+
+
+if __name__ == '__main__':
+    run()
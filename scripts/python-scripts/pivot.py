@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# pivot.py
+# convert the budget/actuals history tables between the long and the fiscal-year-wide layout
+#
+# final_budget_la_2014_2018_long.csv has one row per (department, program, fund, account) and
+# budget year; the _wide.csv files have one row per (department, program, fund, account) and
+# one column per budget year. to_wide() and to_long() convert between the two without
+# pivot_table: every row gets an integer code for its key and its budget year (hashed group
+# codes), and the values are scattered into / gathered from a 2-D array with those codes.
+#
+# Most (key, year) cells are empty, so to_wide(sparse=True) returns sparse year columns.
+# pivot_file() pivots a csv file larger than memory: the rows are first spilled to a few
+# bucket files by department, then each bucket (which holds whole departments) is pivoted on
+# its own and appended to the output.
+#
+# Usage (from scripts/python-scripts):
+#   python3 pivot.py wide final_budget_la_2014_2018_long.csv budget_wide.csv
+#   python3 pivot.py long final_budget_la_2014_2018_wide.csv budget_long.csv --value-name budget_amount
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# the key of a row in the history tables
+id_columns = ['dept_code', 'dept_name', 'prog_code', 'prog_name', 'fund_code', 'fund_name',
+              'account_code', 'account_name', 'new_key']
+
+# the column holding the budget year in the long tables
+year_column = 'budget_year'
+
+
+def _value_column(long, index, columns):
+    # the one column that is neither part of the key nor the year
+    rest = [c for c in long.columns if c not in index and c != columns]
+    if len(rest) != 1:
+        raise ValueError(f'expected one value column besides {index} and {columns!r}, found {rest}')
+    return rest[0]
+
+
+def to_wide(long, index=id_columns, columns=year_column, values=None, sparse=False, column_order=None):
+    """
+    Pivot a long table to one row per key (index) and one column per value of columns.
+
+    values defaults to the only remaining column. Keys and year columns keep the order in which
+    they first appear (column_order gives the year columns explicitly). Raises ValueError if a
+    (key, year) pair occurs twice.
+    """
+    values = values or _value_column(long, index, columns)
+
+    # integer codes of the keys and the years
+    row_codes = long.groupby(index, sort=False, dropna=False).ngroup().to_numpy()
+    year_labels = long[columns]
+    if column_order is None:
+        column_codes, column_order = pd.factorize(year_labels)
+        column_order = list(column_order)
+    else:
+        column_codes = pd.Index(column_order).get_indexer(year_labels)
+        if (column_codes < 0).any():
+            raise ValueError(f'{columns} has values that are not in column_order')
+
+    n_rows, n_columns = int(row_codes.max()) + 1 if len(row_codes) else 0, len(column_order)
+    cells = row_codes.astype(np.int64) * n_columns + column_codes
+    if pd.Series(cells).duplicated().any():
+        raise ValueError(f'some keys have more than one row for the same {columns}')
+
+    # the key of every output row, from its first occurrence
+    first = np.full(n_rows, len(long), dtype=np.int64)
+    np.minimum.at(first, row_codes, np.arange(len(long)))
+    wide = long[index].iloc[first].reset_index(drop=True)
+
+    amounts = long[values].to_numpy(dtype='float64')
+    if sparse:
+        # one dense column at a time, so only the sparse result has to fit in memory
+        for code, label in enumerate(column_order):
+            in_column = column_codes == code
+            column = np.full(n_rows, np.nan)
+            column[row_codes[in_column]] = amounts[in_column]
+            wide[label] = pd.arrays.SparseArray(column, fill_value=np.nan)
+    else:
+        grid = np.full((n_rows, n_columns), np.nan)
+        grid[row_codes, column_codes] = amounts
+        wide = pd.concat([wide, pd.DataFrame(grid, columns=column_order)], axis=1)
+    return wide
+
+
+def to_long(wide, index=id_columns, var_name=year_column, value_name='budget_amount', dropna=False):
+    """
+    Unpivot a wide table: one row per key and year column, years in column order.
+
+    With dropna=True the empty cells are left out.
+    """
+    year_columns = [c for c in wide.columns if c not in index]
+    n_rows, n_years = len(wide), len(year_columns)
+
+    # year-major order, as in the long files: every key for the first year, then the second, ...
+    keys = np.tile(np.arange(n_rows), n_years)
+    years = np.repeat(np.arange(n_years), n_rows)
+    amounts = np.concatenate([np.asarray(wide[c], dtype='float64') for c in year_columns]) if n_years else np.empty(0)
+    if dropna:
+        keep = ~np.isnan(amounts)
+        keys, years, amounts = keys[keep], years[keep], amounts[keep]
+
+    long = wide[index].iloc[keys].reset_index(drop=True)
+    long[var_name] = np.asarray(year_columns, dtype=object)[years]
+    long[value_name] = amounts
+    return long
+
+
+def _bucket(departments, n_buckets):
+    # stable across processes (unlike hash()), so a department always lands in the same bucket
+    return departments.fillna('').map(lambda d: zlib.crc32(d.encode()) % n_buckets)
+
+
+def _read(filename, index, **options):
+    # keys as text, so codes keep their leading zeros ('02')
+    return pd.read_csv(filename, dtype={c: str for c in index}, **options)
+
+
+def pivot_file(source, target, direction='wide', index=id_columns, by='dept_code', chunksize=200_000,
+               n_buckets=16, value_name='budget_amount'):
+    """
+    Pivot the csv file source to target without reading it into memory at once.
+
+    direction 'wide' spills the long rows to n_buckets files by the by column, then pivots each
+    bucket; direction 'long' unpivots chunk by chunk. Returns the number of rows written.
+    """
+    written = 0
+    header = True
+    if direction == 'long':
+        for chunk in _read(source, index, chunksize=chunksize):
+            long = to_long(chunk, index, value_name=value_name)
+            long.to_csv(target, index=False, header=header, mode='w' if header else 'a')
+            header = False
+            written += len(long)
+        return written
+
+    spill_dir = tempfile.mkdtemp(prefix='pivot_')
+    try:
+        # pass 1: spill the rows by department, and collect the year columns in order
+        column_order = []
+        seen = set()
+        for chunk in _read(source, index, chunksize=chunksize):
+            for label in pd.unique(chunk[year_column]):
+                if label not in seen:
+                    seen.add(label)
+                    column_order.append(label)
+            for bucket, rows in chunk.groupby(_bucket(chunk[by], n_buckets)):
+                path = os.path.join(spill_dir, f'{bucket}.csv')
+                rows.to_csv(path, index=False, header=not os.path.exists(path), mode='a')
+
+        # pass 2: each bucket holds whole departments, so it can be pivoted on its own
+        for bucket in range(n_buckets):
+            path = os.path.join(spill_dir, f'{bucket}.csv')
+            if not os.path.exists(path):
+                continue
+            wide = to_wide(_read(path, index), index, column_order=column_order)
+            wide.to_csv(target, index=False, header=header, mode='w' if header else 'a')
+            header = False
+            written += len(wide)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pivot a budget history table between the long and wide layouts.')
+    parser.add_argument('direction', choices=['wide', 'long'], help='layout to convert to')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--value-name', default='budget_amount', help="value column of the long table (e.g. 'revenue_amount')")
+    parser.add_argument('--chunksize', type=int, default=200_000)
+    parser.add_argument('--buckets', type=int, default=16, help='number of spill files when converting to wide')
+    args = parser.parse_args(argv)
+    rows = pivot_file(args.source, args.target, args.direction, chunksize=args.chunksize,
+                      n_buckets=args.buckets, value_name=args.value_name)
+    print(f'{args.target}: {rows:,} rows')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
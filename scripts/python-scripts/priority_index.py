@@ -0,0 +1,145 @@
+# priority_index.py
+# maintained index of program priorities, keyed on (dept_code, prog_code)
+#
+# expenses.py used to rebuild the program priorities from scratch every year by merging the old
+# Socrata rows and a program_priorities.csv into the new expenses. This module keeps one index
+# file instead, recording for every (dept_code, prog_code) the priority, where it came from and
+# how much that source is trusted. The index is updated whenever a source produces priorities
+# (e.g. department_and_program_descriptions.py writing new_program_priorities.csv), and applied
+# to new expenses with hashed lookups on the codes.
+#
+# The description files only know the program number, so their entries have a blank dept_code
+# and apply to that program in any department. When both kinds of entry exist for a row, the
+# one with the higher precedence wins.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# where the index is kept, relative to scripts/python-scripts
+default_index_path = '../../data/program_priority_index.csv'
+
+# precedence of the sources: the descriptions are preferred over the old Socrata rows
+socrata_precedence = 1
+descriptions_precedence = 2
+
+index_columns = ['dept_code', 'prog_code', 'program_priority', 'source', 'precedence']
+
+# label used for the rows that have no priority
+not_categorized = 'Not Categorized'
+
+
+def normalize_codes(codes):
+    # '0201', '201' and 201 are the same program; non-numeric codes ('16A', 'JOBLVL4') are kept as text
+    codes = codes.astype(object).where(codes.notna(), '').astype(str).str.strip().str.upper()
+    codes = codes.str.replace(r'\.0$', '', regex=True)
+    digits = codes.str.fullmatch(r'\d+')
+    return codes.where(~digits, codes.str.lstrip('0').replace('', '0'))
+
+
+def load_index(path=default_index_path):
+    """Read the index, or return an empty one if it doesn't exist yet."""
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=index_columns)
+    return pd.read_csv(path, dtype={'dept_code': str, 'prog_code': str}, keep_default_na=False)
+
+
+def save_index(index, path=default_index_path):
+    index.sort_values(['prog_code', 'dept_code']).to_csv(path, index=False)
+
+
+def update_index(index, priorities, source, precedence):
+    """
+    Add the priorities of one source to the index.
+
+    priorities needs prog_code and program_priority columns, and optionally dept_code. An entry
+    replaces an existing one with the same codes if its precedence is at least as high.
+    """
+    entries = pd.DataFrame({
+        'dept_code': normalize_codes(priorities['dept_code']) if 'dept_code' in priorities.columns else '',
+        'prog_code': normalize_codes(priorities['prog_code']),
+        'program_priority': priorities['program_priority'].astype(object).fillna('').astype(str).str.strip(),
+    })
+    entries = entries[(entries['prog_code'] != '') &
+                      (entries['program_priority'] != '') &
+                      (entries['program_priority'] != not_categorized)]
+    entries = entries.drop_duplicates(subset=['dept_code', 'prog_code'], keep='first')
+    entries['source'] = source
+    entries['precedence'] = precedence
+
+    # on equal precedence the newer entry wins, hence the stable sort with the new entries last
+    combined = pd.concat([index[index_columns], entries[index_columns]], axis=0, ignore_index=True)
+    combined['precedence'] = combined['precedence'].astype(int)
+    combined = combined.sort_values('precedence', kind='stable')
+    combined = combined.drop_duplicates(subset=['dept_code', 'prog_code'], keep='last')
+    return combined.reset_index(drop=True)
+
+
+def _lookup(index, dept_codes, prog_codes):
+    # positions in the index of the (dept_code, prog_code) keys, -1 where there is no entry
+    keys = pd.Index(index['dept_code'] + '|' + index['prog_code'])
+    return keys.get_indexer(dept_codes + '|' + prog_codes)
+
+
+def _lookup_entities(index, expenses, crosswalk):
+    # positions in the index of the best entry for the same program entity (see crosswalk.py), -1
+    # where there is none; this finds the entries of programs whose codes changed since
+    names = expenses['program_name'] if 'program_name' in expenses.columns else None
+    row_ids = crosswalk.program_ids(expenses['dept_code'], expenses['prog_code'], names)
+    entries = pd.DataFrame({
+        'id': crosswalk.program_ids(index['dept_code'], index['prog_code']),
+        'precedence': index['precedence'].astype(int).to_numpy(),
+        'position': np.arange(len(index)),
+    })
+    entries = entries[entries['id'] != ''].sort_values('precedence', kind='stable').drop_duplicates('id', keep='last')
+    position = pd.Index(entries['id']).get_indexer(row_ids)
+    return np.where((position >= 0) & (row_ids != ''), entries['position'].to_numpy()[position], -1)
+
+
+def assign_priorities(expenses, index, report=True, crosswalk=None):
+    """
+    Look up the program priority of every row of expenses (which needs dept_code and prog_code).
+
+    Returns the priorities as a series aligned with expenses; rows without an entry in the index
+    get 'Not Categorized'. Given a crosswalk.Crosswalk, rows without an entry for their codes get
+    the entry of the same program under its other codes. With report=True, prints how many rows
+    came from each source.
+    """
+    dept_codes = normalize_codes(expenses['dept_code']).to_numpy(dtype=object)
+    prog_codes = normalize_codes(expenses['prog_code']).to_numpy(dtype=object)
+
+    exact = _lookup(index, dept_codes, prog_codes)
+    program_only = _lookup(index, np.full(len(expenses), '', dtype=object), prog_codes)
+
+    precedence = index['precedence'].astype(int).to_numpy()
+    exact_precedence = np.where(exact >= 0, precedence[exact], -1)
+    program_precedence = np.where(program_only >= 0, precedence[program_only], -1)
+    position = np.where(program_precedence > exact_precedence, program_only, exact)
+
+    found = position >= 0
+    through_crosswalk = np.zeros(len(expenses), dtype=bool)
+    if crosswalk is not None and not found.all():
+        position = np.where(found, position, _lookup_entities(index, expenses, crosswalk))
+        through_crosswalk = ~found & (position >= 0)
+        found = position >= 0
+
+    priorities = np.full(len(expenses), not_categorized, dtype=object)
+    sources = np.full(len(expenses), not_categorized, dtype=object)
+    priorities[found] = index['program_priority'].to_numpy(dtype=object)[position[found]]
+    sources[found] = index['source'].to_numpy(dtype=object)[position[found]]
+    sources[through_crosswalk] = sources[through_crosswalk] + ' (crosswalk)'
+
+    if report:
+        coverage_report(sources)
+    return pd.Series(priorities, index=expenses.index, name='program_priority')
+
+
+def coverage_report(sources):
+    """Print and return the number of rows whose priority came from each source."""
+    counts = pd.Series(sources).value_counts()
+    total = int(counts.sum())
+    print('program priority coverage:')
+    for source, n in counts.items():
+        print(f'  {source:<50} {n:>8} ({n / total:.1%})' if total else f'  {source}')
+    return counts.to_dict()
@@ -0,0 +1,73 @@
+# priority_outcomes.py
+# separate the priority outcomes from the program descriptions
+#
+# Many program descriptions start with a line like
+#   "Priority Outcome: Create a more livable and sustainable city"
+# which should be removed from the description, but kept to label the priority of the programs
+# in the expenses data. This is done over the whole description column at once -- one regex
+# extract plus a keyword -> outcome table -- so it works the same on one year of descriptions
+# or on the descriptions of every fiscal year stacked together.
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# "Priority Outcome:" or "Priority Outcomes:" on the first line, followed by the description
+priority_pattern = re.compile(
+    r'^Priority Outcomes?:(?P<priority>[^\r\n]*)(?P<description>.*)$',
+    re.DOTALL,
+)
+
+# keywords in the priority outcome text and the language used in the expenses data.
+# the order matters: the first keyword found wins
+outcome_keywords = [
+    ('livable', 'A Livable and Sustainable City'),
+    ('best', 'A Well Run City'),
+    ('jobs', 'A Prosperous City'),
+    ('safe', 'A Safe City'),
+]
+
+
+def split_priorities(descriptions):
+    """
+    Split a column of program descriptions into (descriptions, priorities).
+
+    Descriptions that start with a priority outcome lose that first line; the others are kept
+    as they are. The priority is the raw outcome text, or NaN when there is none.
+    """
+    descriptions = descriptions.fillna('').astype(str).str.strip()
+    parts = descriptions.str.extract(priority_pattern)
+
+    has_priority = parts['priority'].notna()
+    cleaned = descriptions.where(~has_priority, parts['description'].str.strip())
+    priorities = parts['priority'].str.strip()
+    return cleaned, priorities
+
+
+def map_outcomes(priorities):
+    """Convert raw priority outcome text to the outcome labels, '' when nothing matches."""
+    priorities = priorities.fillna('').str.lower()
+    conditions = [priorities.str.contains(keyword, regex=False) for keyword, _ in outcome_keywords]
+    labels = [label for _, label in outcome_keywords]
+    return pd.Series(np.select(conditions, labels, default=''), index=priorities.index)
+
+
+def extract_priorities(programs, number='program_number', name='entity_name', description='description'):
+    """
+    Remove the priority outcomes from the program descriptions.
+
+    Returns (programs, priorities): a copy of programs with cleaned descriptions, and a frame of
+    program_number, program_name and program_priority in the layout of new_program_priorities.csv.
+    Any other columns of programs (e.g. a fiscal year) are carried over to the priorities frame.
+    """
+    programs = programs.copy()
+    programs[description], raw = split_priorities(programs[description])
+
+    priorities = programs.drop(columns=[description]).rename(columns={
+        number: 'program_number',
+        name: 'program_name',
+    })
+    priorities['program_number'] = pd.to_numeric(priorities['program_number'], errors='coerce').astype('Int64')
+    priorities['program_priority'] = map_outcomes(raw)
+    return programs, priorities
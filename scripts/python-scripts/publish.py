@@ -0,0 +1,62 @@
+# publish.py
+# push an output file of the pipelines to its Socrata dataset
+#
+# The scripts end with the upload commented out (client.replace or sync_changes). publish()
+# does that step on its own, from the file the pipeline wrote, so it can be run after the output
+# has been looked over:
+#
+#   sync      upsert only the inserted, changed and deleted rows (see socrata_sync.py)
+#   replace   replace the whole dataset, in resumable chunks (see socrata_upload.py)
+#
+# With dry_run=True nothing is sent: the changes (sync) or the chunks (replace) are only counted.
+# Pushing needs the credentials in credentials.py.
+
+import pandas as pd
+
+from budget_config import BudgetYear, datasets, default_data_root, default_fiscal_year, default_stage, socrata_client, \
+    socrata_domain, socrata_dtypes
+from snapshot_cache import cached_fetch
+from socrata_sync import diff_frames, natural_keys, sync_changes
+from socrata_upload import default_max_chunk_bytes, plan_chunks, replace_dataset
+
+modes = ['sync', 'replace']
+
+
+def read_output(dataset, budget):
+    """The output file of a dataset, with the Socrata column names."""
+    df = pd.read_csv(budget.output_file(dataset), dtype=str)
+    # final_revenues.csv is written with its index
+    df = df[[c for c in df.columns if not c.startswith('Unnamed:')]]
+    return df.rename(columns=datasets[dataset].get('socrata_columns', {}))
+
+
+def publish(dataset, fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage, mode='sync',
+            dry_run=False, client=None):
+    """Push the year's output file of dataset to Socrata; returns a summary dict."""
+    if mode not in modes:
+        raise ValueError(f'unknown publish mode {mode!r}; expected one of {modes}')
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    identifier = datasets[dataset]['identifier']
+    new = read_output(dataset, budget)
+
+    if mode == 'replace':
+        if dry_run:
+            chunks = len(plan_chunks(new, default_max_chunk_bytes)) - 1
+            summary = {'rows': len(new), 'chunks': chunks, 'sent': 0}
+            print(f'{identifier}: would replace with {summary}')
+            return summary
+        import credentials
+
+        return replace_dataset(socrata_domain, identifier, new, app_token=credentials.lahub_auth,
+                               username=credentials.lahub_user, password=credentials.lahub_pass,
+                               checkpoint_dir=budget.data_file('upload_checkpoints/'))
+
+    client = client or socrata_client(login=not dry_run)
+    old = cached_fetch(client, identifier, cache_dir=budget.data_file('.socrata_cache/'), exclude_system_fields=False,
+                       dtypes=socrata_dtypes[identifier])
+    if dry_run:
+        inserted, changed, deleted = diff_frames(old, new, natural_keys[identifier])
+        summary = {'inserted': len(inserted), 'changed': len(changed), 'deleted': len(deleted), 'requests': 0}
+        print(f'{identifier}: would push {summary}')
+        return summary
+    return sync_changes(client, identifier, old, new)
@@ -0,0 +1,104 @@
+# quality_rules.py
+# the data-quality rules of each output, run by data_quality.py
+#
+# Each rule names a check of data_quality.py, its severity ('error' unless given) and the check's
+# parameters. Checks given the fiscal-year column ('year') only check the rows of the fiscal year
+# being added: the history already on Socrata can't be fixed by the pipeline, so it can't stop it.
+# The rules are plain data, so the columns a file needs can be checked from its header
+# without loading pandas (header_problems, used by `labudget validate --schema-only`).
+
+from budget_config import datasets, natural_keys
+
+# the rules of each output: check name, severity and the check's parameters
+rules = {
+    # the parsed Exhibit B (revenue_parser.parse_exhibit_b)
+    'exhibit_b': [
+        {'check': 'columns', 'required': ['source', 'amount', 'percent', 'fund_type', 'total']},
+        {'check': 'not_null', 'columns': ['source', 'amount', 'fund_type']},
+        {'check': 'dtypes', 'types': {'amount': 'integer', 'percent': 'number'}},
+        {'check': 'section_totals'},
+    ],
+    # final_revenues.csv (revenue.py)
+    'revenues': [
+        {'check': 'columns', 'required': ['Revenue.Source', 'Amount', 'Fund.Type', 'Fiscal.Year', 'Fiscal.Year.Shorthand']},
+        {'check': 'not_null', 'columns': ['Revenue.Source', 'Amount', 'Fund.Type'], 'year': 'Fiscal.Year.Shorthand'},
+        {'check': 'unique', 'key': ['Fiscal.Year.Shorthand', 'Revenue.Source', 'Fund.Type'], 'year': 'Fiscal.Year.Shorthand'},
+        {'check': 'dtypes', 'types': {'Amount': 'number', 'Fiscal.Year.Shorthand': 'integer'}, 'year': 'Fiscal.Year.Shorthand'},
+        {'check': 'fiscal_year', 'column': 'Fiscal.Year.Shorthand'},
+        {'check': 'year_over_year', 'severity': 'warning', 'key': ['Revenue.Source', 'Fund.Type'], 'value': 'Amount',
+         'year': 'Fiscal.Year.Shorthand'},
+    ],
+    # new_expenses.csv (expenses.py)
+    'expenses': [
+        # every column of the dataset, so one left out of a sparse page of the history fails the build
+        {'check': 'columns', 'required': datasets['expenses']['columns']},
+        {'check': 'unique', 'key': natural_keys['5242-pnmt'], 'year': 'fiscal_year'},
+        {'check': 'dtypes', 'types': {'appropriation': 'number', 'fiscal_year': 'integer'}, 'year': 'fiscal_year'},
+        {'check': 'fiscal_year', 'column': 'fiscal_year'},
+        {'check': 'year_over_year', 'severity': 'warning', 'key': ['dept_code'], 'value': 'appropriation',
+         'year': 'fiscal_year'},
+    ],
+    # the outputs of open_budget_other.py
+    'gfrev': [
+        {'check': 'columns', 'required': natural_keys['qrkr-kfbh'] + ['revenue']},
+        {'check': 'unique', 'key': natural_keys['qrkr-kfbh'], 'year': 'fiscal_year', 'labels': True},
+        {'check': 'dtypes', 'types': {'revenue': 'number'}, 'year': 'fiscal_year', 'labels': True},
+        {'check': 'fiscal_year', 'column': 'fiscal_year', 'labels': True},
+        {'check': 'year_over_year', 'severity': 'warning', 'key': ['dept_code'], 'value': 'revenue',
+         'year': 'fiscal_year', 'labels': True},
+    ],
+    'positions': [
+        {'check': 'columns', 'required': natural_keys['46qe-t7np'] + ['positions']},
+        {'check': 'unique', 'key': natural_keys['46qe-t7np'], 'year': 'budget', 'labels': True},
+        {'check': 'dtypes', 'types': {'positions': 'number'}, 'year': 'budget', 'labels': True},
+        {'check': 'fiscal_year', 'column': 'budget', 'labels': True},
+        {'check': 'year_over_year', 'severity': 'warning', 'key': ['department_code'], 'value': 'positions',
+         'year': 'budget', 'labels': True, 'min_amount': 10},
+    ],
+    'inc': [
+        {'check': 'columns', 'required': natural_keys['k4k6-bwwv'] + ['incremental_change']},
+        # the same request can be listed more than once
+        {'check': 'unique', 'severity': 'warning', 'key': natural_keys['k4k6-bwwv'], 'year': 'budget', 'labels': True},
+        {'check': 'dtypes', 'types': {'incremental_change': 'number'}, 'year': 'budget', 'labels': True},
+        {'check': 'fiscal_year', 'column': 'budget', 'labels': True},
+    ],
+    'pm': [
+        {'check': 'columns', 'required': natural_keys['bywz-284j'] + ['performance_measure_amount']},
+        {'check': 'unique', 'severity': 'warning', 'key': natural_keys['bywz-284j'], 'year': 'budget', 'labels': True},
+        {'check': 'dtypes', 'types': {'performance_measure_amount': 'number'}, 'year': 'budget', 'labels': True},
+        {'check': 'fiscal_year', 'column': 'budget', 'labels': True},
+    ],
+}
+
+# the parameters of each check that name columns
+_column_params = {
+    'columns': ['required'],
+    'not_null': ['columns', 'year'],
+    'unique': ['key', 'year'],
+    'dtypes': ['types', 'year'],
+    'fiscal_year': ['column'],
+    'section_totals': [],
+    'year_over_year': ['key', 'value', 'year'],
+}
+
+
+def rule_columns(rule):
+    """The columns a rule reads."""
+    columns = []
+    for param in _column_params[rule['check']]:
+        value = rule.get(param)
+        if isinstance(value, str):
+            columns.append(value)
+        elif value:
+            columns.extend(value)
+    return columns
+
+
+def header_problems(dataset, header):
+    """The columns missing from a file's header, per check: [(check, severity, [columns])]."""
+    problems = []
+    for rule in rules[dataset]:
+        missing = [c for c in dict.fromkeys(rule_columns(rule)) if c not in header]
+        if missing:
+            problems.append((rule['check'], rule.get('severity', 'error'), missing))
+    return problems
@@ -6,89 +6,120 @@
 
 
 ### This script will be able to creating new revenue entries in Socrata from the created CSV's via `parse_revenues.py`.
+### run() is the whole pipeline for one fiscal year; `python3 revenue.py` runs it for the default year (see budget_config.py).
 
 ## SETUP
 
 import datetime
 import pandas as pd
-import credentials
-from sodapy import Socrata
-
-# Instantiating variables
-fy = '2021-2022'
-fy_shorthand = 2022
-filepath_prefix = '../../data/approved_budget/FY21-22/'
+from budget_config import BudgetYear, datasets, default_data_root, default_fiscal_year, default_stage, socrata_client, \
+    socrata_dtypes
+from data_quality import gate
+from revenue_reconcile import balance_totals, reconcile
+from snapshot_cache import cached_fetch
+from socrata_sync import drop_system_fields
+from tracing import Tracer
 
 # API endpoint for the dataset
 socrata_endpoint = "https://data.lacity.org/resource/ih6g-qkwz.json"
-socrata_id = 'ih6g-qkwz'
-
-# Get current timestamp
-timestamp = str(datetime.datetime.now())
-
-## EXTRACTING + CLEANING DATA
-
-
-# set up Socrata client
-# Don't need credentials to read in public data.
-client = Socrata('data.lacity.org', None)
-
-# uncomment if you are going to log in / push to the data portal
-# username = credentials.lahub_user
-# password = credentials.lahub_pass
-# apptoken = credentials.lahub_auth
-# client = Socrata('data.lacity.org', apptoken, username=username, password=password)
-
-# read in the data on Socrata and save as backup
-old_revenues = pd.DataFrame(client.get(socrata_id))
-old_revenues.to_csv(f'{filepath_prefix}old_revenues_{timestamp}.csv')
-
-# Filtering out current year
-old_revenues = old_revenues[old_revenues['fiscal_year_2'] != 2022]
-
-# Read in new data -- these spreadsheets are from parse_revenues.py
-new_revenues = pd.read_csv('../../data/approved_budget/FY21-22/new_revenues.csv')
-available_balances = pd.read_csv('../../data/approved_budget/FY21-22/available_balances.csv')
-
-### Cleaning dataframes
-
-# Remove percent columns
-new_revenues.drop(columns=['Percent'], inplace=True)
-available_balances.drop(columns=['Percent'], inplace=True)
-
-# Remove rows without an available balance
-available_balances = available_balances[available_balances['Available.Balance'] != 0]
-
-# Cleaning new_revenues
-new_revenues = new_revenues.merge(available_balances, how='outer', on='Revenue.Source')
-new_revenues['Available.Balance'] = new_revenues['Available.Balance'].fillna(0)
-new_revenues['Amount'] += new_revenues['Available.Balance']
-new_revenues.drop(columns=['Available.Balance'], inplace=True)
-new_revenues['Fiscal.Year.Shorthand'] = fy_shorthand
-new_revenues['Fiscal.Year'] = fy
-
-### Dropping rows that still have null values because this could mean these rows are just slightly misnamed in `Revenue.Source` w.r.t. the `Available Balances` table.
-### The above is not necessarily true from year to year. Quality check of the data is still required.
-new_revenues.dropna(axis=0, how='any', inplace=True)
-
-# Renaming columns for `old_revenues`
-old_revenues.rename(columns={
-    'revenue_source': 'Revenue.Source',
-    'amount': 'Amount',
-    'fund_type': 'Fund.Type',
-    'fiscal_year': 'Fiscal.Year',
-    'fiscal_year_2': 'Fiscal.Year.Shorthand'
-}, inplace=True)
-
-### Dropping rows that still have null values from `old_revenues`. These entries are most likely continuously listed under similar names
-### Quality check before this row would still be best practice.
-old_revenues.dropna(axis=0, how='any', inplace=True)
-
-## CREATING FINAL DATAFRAME AND UPLOADING TO SOCRATA
-
-# Creating the `final_revenues` table and exporting it
-final_revenues = pd.concat([new_revenues, old_revenues])
-final_revenues.to_csv(f'{filepath_prefix}final_revenues.csv')
-
-# Upload to Socrata here
-# client.replace(socrata_id, final_revenues)
+socrata_id = datasets['revenues']['identifier']
+
+# the Socrata column names of final_revenues.csv
+socrata_columns = datasets['revenues']['socrata_columns']
+
+
+def run(fiscal_year=default_fiscal_year, data_root=default_data_root, stage=default_stage, client=None,
+        chrome_trace=False):
+    """
+    Build final_revenues.csv for the fiscal year (the year it ends in) from the csv files written by
+    parse_revenues.py and the revenues on Socrata; returns the whole dataset.
+
+    client is a sodapy client (a public one by default). The stages are traced to
+    trace_revenue_<time>.json in the year's folder (see tracing.py).
+    """
+    # Instantiating variables
+    budget = BudgetYear(fiscal_year, data_root, stage)
+    fy = budget.fields()['fy_long']
+    fy_shorthand = budget.fiscal_year
+    filepath_prefix = budget.folder
+
+    # Get current timestamp
+    timestamp = str(datetime.datetime.now())
+    tracer = Tracer('revenue')
+
+    ## EXTRACTING + CLEANING DATA
+
+    # Don't need credentials to read in public data.
+    client = client or socrata_client()
+
+    # read in the data on Socrata and save as backup
+    tracer.begin('fetch socrata')
+    socrata_revenues = cached_fetch(client, socrata_id, cache_dir=budget.data_file('.socrata_cache/'),
+                                    exclude_system_fields=False, dtypes=socrata_dtypes[socrata_id])
+    old_revenues = drop_system_fields(socrata_revenues)
+    old_revenues.to_csv(f'{filepath_prefix}old_revenues_{timestamp}.csv')
+    tracer.end(rows_out=old_revenues)
+
+    # Filtering out current year (fiscal_year_2 is fetched as an integer, see budget_config.py)
+    old_revenues = old_revenues[pd.to_numeric(old_revenues['fiscal_year_2']) != fy_shorthand]
+
+    # Read in new data -- these spreadsheets are from parse_revenues.py
+    tracer.begin('read new revenues')
+    new_revenues = pd.read_csv(f'{filepath_prefix}new_revenues.csv')
+    available_balances = pd.read_csv(f'{filepath_prefix}available_balances.csv')
+    tracer.end(rows_out=len(new_revenues) + len(available_balances))
+
+    ### Cleaning dataframes
+
+    # Remove percent columns
+    new_revenues.drop(columns=['Percent'], inplace=True)
+    available_balances.drop(columns=['Percent'], inplace=True)
+
+    # Remove rows without an available balance
+    available_balances = available_balances[available_balances['Available.Balance'] != 0]
+
+    # Cleaning new_revenues: add each available balance to the revenue source it belongs to, matching
+    # the names approximately; balances without a clear match are written out for review
+    tracer.begin('reconcile balances', rows_in=available_balances)
+    matches, review = reconcile(new_revenues, available_balances)
+    review.to_csv(f'{filepath_prefix}available_balances_review.csv', index=False)
+    print(f'available balances: {len(matches)} matched, {review["Revenue.Source"].nunique()} to review')
+    new_revenues['Amount'] += balance_totals(new_revenues, available_balances, matches)
+    tracer.end(rows_out=matches)
+    tracer.begin('combine')
+    new_revenues['Fiscal.Year.Shorthand'] = fy_shorthand
+    new_revenues['Fiscal.Year'] = fy
+
+    ### Dropping rows that still have null values. Balances that could not be matched to a revenue source are in
+    ### available_balances_review.csv and are not added; quality check of the data is still required.
+    new_revenues.dropna(axis=0, how='any', inplace=True)
+
+    # Renaming columns for `old_revenues`
+    old_revenues.rename(columns={socrata: column for column, socrata in socrata_columns.items()}, inplace=True)
+
+    ### Dropping rows that still have null values from `old_revenues`. These entries are most likely continuously listed under similar names
+    ### Quality check before this row would still be best practice.
+    old_revenues.dropna(axis=0, how='any', inplace=True)
+
+    ## CREATING FINAL DATAFRAME AND UPLOADING TO SOCRATA
+
+    # Creating the `final_revenues` table and exporting it
+    final_revenues = pd.concat([new_revenues, old_revenues])
+    tracer.end(rows_out=final_revenues)
+
+    # check the table before it is saved and uploaded (see data_quality.py); stops here if a check fails
+    with tracer.stage('quality gate'):
+        gate(final_revenues, 'revenues', fiscal_year=fy_shorthand, report_path=f'{filepath_prefix}quality_revenues.json')
+    with tracer.stage('write csv', rows_in=final_revenues):
+        final_revenues.to_csv(budget.output_file('revenues'))
+
+    # Upload to Socrata with `python3 labudget.py publish revenues`, which pushes only the inserted, changed
+    # and deleted rows (see publish.py), or replace the whole dataset here:
+    # client.replace(socrata_id, final_revenues)
+
+    tracer.finish(filepath_prefix, chrome=chrome_trace)
+    return final_revenues
+
+
+if __name__ == '__main__':
+    run()
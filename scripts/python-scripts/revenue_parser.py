@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# revenue_parser.py
+# parse the revenue tables of the Exhibit B (budget summary of receipts) PDFs
+#
+# The pages are read one at a time and tokenized with a single compiled regex, which picks out
+# both the section headings (General Receipts, Special Receipts, Available Balances) and the
+# "source ........ amount percent%" lines. Each line becomes a typed RevenueRecord; the
+# "Total ..." lines are yielded too, flagged with total=True, so the section sums can be checked;
+# the grand total has fund_type 'All Receipts'.
+#
+# Usage (from scripts/python-scripts), to parse every Exhibit B PDF under data/ in parallel:
+#   python3 revenue_parser.py
+# which writes one exhibit_b_<fiscal year>.csv table per PDF to data/exhibit_b/.
+#
+# requires PyPDF2: pip install PyPDF2
+
+import glob
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+RevenueRecord = namedtuple('RevenueRecord', ['source', 'amount', 'percent', 'fund_type', 'total'])
+
+# fund type of the records in each section
+section_fund_types = {
+    'General Receipts': 'General Fund',
+    'Special Receipts': 'Special Fund',
+    'Available Balances': 'Available Balance',
+}
+
+# page and column titles repeated on every page
+page_titles = re.compile(r'EXHIBIT B|BUDGET SUMMARY|RECEIPTS|% ?of\s*Total\s*Total')
+
+# one token is either a section heading, or a revenue line: the source name (which may contain
+# single dots, as in "Prop. C"), a run of leader dots, the amount (digits with stray single
+# spaces and commas, or dashes for zero), an optional $ and the percent of total receipts.
+# the amount is matched lazily and the percent always has a decimal point, so the digits of the
+# percent are never taken as part of the amount
+token = re.compile(r'''
+    (?P<section>General\ Receipts|Special\ Receipts|Available\ Balances):
+  | (?P<source>(?:[^.\n]|\.(?!\.\.))+?)\s*\.{3,}[\s.]*
+    (?P<amount>\d(?:[\d,]|\ (?=[\d,]))*?|-[-\ ]*?)\s*\$?\s+
+    (?P<percent>\d{1,3}\.\d+)\s*%
+''', re.VERBOSE)
+
+
+def _amount(text):
+    # '1, 961,509,000' -> 1961509000; '--' and '- -' mean zero
+    digits = re.sub(r'[^\d]', '', text)
+    return int(digits) if digits else 0
+
+
+def iter_records(pages):
+    """
+    Yield a RevenueRecord for every line of the revenue tables in pages (an iterable of page texts).
+
+    Pages are processed one at a time; text after the last complete line of a page is carried
+    over to the next page, so lines split across pages are still read.
+    """
+    fund_type = None
+    carry = ''
+    for page in pages:
+        text = carry + page_titles.sub('\n', page)
+        end = 0
+        for match in token.finditer(text):
+            end = match.end()
+            if match.group('section'):
+                fund_type = section_fund_types[match.group('section')]
+                continue
+            if fund_type is None:
+                # lines before the first section heading
+                continue
+            source = ' '.join(match.group('source').split())
+            total = source.replace(' ', '').startswith('Total')
+            yield RevenueRecord(
+                source=source,
+                amount=_amount(match.group('amount')),
+                percent=float(match.group('percent')),
+                fund_type=fund_type,
+                total=total,
+            )
+            # a total closes its section; the grand total ("Total Receipts") comes after the last one
+            if total:
+                fund_type = 'All Receipts'
+        carry = text[end:]
+
+
+def iter_pages(pdf_filename):
+    """Yield the text of each page of a PDF."""
+    import PyPDF2
+
+    with open(pdf_filename, 'rb') as f:
+        # PyPDF2 >= 2 has PdfReader/extract_text, older versions PdfFileReader/extractText
+        if hasattr(PyPDF2, 'PdfReader'):
+            for page in PyPDF2.PdfReader(f).pages:
+                yield page.extract_text()
+        else:
+            reader = PyPDF2.PdfFileReader(f)
+            for i in range(reader.numPages):
+                yield reader.getPage(i).extractText()
+
+
+def parse_exhibit_b(pdf_filename):
+    """Parse one Exhibit B PDF into a data frame of source, amount, percent, fund_type, total."""
+    records = list(iter_records(iter_pages(pdf_filename)))
+    return pd.DataFrame.from_records(records, columns=RevenueRecord._fields).astype({
+        'amount': 'int64',
+        'percent': 'float64',
+    })
+
+
+def write_revenue_csvs(records, filepath_prefix):
+    """
+    Write new_revenues.csv and available_balances.csv, in the layout revenue.py reads, from the
+    data frame returned by parse_exhibit_b.
+    """
+    rows = records[~records['total']]
+
+    receipts = rows[rows['fund_type'].isin(['General Fund', 'Special Fund'])]
+    receipts = receipts[['source', 'amount', 'percent', 'fund_type']]
+    receipts.columns = ['Revenue.Source', 'Amount', 'Percent', 'Fund.Type']
+    receipts.to_csv(f'{filepath_prefix}new_revenues.csv', index=False)
+
+    balances = rows[rows['fund_type'] == 'Available Balance']
+    balances = balances[['source', 'amount', 'percent']]
+    balances.columns = ['Revenue.Source', 'Available.Balance', 'Percent']
+    balances.to_csv(f'{filepath_prefix}available_balances.csv', index=False)
+
+
+def fiscal_year_label(pdf_filename):
+    """'05-Exhibit B 19A.pdf' -> '2018-19 Adopted'; '... 19P.pdf' -> '2018-19 Proposed'."""
+    match = re.search(r'(\d{2})([AP])\.pdf$', os.path.basename(pdf_filename), re.IGNORECASE)
+    if not match:
+        return os.path.splitext(os.path.basename(pdf_filename))[0]
+    end_year = 2000 + int(match.group(1))
+    stage = 'Adopted' if match.group(2).upper() == 'A' else 'Proposed'
+    return f'{end_year - 1}-{str(end_year)[2:]} {stage}'
+
+
+def find_exhibit_b(data_root='../../data/'):
+    """Every Exhibit B PDF in the fiscal-year folders under data_root."""
+    return sorted(glob.glob(os.path.join(data_root, '*', 'FY*', '*Exhibit B*.pdf')))
+
+
+def _parse_labelled(pdf_filename):
+    df = parse_exhibit_b(pdf_filename)
+    df['budget'] = fiscal_year_label(pdf_filename)
+    return df
+
+
+def parse_all(pdf_filenames, output_dir='../../data/exhibit_b/', workers=None):
+    """
+    Parse the PDFs in a process pool and write one exhibit_b_<fiscal year>.csv per PDF.
+
+    Returns {fiscal year label: data frame}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tables = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for pdf_filename, df in zip(pdf_filenames, pool.map(_parse_labelled, pdf_filenames)):
+            label = fiscal_year_label(pdf_filename)
+            filename = os.path.join(output_dir, f"exhibit_b_{label.replace(' ', '_')}.csv")
+            df.to_csv(filename, index=False)
+            print(f'{pdf_filename}: {len(df)} lines -> {filename}')
+            tables[label] = df
+    return tables
+
+
+if __name__ == '__main__':
+    parse_all(find_exhibit_b())
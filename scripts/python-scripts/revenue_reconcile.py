@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# revenue_reconcile.py
+# match the available balances of Exhibit B to the revenue sources they belong to
+#
+# revenue.py used to outer-merge new_revenues.csv and available_balances.csv on the exact
+# Revenue.Source string and then drop the rows left with nulls, even though those are often the
+# same source slightly misnamed ('Community Development Fund' / 'Community Development Trust
+# Fund'), or split up by the PDF text extraction ('Neighborhood Empowe rment F und').
+#
+# reconcile() instead:
+#   1. normalizes the names to a compact key (lower case, no punctuation or spaces)
+#   2. blocks on character trigrams: an inverted index from trigram to revenue names, leaving
+#      out the trigrams shared by many names ('fun', 'und'), gives the candidates of each
+#      balance without comparing all pairs
+#   3. scores each candidate with the Dice coefficient of the two trigram sets
+#   4. joins a balance to its best candidate when the score is at least `threshold` and clearly
+#      ahead of the runner-up; every other balance goes to a review table with its candidates
+#
+# Candidates are only looked for within the same block (e.g. the same budget), so every year of
+# Exhibit B can be reconciled in one call.
+#
+# Usage (from scripts/python-scripts), to reconcile every parsed Exhibit B under data/exhibit_b/:
+#   python3 revenue_reconcile.py
+
+import glob
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# names that don't share enough letters with the source they stand for, by normalized key
+known_aliases = {
+    'cers': 'cityemployeesretirementfund',
+}
+
+default_threshold = 0.85
+default_margin = 0.1
+
+# trigrams found in more than this share of the names of a block are not used for blocking
+max_gram_share = 0.2
+
+# candidates listed per balance in the review table
+review_candidates = 3
+
+
+def normalize_sources(names):
+    """Compact matching key of each name: 'Prop. C Anti-Gridlock F und' -> 'propcantigridlockfund'."""
+    keys = (names.fillna('').astype(str).str.lower()
+            .str.replace('&', 'and', regex=False)
+            .str.replace(r'[^a-z0-9]', '', regex=True))
+    return keys.replace(known_aliases)
+
+
+def _grams(keys, block):
+    # one row per distinct (name, trigram)
+    grams = pd.DataFrame({
+        'row': np.arange(len(keys)),
+        'block': block,
+        'gram': [[key[i:i + 3] for i in range(len(key) - 2)] or [key] for key in keys],
+    }).explode('gram')
+    grams = grams.drop_duplicates(['row', 'gram'])
+    sizes = grams.groupby('row').size().reindex(np.arange(len(keys)), fill_value=0).to_numpy()
+    return grams, sizes
+
+
+def candidates(revenue_keys, balance_keys, revenue_block, balance_block):
+    """Candidate (balance, revenue) pairs sharing informative trigrams, with their Dice scores."""
+    revenue_grams, revenue_sizes = _grams(revenue_keys, revenue_block)
+    balance_grams, balance_sizes = _grams(balance_keys, balance_block)
+
+    # trigrams common to many revenue names of the block say little and make the blocks huge
+    names_per_block = revenue_grams.groupby('block')['row'].nunique()
+    gram_counts = revenue_grams.groupby(['block', 'gram']).size().rename('names').reset_index()
+    gram_counts['share'] = gram_counts['names'] / gram_counts['block'].map(names_per_block)
+    informative = gram_counts[(gram_counts['share'] <= max_gram_share) | (gram_counts['names'] <= 1)]
+    blocking = revenue_grams.merge(informative[['block', 'gram']], on=['block', 'gram'])
+
+    # the candidate pairs, found through the informative trigrams, and all the trigrams they share
+    pairs = balance_grams.merge(blocking, on=['block', 'gram'], suffixes=('_balance', '_revenue'))
+    pairs = pairs[['row_balance', 'row_revenue']].drop_duplicates()
+    shared = (pairs
+              .merge(balance_grams[['row', 'gram']].rename(columns={'row': 'row_balance'}), on='row_balance')
+              .merge(revenue_grams[['row', 'gram']].rename(columns={'row': 'row_revenue'}), on=['row_revenue', 'gram'])
+              .groupby(['row_balance', 'row_revenue']).size().rename('shared').reset_index())
+
+    a = balance_sizes[shared['row_balance'].to_numpy()]
+    b = revenue_sizes[shared['row_revenue'].to_numpy()]
+    shared['score'] = 2 * shared['shared'] / (a + b)
+    exact = balance_keys[shared['row_balance'].to_numpy()] == revenue_keys[shared['row_revenue'].to_numpy()]
+    shared.loc[exact, 'score'] = 1.0
+    return shared.sort_values(['row_balance', 'score'], ascending=[True, False], kind='stable')
+
+
+def reconcile(revenues, balances, source='Revenue.Source', by=None, threshold=default_threshold,
+              margin=default_margin):
+    """
+    Match each row of balances to a row of revenues by source name.
+
+    by optionally names columns that must be equal (e.g. the budget year). Returns (matches,
+    review): matches has the balances and revenues index labels of the joined rows and their
+    score; review has every other balance with its best candidates (candidate empty if none).
+    """
+    revenue_keys = normalize_sources(revenues[source]).to_numpy(dtype=object)
+    balance_keys = normalize_sources(balances[source]).to_numpy(dtype=object)
+    if by:
+        revenue_block = pd.MultiIndex.from_frame(revenues[by]).to_flat_index() if isinstance(by, list) else revenues[by].to_numpy()
+        balance_block = pd.MultiIndex.from_frame(balances[by]).to_flat_index() if isinstance(by, list) else balances[by].to_numpy()
+    else:
+        revenue_block = balance_block = 0
+    scored = candidates(revenue_keys, balance_keys, revenue_block, balance_block)
+
+    # best and runner-up score of each balance
+    ranked = scored.assign(rank=scored.groupby('row_balance').cumcount())
+    best = ranked[ranked['rank'] == 0].set_index('row_balance')
+    runner_up = ranked[ranked['rank'] == 1].set_index('row_balance')['score'].reindex(best.index, fill_value=0)
+    accepted = best[(best['score'] >= threshold) & ((best['score'] - runner_up >= margin) | (best['score'] == 1.0))]
+
+    # a revenue row takes at most one balance: the best scoring one
+    accepted = accepted.reset_index().sort_values('score', ascending=False, kind='stable')
+    accepted = accepted.drop_duplicates('row_revenue', keep='first').sort_values('row_balance')
+
+    matches = pd.DataFrame({
+        'balance': balances.index[accepted['row_balance'].to_numpy()],
+        'revenue': revenues.index[accepted['row_revenue'].to_numpy()],
+        'score': accepted['score'].round(3).to_numpy(),
+    })
+
+    # the rest, with their candidates
+    unmatched = np.setdiff1d(np.arange(len(balances)), accepted['row_balance'].to_numpy())
+    listed = ranked[ranked['row_balance'].isin(unmatched) & (ranked['rank'] < review_candidates)]
+    listed = pd.DataFrame({'row_balance': unmatched}).merge(listed, on='row_balance', how='left')
+    review = balances.iloc[listed['row_balance'].to_numpy()].reset_index(drop=True)
+    found = listed['row_revenue'].notna().to_numpy()
+    candidate_names = np.full(len(listed), None, dtype=object)
+    candidate_names[found] = revenues[source].to_numpy(dtype=object)[listed['row_revenue'][found].astype(int)]
+    review['candidate'] = candidate_names
+    review['score'] = listed['score'].round(3).to_numpy()
+    review['rank'] = (listed['rank'] + 1).astype('Int64').to_numpy()
+    return matches, review
+
+
+def balance_totals(revenues, balances, matches, amount='Available.Balance'):
+    """The matched balance amount of each revenue row (0 where there is none)."""
+    totals = balances.loc[matches['balance'], amount].groupby(matches['revenue'].to_numpy()).sum()
+    return totals.reindex(revenues.index, fill_value=0)
+
+
+def reconcile_exhibit_b(tables, threshold=default_threshold):
+    """
+    Reconcile the tables written by revenue_parser.parse_all (every budget at once): returns
+    (matches, review), with the budget of every row.
+    """
+    records = pd.concat(tables, ignore_index=True)
+    records = records[~records['total'].astype(bool)]
+    revenues = records[records['fund_type'].isin(['General Fund', 'Special Fund'])]
+    balances = records[records['fund_type'] == 'Available Balance']
+    matches, review = reconcile(revenues, balances, source='source', by='budget', threshold=threshold)
+    matches['budget'] = balances.loc[matches['balance'], 'budget'].to_numpy()
+    matches['balance_source'] = balances.loc[matches['balance'], 'source'].to_numpy()
+    matches['revenue_source'] = revenues.loc[matches['revenue'], 'source'].to_numpy()
+    return matches, review
+
+
+if __name__ == '__main__':
+    output_dir = '../../data/exhibit_b/'
+    filenames = sorted(glob.glob(os.path.join(output_dir, 'exhibit_b_*.csv')))
+    if not filenames:
+        print(f'no parsed Exhibit B tables in {output_dir}; run python3 revenue_parser.py first')
+        sys.exit(1)
+    matches, review = reconcile_exhibit_b([pd.read_csv(f) for f in filenames])
+    review.to_csv(os.path.join(output_dir, 'available_balances_review.csv'), index=False)
+    for budget, group in matches.groupby('budget'):
+        unmatched = review.loc[review['budget'] == budget, 'source'].nunique()
+        print(f'{budget}: {len(group)} balances joined, {unmatched} to review')
+    print(f"review file: {os.path.join(output_dir, 'available_balances_review.csv')}")
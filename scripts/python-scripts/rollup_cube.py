@@ -0,0 +1,145 @@
+# rollup_cube.py
+# precomputed totals of the appropriations at every level of the budget hierarchy
+#
+# The consumers of the appropriations dataset (5242-pnmt) keep summing the line items up to
+# department, subdepartment, program, fund and account totals per fiscal year and per program
+# priority. update_cube() writes those totals once:
+#
+#   cube      one row per fiscal year, program priority ('All' for every priority) and node of
+#             the hierarchy, with the appropriation total and the number of line items; the
+#             level column says how deep the node is. Stored as Parquet, one partition per year.
+#   treemap   treemap_<fiscal year>.json: the hierarchy as nested {name, value, children}.
+#
+# A fingerprint of each year's line items is kept in a manifest, and only the years whose line
+# items changed are recomputed -- after a yearly update, that is just the new fiscal year.
+#
+# requires pyarrow: pip install pyarrow
+
+import json
+import os
+import shutil
+
+import pandas as pd
+
+# where the cube and the treemaps are written, relative to scripts/python-scripts
+default_cube_dir = '../../data/rollup_cube/'
+
+# the hierarchy, from the top
+levels = ['department_name', 'subdepartment_name', 'program_name', 'source_fund_name', 'account_name']
+
+# program_priority value of the rows that total every priority
+all_priorities = 'All'
+
+
+def _fingerprint(year_rows):
+    # order-independent hash of one year's line items
+    columns = levels + ['program_priority', 'appropriation']
+    return str(int(pd.util.hash_pandas_object(year_rows[columns], index=False).sum()))
+
+
+def year_cube(year_rows):
+    """The totals of one fiscal year's line items at every level, overall and per priority."""
+    parts = []
+    for by_priority in (False, True):
+        for depth in range(len(levels) + 1):
+            keys = (['program_priority'] if by_priority else []) + levels[:depth]
+            if keys:
+                totals = year_rows.groupby(keys, sort=False, dropna=False, observed=True).agg(
+                    appropriation=('appropriation', 'sum'), line_items=('appropriation', 'size')).reset_index()
+            else:
+                totals = pd.DataFrame({'appropriation': [year_rows['appropriation'].sum()],
+                                       'line_items': [len(year_rows)]})
+            if not by_priority:
+                totals['program_priority'] = all_priorities
+            totals['level'] = levels[depth - 1] if depth else 'total'
+            parts.append(totals)
+    cube = pd.concat(parts, ignore_index=True)
+    return cube[['level', 'program_priority'] + levels + ['appropriation', 'line_items']]
+
+
+def treemap(cube):
+    """Nested {name, value, children} of one year's cube, from its all-priority rows."""
+    root = {'name': 'total', 'value': 0.0, 'children': []}
+    overall = cube[cube['program_priority'] == all_priorities]
+    nodes = {(): root}
+    for depth, level in enumerate(levels, start=1):
+        rows = overall[overall['level'] == level]
+        names = [rows[column].astype(object).fillna('').to_numpy() for column in levels[:depth]]
+        for path, value in zip(zip(*names), rows['appropriation'].to_numpy(dtype=float).tolist()):
+            node = {'name': path[-1], 'value': value}
+            nodes[path[:-1]].setdefault('children', []).append(node)
+            nodes[path] = node
+    root['value'] = float(overall.loc[overall['level'] == 'total', 'appropriation'].sum())
+    return root
+
+
+def _manifest_path(cube_dir):
+    return os.path.join(cube_dir, 'manifest.json')
+
+
+def _partition(cube_dir, fiscal_year):
+    return os.path.join(cube_dir, 'cube', f'fiscal_year={fiscal_year}')
+
+
+def update_cube(expenses, cube_dir=default_cube_dir, years=None, complete=True):
+    """
+    Bring the cube and the treemaps in cube_dir up to date with the expenses line items.
+
+    Only the fiscal years whose line items changed since the last update are recomputed
+    (years forces a list of years to be recomputed); years no longer in expenses are removed.
+    With complete=False, expenses only holds some fiscal years, and the other years are kept.
+    Returns the list of recomputed years.
+    """
+    expenses = expenses.assign(
+        fiscal_year=expenses['fiscal_year'].astype(int),
+        appropriation=pd.to_numeric(expenses['appropriation'], errors='coerce').fillna(0))
+
+    os.makedirs(cube_dir, exist_ok=True)
+    manifest = {}
+    if os.path.exists(_manifest_path(cube_dir)):
+        with open(_manifest_path(cube_dir)) as f:
+            manifest = json.load(f)
+
+    recomputed = []
+    current = {}
+    for fiscal_year, year_rows in expenses.groupby('fiscal_year', sort=True):
+        key = str(fiscal_year)
+        current[key] = _fingerprint(year_rows)
+        if manifest.get(key) == current[key] and (years is None or fiscal_year not in years) \
+                and os.path.exists(_partition(cube_dir, fiscal_year)):
+            continue
+
+        cube = year_cube(year_rows)
+        partition = _partition(cube_dir, fiscal_year)
+        shutil.rmtree(partition, ignore_errors=True)
+        os.makedirs(partition)
+        cube.to_parquet(os.path.join(partition, 'part.parquet'), index=False)
+        with open(os.path.join(cube_dir, f'treemap_{fiscal_year}.json'), 'w') as f:
+            # dumps (unlike dump) uses the C encoder
+            f.write(json.dumps(treemap(cube), separators=(',', ':')))
+        recomputed.append(fiscal_year)
+
+    # years that are gone from the dataset
+    if not complete:
+        current = dict(manifest, **current)
+    for key in set(manifest) - set(current):
+        shutil.rmtree(_partition(cube_dir, key), ignore_errors=True)
+        treemap_path = os.path.join(cube_dir, f'treemap_{key}.json')
+        if os.path.exists(treemap_path):
+            os.remove(treemap_path)
+
+    with open(_manifest_path(cube_dir), 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f'rollup cube: recomputed {recomputed or "no"} fiscal years, {len(current) - len(recomputed)} unchanged')
+    return recomputed
+
+
+def load_cube(cube_dir=default_cube_dir, fiscal_years=None, level=None):
+    """Read the cube, optionally only some fiscal years and one level."""
+    filters = [('fiscal_year', 'in', [int(y) for y in fiscal_years])] if fiscal_years is not None else None
+    cube = pd.read_parquet(os.path.join(cube_dir, 'cube'), filters=filters)
+    # partition values come back as a categorical
+    cube['fiscal_year'] = cube['fiscal_year'].astype(int)
+    if level is not None:
+        cube = cube[cube['level'] == level]
+    return cube
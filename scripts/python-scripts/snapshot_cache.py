@@ -0,0 +1,90 @@
+# snapshot_cache.py
+# local cache of Socrata dataset snapshots
+#
+# Each run used to download the full existing datasets again, even when nothing on the portal
+# had changed since the last run minutes earlier. cached_fetch() records the portal's
+# last-modified times and row count next to a Parquet copy of the dataset, and only downloads
+# the data again when that metadata has changed. Iterating on the transformation code then
+# costs a metadata request and a Parquet read per dataset.
+#
+# cached_chunks() yields the dataset in chunks instead, from the snapshot if it is current and
+# from the portal otherwise, for processing it out of core.
+#
+# requires pyarrow for the Parquet files: pip install pyarrow
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from socrata_fetch import count_rows, fetch_dataset, iter_chunks
+
+# where the snapshots are kept, relative to scripts/python-scripts
+default_cache_dir = '../../data/.socrata_cache/'
+
+
+def _portal_stamp(client, identifier):
+    # the metadata that tells us whether the dataset changed on the portal
+    metadata = client.get_metadata(identifier)
+    return {
+        'rowsUpdatedAt': metadata.get('rowsUpdatedAt'),
+        'viewLastModified': metadata.get('viewLastModified'),
+        'row_count': count_rows(client, identifier),
+    }
+
+
+def _cache_paths(cache_dir, identifier, fetch_options):
+    # the fetch options (e.g. exclude_system_fields) change the content, so they are part of the key
+    options = json.dumps(fetch_options, sort_keys=True, default=str)
+    suffix = hashlib.sha1(options.encode()).hexdigest()[:8]
+    base = os.path.join(cache_dir, f'{identifier}_{suffix}')
+    return f'{base}.parquet', f'{base}.json'
+
+
+def _is_current(stamp_path, stamp):
+    if not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path) as f:
+        return json.load(f) == stamp
+
+
+def cached_fetch(client, identifier, cache_dir=default_cache_dir, refresh=False, **fetch_options):
+    """
+    Return the dataset as a data frame, downloading it only if it changed on the portal.
+
+    fetch_options are passed on to socrata_fetch.fetch_dataset; refresh=True always downloads.
+    """
+    data_path, stamp_path = _cache_paths(cache_dir, identifier, fetch_options)
+    stamp = _portal_stamp(client, identifier)
+
+    if not refresh and _is_current(stamp_path, stamp):
+        print(f'{identifier}: unchanged on the portal, loading {data_path}')
+        return pd.read_parquet(data_path)
+
+    df = fetch_dataset(client, identifier, **fetch_options)
+
+    # write the data before the stamp, so an interrupted write never looks like a valid cache
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_parquet(data_path, index=False)
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+
+    return df
+
+
+def cached_chunks(client, identifier, chunksize=50000, cache_dir=default_cache_dir, **fetch_options):
+    """
+    Yield the dataset in data frames of at most chunksize rows: read from the snapshot if it is
+    current, otherwise downloaded page by page (the snapshot is not written in that case; the
+    next cached_fetch() call writes it).
+    """
+    import pyarrow.parquet as pq
+
+    data_path, stamp_path = _cache_paths(cache_dir, identifier, fetch_options)
+    if os.path.exists(data_path) and _is_current(stamp_path, _portal_stamp(client, identifier)):
+        print(f'{identifier}: unchanged on the portal, reading {data_path} in chunks')
+        for batch in pq.ParquetFile(data_path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+        return
+    yield from iter_chunks(client, identifier, page_size=chunksize, **fetch_options)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# socrata_async.py
+# one asyncio Socrata client for every dataset, fetching them all concurrently
+#
+# Each script opens its own sodapy client and fetches its datasets one after another, so a full
+# refresh waits for the metadata, count and data requests of the seven datasets in sequence.
+# AsyncSocrata shares one pooled HTTP session between all the datasets and runs every request
+# concurrently, up to `concurrency` at a time: the metadata and row counts of all the datasets
+# go out at once, then every page of every dataset that changed. datasets() gives one awaitable
+# per dataset, so a caller can start working on the first dataset that arrives.
+#
+# The requests themselves are made with requests, on a thread pool the size of the concurrency
+# cap (no extra dependency; the sockets release the GIL), and the JSON of each page is turned
+# into a data frame on the same thread, so the event loop only schedules.
+#
+# cached_fetch() keeps the same snapshots as snapshot_cache.py, so prefetch() can fill the cache
+# for every dataset up front and the scripts' own cached_fetch() calls then read the snapshots.
+#
+# Usage (from scripts/python-scripts), to bring the snapshots of all seven datasets up to date:
+#   python3 socrata_async.py
+#   python3 socrata_async.py 5242-pnmt ih6g-qkwz --concurrency 16
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from snapshot_cache import _cache_paths, _is_current, default_cache_dir
+from socrata_fetch import _page_to_chunk, default_page_size
+from budget_config import natural_keys, socrata_dtypes
+
+# the datasets the pipelines read
+all_identifiers = list(natural_keys)
+
+# requests in flight at the same time, over all the datasets
+default_concurrency = 8
+
+default_timeout = 300
+
+
+class AsyncSocrata:
+    """
+    asyncio client for the SODA endpoints of one domain.
+
+    domain is a host name ('data.lacity.org', over https) or a base URL ('http://127.0.0.1:8080').
+    Use as an async context manager, or call close() when done.
+    """
+
+    def __init__(self, domain='data.lacity.org', app_token=None, username=None, password=None,
+                 concurrency=default_concurrency, timeout=default_timeout):
+        self.base_url = domain.rstrip('/') if '://' in domain else f'https://{domain}'
+        self.timeout = timeout
+        self.session = requests.Session()
+        # one kept-alive connection per request in flight
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if app_token:
+            self.session.headers['X-App-Token'] = app_token
+        if username and password:
+            self.session.auth = (username, password)
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='socrata')
+
+    def _get_json(self, path, params, convert):
+        # runs on the thread pool
+        response = self.session.get(f'{self.base_url}{path}', params=params, timeout=self.timeout)
+        response.raise_for_status()
+        records = response.json()
+        return convert(records) if convert else records
+
+    async def _get(self, path, params=None, convert=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, self._get_json, path, params, convert)
+
+    async def get(self, identifier, convert=None, exclude_system_fields=True, **query):
+        """
+        The records of a SoQL query (select=, where=, order=, limit=, offset=, ...), like
+        sodapy's get(); convert is applied to them on the request's thread.
+        """
+        params = {f'${k}': v for k, v in query.items() if v is not None}
+        if not exclude_system_fields:
+            params['$$exclude_system_fields'] = 'false'
+        return await self._get(f'/resource/{identifier}.json', params, convert)
+
+    async def get_metadata(self, identifier):
+        return await self._get(f'/api/views/{identifier}.json')
+
+    async def count_rows(self, identifier, where=None):
+        result = await self.get(identifier, select='count(*)', where=where)
+        return int(result[0]['count']) if result else 0
+
+    async def fetch(self, identifier, page_size=default_page_size, dtypes=None, exclude_system_fields=True,
+                    total=None, **query):
+        """
+        The whole dataset (or the rows of a where= query) as a data frame, every page requested at
+        once. total is the row count, if already known.
+        """
+        start = time.perf_counter()
+        if total is None:
+            total = await self.count_rows(identifier, where=query.get('where'))
+        convert = partial(_page_to_chunk, dtypes=dtypes)
+        pages = [self.get(identifier, convert=convert, exclude_system_fields=exclude_system_fields,
+                          limit=page_size, offset=offset, order=':id', **query)
+                 for offset in range(0, total, page_size)]
+        chunks = [chunk for chunk in await asyncio.gather(*pages) if len(chunk)]
+        df = pd.concat(chunks, axis=0, ignore_index=True) if chunks else pd.DataFrame()
+        print(f'{identifier}: fetched {len(df)} rows in {time.perf_counter() - start:.1f}s')
+        return df
+
+    async def portal_stamp(self, identifier):
+        """The metadata snapshot_cache compares to tell whether the dataset changed on the portal."""
+        metadata, row_count = await asyncio.gather(self.get_metadata(identifier), self.count_rows(identifier))
+        return {
+            'rowsUpdatedAt': metadata.get('rowsUpdatedAt'),
+            'viewLastModified': metadata.get('viewLastModified'),
+            'row_count': row_count,
+        }
+
+    async def cached_fetch(self, identifier, cache_dir=default_cache_dir, refresh=False, **fetch_options):
+        """snapshot_cache.cached_fetch: the snapshot if the dataset is unchanged, else a download."""
+        loop = asyncio.get_running_loop()
+        data_path, stamp_path = _cache_paths(cache_dir, identifier, fetch_options)
+        stamp = await self.portal_stamp(identifier)
+
+        if not refresh and _is_current(stamp_path, stamp):
+            print(f'{identifier}: unchanged on the portal, loading {data_path}')
+            return await loop.run_in_executor(None, pd.read_parquet, data_path)
+
+        df = await self.fetch(identifier, total=stamp['row_count'], **fetch_options)
+
+        # the data before the stamp, so an interrupted write never looks like a valid cache
+        os.makedirs(cache_dir, exist_ok=True)
+        await loop.run_in_executor(None, partial(df.to_parquet, data_path, index=False))
+        with open(stamp_path, 'w') as f:
+            json.dump(stamp, f)
+        return df
+
+    def datasets(self, identifiers=all_identifiers, cached=True, **fetch_options):
+        """
+        Start fetching every dataset; returns {identifier: task}, each task resolving to the
+        dataset's data frame. Must be called from a running event loop.
+        """
+        fetch = self.cached_fetch if cached else self.fetch
+        return {identifier: asyncio.create_task(fetch(identifier, **fetch_options)) for identifier in identifiers}
+
+    async def close(self):
+        self._pool.shutdown(wait=False)
+        self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def fetch_all(identifiers=all_identifiers, domain='data.lacity.org', concurrency=default_concurrency,
+              cached=True, **fetch_options):
+    """Fetch the datasets concurrently from synchronous code; returns {identifier: data frame}."""
+    async def run():
+        async with AsyncSocrata(domain, concurrency=concurrency) as client:
+            tasks = client.datasets(identifiers, cached=cached, **fetch_options)
+            return dict(zip(tasks, await asyncio.gather(*tasks.values())))
+
+    return asyncio.run(run())
+
+
+def prefetch(identifiers=all_identifiers, domain='data.lacity.org', concurrency=default_concurrency,
+             cache_dir=default_cache_dir):
+    """
+    Bring the snapshots the scripts read (with the ':id' system field and the dtypes of
+    budget_config.socrata_dtypes) up to date, all datasets at once; returns the number of rows of each dataset.
+    """
+    async def run():
+        async with AsyncSocrata(domain, concurrency=concurrency) as client:
+            # the same options as the scripts' cached_fetch() calls, so the snapshots have the same cache keys
+            tasks = {identifier: asyncio.create_task(client.cached_fetch(
+                identifier, cache_dir=cache_dir, exclude_system_fields=False, dtypes=socrata_dtypes.get(identifier, {})))
+                for identifier in identifiers}
+            return dict(zip(tasks, await asyncio.gather(*tasks.values())))
+
+    start = time.perf_counter()
+    frames = asyncio.run(run())
+    print(f'{len(frames)} datasets up to date in {time.perf_counter() - start:.1f}s')
+    return {identifier: len(df) for identifier, df in frames.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bring the local snapshots of the Socrata datasets up to date.')
+    parser.add_argument('identifiers', nargs='*', default=all_identifiers)
+    parser.add_argument('--domain', default='data.lacity.org')
+    parser.add_argument('--concurrency', type=int, default=default_concurrency)
+    parser.add_argument('--cache-dir', default=default_cache_dir)
+    args = parser.parse_args(argv)
+    prefetch(args.identifiers, args.domain, args.concurrency, args.cache_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# socrata_fetch.py
+# paged, bounded-memory download of a Socrata dataset into a data frame
+#
+# The scripts used to pull whole datasets with one client.get(identifier, limit=99999999999999)
+# call, holding the full JSON list and the data frame in memory at the same time, and making one
+# huge request that is the first thing to time out. fetch_dataset() instead pages through the
+# dataset with $limit/$offset (ordered by ':id' so the pages are stable), keeps a few pages in
+# flight at once, and converts each page to a typed chunk as soon as it arrives so that only the
+# chunks -- not the raw JSON -- are held until the final concat. iter_chunks() yields those chunks
+# one at a time instead, for callers that process the dataset out of core.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# rows per request; Socrata allows up to 50000 per page on the 2.0 endpoints
+default_page_size = 50000
+
+# number of pages downloading at the same time
+default_workers = 4
+
+
+def count_rows(client, identifier):
+    """Number of rows in the dataset, from a count(*) query."""
+    result = client.get(identifier, select='count(*)')
+    return int(result[0]['count']) if result else 0
+
+
+def _page_to_chunk(records, dtypes):
+    # convert one page of JSON records to a data frame and apply the requested dtypes
+    chunk = pd.DataFrame.from_records(records)
+    if dtypes:
+        chunk = chunk.astype({c: t for c, t in dtypes.items() if c in chunk.columns})
+    return chunk
+
+
+def iter_chunks(client, identifier, page_size=default_page_size, workers=default_workers,
+                dtypes=None, exclude_system_fields=True, **query):
+    """
+    Yield the dataset as one data frame per page, in ':id' order, with up to `workers` pages
+    downloading ahead. Only the pages in flight are held in memory.
+    """
+    start = time.perf_counter()
+    total = count_rows(client, identifier) if 'where' not in query else None
+
+    def get_page(offset):
+        return client.get(identifier, limit=page_size, offset=offset, order=':id',
+                          exclude_system_fields=exclude_system_fields, **query)
+
+    rows = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        offset = 0
+        in_flight = []
+        done = False
+        while not done or in_flight:
+            # keep up to `workers` pages downloading
+            while not done and len(in_flight) < workers:
+                in_flight.append(pool.submit(get_page, offset))
+                offset += page_size
+                # with a known row count we know when to stop submitting; otherwise keep
+                # going until the first short page (see below)
+                if total is not None and offset >= total:
+                    done = True
+
+            # consume pages in order, so that the chunks stay sorted by ':id'
+            records = in_flight.pop(0).result()
+            if len(records) < page_size:
+                # a short page is the last one; anything still in flight is past the end
+                done = True
+                for future in in_flight:
+                    future.cancel()
+                in_flight = []
+            if records:
+                rows += len(records)
+                chunk = _page_to_chunk(records, dtypes)
+                del records
+                yield chunk
+
+    elapsed = time.perf_counter() - start
+    rate = rows / elapsed if elapsed > 0 else float('inf')
+    print(f'{identifier}: fetched {rows} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec)')
+
+
+def fetch_dataset(client, identifier, page_size=default_page_size, workers=default_workers,
+                  dtypes=None, exclude_system_fields=True, **query):
+    """
+    Download a whole dataset page by page.
+
+    client is a sodapy.Socrata (or anything with the same get() signature), dtypes an optional
+    {column: dtype} mapping applied to each page (the pipelines pass the dataset's entry of
+    budget_config.socrata_dtypes), and any other keyword arguments (select, where, ...) are passed
+    through as SoQL parameters.
+    """
+    chunks = list(iter_chunks(client, identifier, page_size, workers, dtypes, exclude_system_fields, **query))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, axis=0, ignore_index=True)
@@ -0,0 +1,221 @@
+# socrata_sync.py
+# push only the rows that changed to Socrata, instead of replacing the whole dataset
+#
+# Every pipeline rebuilds the full history and used to end in client.replace(...), so adding
+# one fiscal year re-uploaded every row since 2010. sync_changes() compares the freshly built
+# frame with the snapshot fetched from Socrata on a natural key and sends only the inserted,
+# changed and deleted rows as batched upserts.
+#
+# The old snapshot should be fetched with exclude_system_fields=False so that it carries the
+# Socrata ':id' of every row -- changed and deleted rows are addressed by ':id', which works
+# even for datasets that have no row identifier set on the portal.
+#
+# The client only needs an upsert(identifier, records) method, so a local fake endpoint can
+# stand in for sodapy.Socrata when testing. FakeEndpoint is one: it keeps the rows in memory and
+# applies upserts the way the portal does (a record without ':id' is inserted, one with ':id'
+# updates that row, and ':deleted' removes it). To check a sync against it:
+#
+#   python3 socrata_sync.py --rows 20000
+
+import argparse
+import sys
+
+import pandas as pd
+
+# the natural keys of the datasets, by identifier, using the Socrata column names
+from budget_config import natural_keys
+
+# number of rows sent per upsert request
+default_batch_size = 5000
+
+
+def drop_system_fields(df):
+    """Remove the Socrata system columns (':id', ':created_at', ...) from a fetched frame."""
+    return df[[c for c in df.columns if not str(c).startswith(':')]]
+
+
+def _normalize(series):
+    # Socrata returns every value as a string, while the new frames hold ints and floats.
+    # compare numbers as numbers ('758985' == 758985 == 758985.0) and everything else as
+    # stripped strings, with all kinds of missing values collapsed to ''
+    numbers = pd.to_numeric(series, errors='coerce')
+    text = series.astype(object).where(series.notna(), '').astype(str).str.strip()
+    text = text.mask(text.isin(['nan', 'None', 'NaN', '<NA>']), '')
+    return text.where(numbers.isna(), numbers.astype(float).astype(str))
+
+
+def _keyed(df, key):
+    # normalized copy of df with an occurrence counter, so that duplicate natural keys are
+    # matched up in order rather than multiplied out by the merge
+    out = pd.DataFrame({c: _normalize(df[c]) for c in df.columns if not str(c).startswith(':')}, index=df.index)
+    if ':id' in df.columns:
+        out[':id'] = df[':id']
+    out['_occurrence'] = out.groupby(key, sort=False).cumcount()
+    return out
+
+
+def diff_frames(old, new, key):
+    """
+    Compare the old Socrata snapshot with the new frame on the natural key.
+
+    Returns (inserted, changed, deleted): inserted and changed are rows of new (changed rows
+    also carry the ':id' of the row they replace, when old has one), deleted are rows of old.
+    Only columns present in new are compared.
+    """
+    missing = [c for c in key if c not in old.columns or c not in new.columns]
+    if missing:
+        raise KeyError(f'natural key columns missing from the data: {missing}')
+
+    columns = list(new.columns)
+    old_keyed = _keyed(old[[c for c in old.columns if c in columns or c == ':id']], key)
+    new_keyed = _keyed(new, key)
+    new_keyed['_row'] = range(len(new))
+    old_keyed['_row'] = range(len(old))
+
+    merged = pd.merge(old_keyed, new_keyed, on=key + ['_occurrence'], how='outer',
+                      suffixes=('_old', '_new'), indicator=True)
+
+    inserted = new.iloc[merged.loc[merged['_merge'] == 'right_only', '_row_new'].astype(int)]
+    deleted = old.iloc[merged.loc[merged['_merge'] == 'left_only', '_row_old'].astype(int)]
+
+    both = merged[merged['_merge'] == 'both']
+    value_columns = [c for c in columns if c not in key]
+    differs = pd.Series(False, index=both.index)
+    for c in value_columns:
+        if c in old_keyed.columns:
+            differs |= both[f'{c}_old'] != both[f'{c}_new']
+        else:
+            # a column that doesn't exist on Socrata yet counts as changed if it has a value
+            differs |= both[c] != ''
+    both = both[differs]
+    changed = new.iloc[both['_row_new'].astype(int)].copy()
+    if ':id' in old.columns:
+        changed[':id'] = both[':id'].values
+
+    return inserted, changed, deleted
+
+
+def _records(df):
+    # JSON-ready records: missing values are sent as null
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+
+def sync_changes(client, identifier, old, new, key=None, batch_size=default_batch_size):
+    """
+    Upsert only the inserted, changed and deleted rows of new relative to old.
+
+    Returns a dict with the number of rows in each category and the number of requests made.
+    """
+    key = key or natural_keys[identifier]
+    inserted, changed, deleted = diff_frames(old, new, key)
+
+    if len(deleted) and ':id' not in deleted.columns:
+        raise ValueError('the old snapshot has no :id column, so deleted rows cannot be addressed; '
+                         'fetch it with exclude_system_fields=False')
+
+    records = _records(inserted) + _records(changed)
+    records += [{':id': row_id, ':deleted': True} for row_id in deleted[':id']] if len(deleted) else []
+
+    requests = 0
+    for start in range(0, len(records), batch_size):
+        client.upsert(identifier, records[start:start + batch_size])
+        requests += 1
+
+    summary = {
+        'inserted': len(inserted),
+        'changed': len(changed),
+        'deleted': len(deleted),
+        'requests': requests,
+    }
+    print(f'{identifier}: {summary}')
+    return summary
+
+
+class FakeEndpoint:
+    """In-memory stand-in for sodapy.Socrata with get() and upsert(), for testing syncs."""
+
+    def __init__(self, datasets=None):
+        self.datasets = {}
+        self.requests = 0
+        self._next_id = 0
+        for identifier, records in (datasets or {}).items():
+            self.upsert(identifier, records)
+        self.requests = 0
+
+    def _new_id(self):
+        self._next_id += 1
+        return f'row-fake-{self._next_id}'
+
+    def get(self, identifier, select=None, limit=1000, offset=0, exclude_system_fields=True, **query):
+        rows = list(self.datasets.get(identifier, {}).values())
+        if select == 'count(*)':
+            return [{'count': str(len(rows))}]
+        rows = rows[offset:offset + limit]
+        if exclude_system_fields:
+            rows = [{k: v for k, v in row.items() if not k.startswith(':')} for row in rows]
+        return [dict(row) for row in rows]
+
+    def upsert(self, identifier, records):
+        rows = self.datasets.setdefault(identifier, {})
+        self.requests += 1
+        for record in records:
+            row_id = record.get(':id')
+            if record.get(':deleted'):
+                if row_id not in rows:
+                    raise KeyError(f'{identifier}: no row {row_id} to delete')
+                del rows[row_id]
+            elif row_id is not None and row_id in rows:
+                rows[row_id].update({k: v for k, v in record.items() if k != ':id'})
+            else:
+                row_id = row_id or self._new_id()
+                rows[row_id] = {**record, ':id': row_id}
+        return {'Rows Updated': len(records)}
+
+    def rows(self, identifier):
+        """The rows of a dataset as a frame (with their ':id')."""
+        return pd.DataFrame(list(self.datasets.get(identifier, {}).values()))
+
+
+def _comparable(df, columns):
+    # the rows as normalized strings in a fixed order, for comparing two frames
+    out = pd.DataFrame({c: _normalize(df[c]) if c in df.columns else '' for c in columns})
+    return out.sort_values(columns).reset_index(drop=True)
+
+
+def fake_demo(rows, seed=0):
+    """Sync a changed copy of synthetic appropriations to a FakeEndpoint; True if it ends up equal to the new frame."""
+    import numpy as np
+
+    import synthetic_data
+
+    identifier = '5242-pnmt'
+    records = synthetic_data.socrata_appropriations(rows, seed=seed)
+    endpoint = FakeEndpoint({identifier: records})
+    old = pd.DataFrame(endpoint.get(identifier, limit=rows, exclude_system_fields=False))
+
+    # the new build: some amounts changed, some rows gone, a new fiscal year added
+    rng = np.random.default_rng(seed)
+    new = drop_system_fields(old).copy()
+    changed = rng.random(len(new)) < 0.05
+    new.loc[changed, 'appropriation'] = (pd.to_numeric(new.loc[changed, 'appropriation']) + 1).astype(str)
+    new = new[rng.random(len(new)) >= 0.02]
+    added = drop_system_fields(pd.DataFrame(synthetic_data.socrata_appropriations(rows // 10, seed=seed + 1)))
+    new = pd.concat([new, added.assign(fiscal_year='2022')], ignore_index=True)
+
+    summary = sync_changes(endpoint, identifier, old, new)
+    result = endpoint.rows(identifier)
+    same = _comparable(result, list(new.columns)).equals(_comparable(new, list(new.columns)))
+    print(f'{len(result)} rows on the fake endpoint after {summary["requests"]} requests, '
+          f'{len(new)} in the new frame: {"identical" if same else "DIFFERENT"}')
+    return same
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check sync_changes against a local fake endpoint.')
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args(argv)
+    return 0 if fake_demo(args.rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
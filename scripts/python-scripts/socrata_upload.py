@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# socrata_upload.py
+# resumable, parallel upload of a full dataset replacement to Socrata
+#
+# When a dataset does have to be replaced as a whole (e.g. positions or incremental changes after
+# a schema change), client.replace(identifier, df) sends every row in one request; if it fails,
+# the whole upload starts over. replace_dataset() instead:
+#   1. splits the frame into chunks of at most max_chunk_bytes of JSON, cutting on the exact
+#      serialized size of every row
+#   2. sends the first chunk as a replace (PUT), which truncates the dataset, and the others as
+#      upserts (POST), a few at a time over one pooled HTTP session
+#   3. retries a chunk that fails with a connection error, a timeout, 429 or 5xx, backing off
+#      exponentially (or as long as the server's Retry-After says)
+#   4. records every acknowledged chunk in a checkpoint file, so that running the same upload
+#      again after an interruption only sends the chunks that are missing
+#
+# The checkpoint is tied to a fingerprint of the frame; if the data changed in between, the
+# upload starts over from the replace. A chunk whose response was lost may be sent twice, which
+# appends its rows twice to a dataset without a row identifier -- set one on the portal for the
+# datasets uploaded this way.
+#
+# StandInSocrata is a local HTTP server with the same two endpoints, which can fail requests on
+# purpose, to try the uploader without touching the portal.
+#
+# Usage (from scripts/python-scripts):
+#   python3 socrata_upload.py 46qe-t7np ../../data/approved_budget/FY21-22/new_positions.csv
+#   python3 socrata_upload.py --stand-in --rows 200000    # flaky local server, with a resume
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+# where the checkpoints are kept, relative to scripts/python-scripts
+default_checkpoint_dir = '../../data/upload_checkpoints/'
+
+# Socrata rejects very large request bodies; a few MB per request keeps every request short
+default_max_chunk_bytes = 8 * 2**20
+
+# chunks in flight at the same time
+default_workers = 4
+
+default_retries = 5
+default_backoff = 1.0
+max_backoff = 60.0
+default_timeout = 300
+
+# responses worth retrying; any other error status fails the upload
+retry_statuses = {408, 429, 500, 502, 503, 504}
+
+# rows serialized at a time when measuring the size of every row
+_measure_rows = 20000
+
+
+class UploadError(RuntimeError):
+    """A chunk was rejected, or still failing after every retry."""
+
+
+def fingerprint(df):
+    """Hash of the columns and values of df, to tell whether a checkpoint belongs to it."""
+    digest = hashlib.sha1(json.dumps([str(c) for c in df.columns]).encode())
+    digest.update(str(len(df)).encode())
+    digest.update(str(int(pd.util.hash_pandas_object(df.astype(str), index=False).sum())).encode())
+    return digest.hexdigest()
+
+
+def _serialize(df):
+    # pandas' C encoder; missing values become null
+    return df.to_json(orient='records', date_format='iso')
+
+
+def plan_chunks(df, max_chunk_bytes=default_max_chunk_bytes):
+    """
+    Row boundaries [0, b1, ..., len(df)] of chunks that each serialize to at most
+    max_chunk_bytes (a single row larger than that gets a chunk of its own).
+    """
+    sizes = []
+    for start in range(0, len(df), _measure_rows):
+        lines = df.iloc[start:start + _measure_rows].to_json(orient='records', lines=True, date_format='iso')
+        # non-ASCII characters are escaped, so the length of a line is its size in bytes; the
+        # comma that separates it from the next row is counted with it
+        sizes.append(np.fromiter((len(line) + 1 for line in lines.rstrip('\n').split('\n')), dtype=np.int64))
+    if not sizes:
+        return [0, 0]
+    ends = np.cumsum(np.concatenate(sizes))
+
+    bounds = [0]
+    # the 2 bytes of the brackets around the array
+    budget = max_chunk_bytes - 2
+    while bounds[-1] < len(df):
+        start = bounds[-1]
+        offset = ends[start - 1] if start else 0
+        stop = int(np.searchsorted(ends, offset + budget, side='right'))
+        bounds.append(max(stop, start + 1))
+    return bounds
+
+
+class _Checkpoint:
+    # the acknowledged chunks of one upload, saved after every acknowledgement
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, checkpoint_dir, identifier, df, max_chunk_bytes):
+        path = os.path.join(checkpoint_dir, f'{identifier}.json')
+        digest = fingerprint(df)
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('fingerprint') == digest and state.get('max_chunk_bytes') == max_chunk_bytes:
+                return cls(path, state)
+            print(f'{identifier}: the data changed since the interrupted upload, starting over')
+        state = {
+            'identifier': identifier,
+            'fingerprint': digest,
+            'max_chunk_bytes': max_chunk_bytes,
+            'bounds': [int(b) for b in plan_chunks(df, max_chunk_bytes)],
+            'acked': [],
+        }
+        checkpoint = cls(path, state)
+        checkpoint.save()
+        return checkpoint
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def ack(self, chunk):
+        with self._lock:
+            self.state['acked'] = sorted(set(self.state['acked']) | {chunk})
+            self.save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ChunkedUploader:
+    """
+    Uploads data frames to one Socrata domain over a pooled session.
+
+    domain is a host name ('data.lacity.org', sent over https) or a base URL
+    ('http://127.0.0.1:8080', e.g. a StandInSocrata).
+    """
+
+    def __init__(self, domain, app_token=None, username=None, password=None, workers=default_workers,
+                 max_chunk_bytes=default_max_chunk_bytes, retries=default_retries, backoff=default_backoff,
+                 timeout=default_timeout, checkpoint_dir=default_checkpoint_dir):
+        self.base_url = domain.rstrip('/') if '://' in domain else f'https://{domain}'
+        self.workers = workers
+        self.max_chunk_bytes = max_chunk_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.checkpoint_dir = checkpoint_dir
+
+        self.session = requests.Session()
+        # one kept-alive connection per worker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        if app_token:
+            self.session.headers['X-App-Token'] = app_token
+        if username and password:
+            self.session.auth = (username, password)
+
+    def _send(self, method, identifier, body):
+        # one request, retried on the failures that are worth retrying
+        url = f'{self.base_url}/resource/{identifier}.json'
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, data=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error, wait_for = e, None
+            else:
+                if response.ok:
+                    return response
+                if response.status_code not in retry_statuses:
+                    raise UploadError(f'{method} {url}: {response.status_code} {response.text[:500]}')
+                error = f'{response.status_code} {response.reason}'
+                retry_after = response.headers.get('Retry-After', '')
+                wait_for = float(retry_after) if retry_after.replace('.', '', 1).isdigit() else None
+
+            if attempt == self.retries:
+                raise UploadError(f'{method} {url}: still failing after {self.retries} retries ({error})')
+            if wait_for is None:
+                # exponential backoff, with jitter so the workers don't retry in lockstep
+                wait_for = min(max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+            time.sleep(wait_for)
+
+    def _send_chunk(self, identifier, df, bounds, chunk, checkpoint):
+        body = _serialize(df.iloc[bounds[chunk]:bounds[chunk + 1]]).encode()
+        self._send('PUT' if chunk == 0 else 'POST', identifier, body)
+        checkpoint.ack(chunk)
+        return chunk
+
+    def replace(self, identifier, df):
+        """
+        Replace the rows of the dataset with df, resuming an interrupted upload of the same df.
+        Returns a dict with the number of rows, chunks and chunks sent by this call.
+        """
+        checkpoint = _Checkpoint.open(self.checkpoint_dir, identifier, df, self.max_chunk_bytes)
+        bounds = checkpoint.state['bounds']
+        chunks = len(bounds) - 1
+        acked = set(checkpoint.state['acked'])
+        if acked:
+            print(f'{identifier}: resuming, {len(acked)} of {chunks} chunks already uploaded')
+        start = time.perf_counter()
+
+        # the replace truncates the dataset, so the upserts can only follow it
+        todo = [c for c in range(chunks) if c not in acked]
+        if 0 in todo:
+            self._send_chunk(identifier, df, bounds, 0, checkpoint)
+            todo.remove(0)
+
+        # chunks are serialized as they are submitted, so only the ones in flight are held as JSON
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            queue = iter(todo)
+            in_flight = set()
+            error = None
+            while True:
+                while error is None and len(in_flight) < self.workers:
+                    chunk = next(queue, None)
+                    if chunk is None:
+                        break
+                    in_flight.add(pool.submit(self._send_chunk, identifier, df, bounds, chunk, checkpoint))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        error = error or e
+            if error is not None:
+                remaining = chunks - len(checkpoint.state['acked'])
+                print(f'{identifier}: upload interrupted, {remaining} of {chunks} chunks left; '
+                      f'run it again to resume')
+                raise error
+
+        checkpoint.remove()
+        summary = {'rows': len(df), 'chunks': chunks, 'sent': chunks - len(acked)}
+        print(f'{identifier}: {summary} in {time.perf_counter() - start:.1f}s')
+        return summary
+
+
+def replace_dataset(domain, identifier, df, **kwargs):
+    """Replace the rows of a dataset with df; see ChunkedUploader for the options."""
+    return ChunkedUploader(domain, **kwargs).replace(identifier, df)
+
+
+class StandInSocrata:
+    """
+    Local HTTP stand-in for the Socrata upload endpoints: PUT /resource/<id>.json replaces the
+    rows of a dataset, POST appends them.
+
+    fail_rate is the share of requests answered with 503 (seeded, so runs are repeatable);
+    requests after the first fail_after ones are all answered with 503, to simulate an outage.
+    Use as a context manager; url is the base URL to give to ChunkedUploader.
+    """
+
+    def __init__(self, fail_rate=0.0, fail_after=None, seed=0):
+        self.fail_rate = fail_rate
+        self.fail_after = fail_after
+        self.datasets = {}
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _receive(self, replace):
+                records = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'[]')
+                identifier = self.path.rsplit('/', 1)[-1].split('.')[0]
+                with stand_in._lock:
+                    stand_in.requests += 1
+                    failing = (stand_in.fail_after is not None and stand_in.requests > stand_in.fail_after) \
+                        or stand_in._random.random() < stand_in.fail_rate
+                    if not failing:
+                        if replace:
+                            stand_in.datasets[identifier] = []
+                        stand_in.datasets.setdefault(identifier, []).extend(records)
+                if failing:
+                    self._respond(503, {'message': 'stand-in failure'})
+                else:
+                    self._respond(200, {'Rows Created': len(records), 'Errors': 0})
+
+            def do_PUT(self):
+                self._receive(replace=True)
+
+            def do_POST(self):
+                self._receive(replace=False)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def rows(self, identifier):
+        """The rows received for a dataset, as a data frame."""
+        return pd.DataFrame.from_records(self.datasets.get(identifier, []))
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def stand_in_demo(rows, checkpoint_dir):
+    # upload synthetic positions to a flaky stand-in, interrupt the upload with an outage and resume it
+    import synthetic_data
+
+    df = synthetic_data.positions(rows)
+    identifier = '46qe-t7np'
+    options = dict(max_chunk_bytes=2**20, backoff=0.01, retries=3, checkpoint_dir=checkpoint_dir)
+    with StandInSocrata(fail_rate=0.1, fail_after=10) as server:
+        try:
+            replace_dataset(server.url, identifier, df, **options)
+        except UploadError as e:
+            print(f'first attempt failed as planned: {e}')
+        server.fail_after = None
+        replace_dataset(server.url, identifier, df, **options)
+        received = server.rows(identifier)
+    print(f'{len(received)} rows on the stand-in, {len(df)} uploaded; '
+          f'{received.drop_duplicates().shape[0]} distinct, {server.requests} requests')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replace a Socrata dataset in resumable, parallel chunks.')
+    parser.add_argument('identifier', nargs='?', help='dataset identifier, e.g. 46qe-t7np')
+    parser.add_argument('csv', nargs='?', help='the csv file with the new rows')
+    parser.add_argument('--domain', default='data.lacity.org')
+    parser.add_argument('--workers', type=int, default=default_workers)
+    parser.add_argument('--max-chunk-mb', type=float, default=default_max_chunk_bytes / 2**20)
+    parser.add_argument('--checkpoint-dir', default=default_checkpoint_dir)
+    parser.add_argument('--stand-in', action='store_true', help='upload synthetic data to a local flaky server')
+    parser.add_argument('--rows', type=int, default=100000, help='rows of synthetic data for --stand-in')
+    args = parser.parse_args(argv)
+
+    if args.stand_in:
+        stand_in_demo(args.rows, args.checkpoint_dir)
+        return 0
+    if not args.identifier or not args.csv:
+        parser.error('give a dataset identifier and a csv file, or --stand-in')
+
+    import credentials
+
+    df = pd.read_csv(args.csv, dtype=str)
+    replace_dataset(args.domain, args.identifier, df, app_token=credentials.lahub_auth,
+                    username=credentials.lahub_user, password=credentials.lahub_pass, workers=args.workers,
+                    max_chunk_bytes=int(args.max_chunk_mb * 2**20), checkpoint_dir=args.checkpoint_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
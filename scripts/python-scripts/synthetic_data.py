@@ -0,0 +1,170 @@
+# synthetic_data.py
+# generate realistic-looking budget data of any size, for benchmarking the pipelines
+#
+# The frames have the same columns (and roughly the same code formats and cardinalities) as the
+# City Administrative Office exports: Expenditures_Sec2, Positions and Budget_Requests_Detail,
+# plus the appropriations dataset as it comes back from Socrata and Exhibit B page text.
+
+import numpy as np
+import pandas as pd
+
+# rough cardinalities of the real data
+n_departments = 60
+programs_per_department = 8
+n_funds = 120
+n_accounts = 300
+n_position_accounts = 12
+
+departments = ['Aging', 'Animal Services', 'Building and Safety', 'City Administrative Officer',
+               'City Attorney', 'City Clerk', 'Controller', 'Cultural Affairs', 'Fire', 'General Services',
+               'Housing', 'Information Technology Agency', 'Library', 'Personnel', 'Police',
+               'Public Works - Sanitation', 'Recreation and Parks', 'Transportation', 'Zoo']
+words = ['Services', 'Operations', 'Support', 'Planning', 'Maintenance', 'Management', 'Programs',
+         'Development', 'Enforcement', 'Administration', 'Technology', 'Safety', 'Community', 'Facilities']
+categories = ['1-Obligatory Changes', '2-Deletion of One-Time Services', '3-Continuation of Services',
+              '4-New Services', '5-Efficiencies to Services', '6-Other Changes or Adjustments']
+
+
+def _dimension(rng, n, prefix, width, names):
+    # codes and names of one dimension (e.g. n accounts)
+    codes = np.array([str(i + 1).zfill(width) for i in range(n)], dtype=object)
+    labels = np.array([f'{names[i % len(names)]} {prefix} {i // len(names) + 1}' for i in range(n)], dtype=object)
+    return codes, labels
+
+
+def _hierarchy(rng, n):
+    # n (department, program, fund, account) combinations; a department's programs share its code prefix
+    dept = rng.integers(0, n_departments, n)
+    prog = dept * programs_per_department + rng.integers(0, programs_per_department, n)
+    dept_codes = np.array([str(i + 1).zfill(2) for i in range(n_departments)], dtype=object)
+    dept_names = np.array([departments[i % len(departments)] + ('' if i < len(departments) else f' {i}')
+                           for i in range(n_departments)], dtype=object)
+    prog_codes = np.array([dept_codes[i // programs_per_department] + str(i % programs_per_department + 1).zfill(2)
+                           for i in range(n_departments * programs_per_department)], dtype=object)
+    prog_names = np.array([f'{words[i % len(words)]} {words[(i // len(words)) % len(words)]} {i}'
+                           for i in range(n_departments * programs_per_department)], dtype=object)
+    return pd.DataFrame({
+        'Dept Code': dept_codes[dept],
+        'Dept Name': dept_names[dept],
+        'Org Level 5 Code': dept_codes[dept] + 'LVL5',
+        'Org Level 5 Name': dept_names[dept],
+        'Prog Code': prog_codes[prog],
+        'Prog Name': prog_names[prog],
+    })
+
+
+def _amounts(rng, n, scale=1e6):
+    # skewed amounts with some blanks, like the real appropriation columns
+    values = np.round(rng.lognormal(np.log(scale) - 2, 2, n))
+    values[rng.random(n) < 0.1] = np.nan
+    return values
+
+
+def expenditures(n, seed=0):
+    """An Expenditures_Sec2-shaped frame with n rows."""
+    rng = np.random.default_rng(seed)
+    df = _hierarchy(rng, n)
+    fund_codes, fund_names = _dimension(rng, n_funds, 'Fund', 3, words)
+    account_codes, account_names = _dimension(rng, n_accounts, 'Account', 6, words)
+    fund = rng.integers(0, n_funds, n)
+    account = rng.integers(0, n_accounts, n)
+    df['Fund Code'] = fund_codes[fund]
+    df['Fund Name'] = fund_names[fund]
+    df['Source Fund Code'] = fund_codes[fund]
+    df['Source Fund Name'] = fund_names[fund]
+    df['Account Code'] = account_codes[account]
+    df['Account Name'] = account_names[account]
+    for column in ['2019-20 Actuals', '2020-21 Adopted Budget', '2020-21 Estimates', '2021-22 Proposed Budget', '2021-22 Adopted']:
+        df[column] = _amounts(rng, n)
+    return df
+
+
+def positions(n, seed=0):
+    """A Positions-shaped frame with n rows."""
+    rng = np.random.default_rng(seed)
+    df = _hierarchy(rng, n)
+    fund_codes, fund_names = _dimension(rng, n_funds, 'Fund', 3, words)
+    account_codes, account_names = _dimension(rng, n_position_accounts, 'Positions', 0, words)
+    fund = rng.integers(0, n_funds, n)
+    account = rng.integers(0, n_position_accounts, n)
+    df['Fund Code'] = fund_codes[fund]
+    df['Source Fund Code'] = fund_codes[fund]
+    df['Source Fund Name'] = fund_names[fund]
+    df['Account Code'] = 'POS' + account_codes[account]
+    df['Account Name'] = account_names[account]
+    for column in ['2020-21 Adopted Budget', '2021-22 Proposed Budget', '2021-22 Adopted']:
+        df[column] = np.round(rng.gamma(2, 20, n), 2)
+    return df
+
+
+def budget_requests(n, seed=0):
+    """A Budget_Requests_Detail-shaped frame with n rows."""
+    rng = np.random.default_rng(seed)
+    hierarchy = _hierarchy(rng, n)
+    fund_codes, fund_names = _dimension(rng, n_funds, 'Fund', 3, words)
+    account_codes, account_names = _dimension(rng, n_accounts, 'Account', 6, words)
+    fund = rng.integers(0, n_funds, n)
+    account = rng.integers(0, n_accounts, n)
+    description = rng.integers(0, 2000, n)
+    change = np.round(rng.normal(0, 2e5, n))
+    return pd.DataFrame({
+        'Department Code': hierarchy['Dept Code'],
+        'Department Name': hierarchy['Dept Name'],
+        'Program Code': hierarchy['Prog Code'],
+        'Program Name': hierarchy['Prog Name'],
+        'Fund Code': fund_codes[fund],
+        'Fund Name': fund_names[fund],
+        'Source Fund Code': fund_codes[fund],
+        'Source Fund Name': fund_names[fund],
+        'Budget Request Description': [f'{words[d % len(words)]} request {d}' for d in description],
+        'Budget Request Category': np.array(categories, dtype=object)[rng.integers(0, len(categories), n)],
+        'Budget Object Code': account_codes[account],
+        'Audit Budget Object Name': account_names[account],
+        'One Time/ On-going': np.where(rng.random(n) < 0.3, '01', 'BB'),
+        '2021-22 (Proposed) Incremental change from 2020-21 Adopted Budget': change,
+        '2021-22 (Adopted) Incremental change from 2020-21 Adopted Budget': change,
+    })
+
+
+def socrata_appropriations(n, seed=0, first_year=2010, last_year=2021):
+    """The appropriations dataset (5242-pnmt) as Socrata returns it: n records of strings."""
+    rng = np.random.default_rng(seed)
+    df = expenditures(n, seed)
+    out = pd.DataFrame({
+        ':id': [f'row-{i}' for i in range(n)],
+        'dept_code': df['Dept Code'].str.lstrip('0'),
+        'department_name': df['Dept Name'],
+        'subdept_code': df['Org Level 5 Code'],
+        'subdepartment_name': df['Org Level 5 Name'],
+        'prog_code': df['Prog Code'].str.lstrip('0'),
+        'program_name': df['Prog Name'],
+        'program_priority': np.array(['A Safe City', 'A Well Run City', 'A Prosperous City',
+                                      'A Livable and Sustainable City', ''], dtype=object)[rng.integers(0, 5, n)],
+        'source_fund_code': df['Source Fund Code'],
+        'source_fund_name': df['Source Fund Name'],
+        'account_code': df['Account Code'],
+        'account_name': df['Account Name'],
+        'appropriation': df['2021-22 Adopted'].fillna(0).astype(int).astype(str),
+        'fiscal_year': rng.integers(first_year, last_year + 1, n).astype(str),
+        'expense_type': None,
+    })
+    return out.to_dict(orient='records')
+
+
+def exhibit_b_pages(n_lines, lines_per_page=60, seed=0):
+    """Exhibit B page text with n_lines revenue lines, in the layout PyPDF2 extracts."""
+    rng = np.random.default_rng(seed)
+    amounts = np.round(rng.lognormal(16, 2, n_lines)).astype(np.int64)
+    sections = [('General Receipts', n_lines // 3), ('Special Receipts', n_lines // 3),
+                ('Available Balances', n_lines - 2 * (n_lines // 3))]
+    lines = []
+    i = 0
+    for section, count in sections:
+        lines.append(f'{section}:')
+        for _ in range(count):
+            lines.append(f'{words[i % len(words)]} Fund {i}{"." * 40} {amounts[i]:,}          0.{i % 10}%')
+            i += 1
+        lines.append(f'Total {section}{"." * 40} {amounts[i - count:i].sum():,} $   33.3%')
+    header = '% of\nTotal Total\n'
+    return [header + '\n'.join(lines[start:start + lines_per_page]) + 'EXHIBIT B\nBUDGET SUMMARY\nRECEIPTS'
+            for start in range(0, len(lines), lines_per_page)]
@@ -0,0 +1,225 @@
+# tracing.py
+# per-stage timing and memory instrumentation of the pipeline scripts
+#
+# A Tracer records one span per stage of a run (fetch, read, merge, write, ...): its wall time,
+# CPU time, the process's resident memory (current and peak) at the end of the stage, the growth
+# of Python-allocated memory during the stage (tracemalloc, when memory=True) and the number of
+# rows going in and out. finish() prints a table of the spans and writes them to a JSON trace
+# file, and optionally to a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+#
+# The scripts are flat, so stages are marked with begin()/end(); functions can use the stage()
+# context manager instead:
+#
+#   tracer = Tracer('expenses')
+#   tracer.begin('fetch socrata')
+#   old = cached_fetch(...)
+#   tracer.end(rows_out=old)
+#   with tracer.stage('merge', rows_in=len(old)) as span:
+#       merged = ...
+#       span.rows_out = merged
+#   tracer.finish('../../data/approved_budget/FY21-22/', chrome=True)
+#
+# CPU time is the whole process's, so it includes other threads running at the same time (e.g.
+# the stages pipeline_runner.py runs concurrently). tracemalloc slows allocation down noticeably,
+# which is why it is off unless memory=True.
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def _count(rows):
+    # rows can be given as a frame (or anything with a length) or as a number
+    if rows is None:
+        return None
+    return len(rows) if hasattr(rows, '__len__') else int(rows)
+
+
+def peak_rss():
+    """Peak resident memory of the process so far, in bytes (None if it can't be read)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss():
+    """Current resident memory of the process, in bytes (None if it can't be read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Span:
+    """One stage of a run; rows_in and rows_out can be set while it runs."""
+
+    def __init__(self, name, depth, thread, rows_in=None):
+        self.name = name
+        self.depth = depth
+        self.thread = thread
+        self.rows_in = _count(rows_in)
+        self.rows_out = None
+        self.start = None
+        self.wall = None
+        self.cpu = None
+        self.rss = None
+        self.peak_rss = None
+        self.traced_delta = None
+        self.traced_peak = None
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'depth': self.depth,
+            'thread': self.thread,
+            'start': round(self.start, 6),
+            'wall': round(self.wall, 6) if self.wall is not None else None,
+            'cpu': round(self.cpu, 6) if self.cpu is not None else None,
+            'rss': self.rss,
+            'peak_rss': self.peak_rss,
+            'traced_delta': self.traced_delta,
+            'traced_peak': self.traced_peak,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out if not hasattr(self.rows_out, '__len__') else len(self.rows_out),
+        }
+
+
+class Tracer:
+    """The spans of one run of a script; see the top of this file."""
+
+    def __init__(self, run, memory=False):
+        self.run = run
+        self.memory = memory
+        self.started = time.strftime('%Y-%m-%d_%H.%M.%S')
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def begin(self, name, rows_in=None):
+        """Start a stage, nested in the stage currently running in this thread, if any."""
+        stack = self._stack()
+        span = Span(name, len(stack), threading.current_thread().name, rows_in)
+        span._cpu_start = time.process_time()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak is reset for the new stage; the enclosing one keeps the peak it had so far
+            if stack:
+                stack[-1]._traced_peak = max(stack[-1]._traced_peak, peak - stack[-1]._traced_start)
+            tracemalloc.reset_peak()
+            span._traced_start = current
+            span._traced_peak = 0
+        span.start = time.perf_counter() - self._origin
+        stack.append(span)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def end(self, rows_out=None):
+        """End the innermost running stage of this thread; returns its span."""
+        span = self._stack().pop()
+        span.wall = time.perf_counter() - self._origin - span.start
+        span.cpu = time.process_time() - span._cpu_start
+        span.rss = current_rss()
+        span.peak_rss = peak_rss()
+        # counted now, so the span doesn't keep the frame alive
+        span.rows_out = _count(rows_out if rows_out is not None else span.rows_out)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            span.traced_delta = current - span._traced_start
+            span.traced_peak = max(span._traced_peak, peak - span._traced_start)
+            stack = self._stack()
+            if stack:
+                stack[-1]._traced_peak = max(stack[-1]._traced_peak,
+                                             span._traced_start + span.traced_peak - stack[-1]._traced_start)
+        return span
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        span = self.begin(name, rows_in)
+        try:
+            yield span
+        finally:
+            # the span is ended on this thread's stack, even if the stage raised
+            if span in self._stack():
+                while self._stack()[-1] is not span:
+                    self.end()
+                self.end()
+
+    def trace(self):
+        """The run and its spans, as a JSON-friendly dict."""
+        return {
+            'run': self.run,
+            'started': self.started,
+            'total': round(time.perf_counter() - self._origin, 6),
+            'spans': [span.as_dict() for span in self.spans],
+        }
+
+    def chrome_trace(self):
+        """The spans as Chrome trace events (complete events, in microseconds)."""
+        threads = {}
+        events = []
+        for span in self.spans:
+            if span.wall is None:
+                continue
+            tid = threads.setdefault(span.thread, len(threads))
+            args = {k: v for k, v in span.as_dict().items() if k not in ('name', 'start', 'wall', 'depth', 'thread')}
+            events.append({'name': span.name, 'cat': self.run, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                           'ts': round(span.start * 1e6), 'dur': round(span.wall * 1e6), 'args': args})
+        for name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def report(self):
+        """Print the spans, in the order they started."""
+        print(f'{"stage":<36} {"wall (s)":>9} {"cpu (s)":>8} {"rss (MB)":>9} {"peak (MB)":>10} {"rows in":>10} {"rows out":>10}')
+        for span in self.spans:
+            name = '  ' * span.depth + span.name
+            values = span.as_dict()
+            wall = f'{values["wall"]:.2f}' if values['wall'] is not None else '-'
+            cpu = f'{values["cpu"]:.2f}' if values['cpu'] is not None else '-'
+            rss = f'{values["rss"] / 2**20:.0f}' if values['rss'] else '-'
+            peak = f'{values["peak_rss"] / 2**20:.0f}' if values['peak_rss'] else '-'
+            rows_in = f'{values["rows_in"]:,}' if values['rows_in'] is not None else ''
+            rows_out = f'{values["rows_out"]:,}' if values['rows_out'] is not None else ''
+            print(f'{name[:36]:<36} {wall:>9} {cpu:>8} {rss:>9} {peak:>10} {rows_in:>10} {rows_out:>10}')
+
+    def finish(self, output_dir, chrome=False, report=True):
+        """
+        End the stages still running in this thread, print the report and write
+        trace_<run>_<started>.json (and .chrome.json with chrome=True) to output_dir.
+        Returns the path of the JSON trace.
+        """
+        while self._stack():
+            self.end()
+        if report:
+            self.report()
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, f'trace_{self.run}_{self.started}.json')
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f, indent=1)
+        if chrome:
+            with open(f'{path[:-len(".json")]}.chrome.json', 'w') as f:
+                json.dump(self.chrome_trace(), f)
+        print(f'trace written to {path}')
+        return path